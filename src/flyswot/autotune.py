@@ -0,0 +1,168 @@
+"""Batch size and thread count tuning."""
+
+import itertools
+import os
+import time
+from collections.abc import Iterable, Sequence, Sized
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import torch
+from loguru import logger
+from PIL import Image
+
+from flyswot import decode, models
+from flyswot.inference import InferenceSession
+
+AUTO = "auto"
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_BATCH_SIZES = (4, 8, 16, 32, 64)
+ACTIVATION_FACTOR = 16  # rough ratio of a model's peak activation memory to the size of its input tensor
+
+
+def parse_batch_size(bs: str | int) -> int | None:
+    """Parses a `--bs` value, returning None for `auto`
+
+    Raises:
+        ValueError: `bs` is neither `auto` nor a positive integer
+    """
+    if str(bs).strip().lower() == AUTO:
+        return None
+    batch_size = int(bs)
+    if batch_size < 1:
+        raise ValueError(f"Batch size must be at least 1, got {batch_size}")
+    return batch_size
+
+
+def available_memory(meminfo: Path = Path("/proc/meminfo")) -> int | None:
+    """Memory, in bytes, available to new processes, None if it can't be found
+
+    Uses MemAvailable from `meminfo`, which counts reclaimable page cache, falling back to the free physical
+    memory reported by `os.sysconf`.
+    """
+    try:
+        with open(meminfo) as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def default_memory_limit() -> int | None:
+    """Half of the memory currently available"""
+    available = available_memory()
+    return available // 2 if available else None
+
+
+def default_thread_counts() -> list[int]:
+    """All the CPU cores and half of them"""
+    cores = os.cpu_count() or 1
+    return sorted({cores, max(1, cores // 2)}, reverse=True)
+
+
+def image_bytes(image: Image.Image) -> int:
+    """Memory, in bytes, taken by decoded `image`"""
+    return image.width * image.height * len(image.getbands())
+
+
+def batch_memory(images: Sequence[Image.Image], bs: int, input_bytes: int) -> int:
+    """Estimates the memory, in bytes, needed to decode and predict a batch of `bs` images like `images`"""
+    mean_image_bytes = sum(map(image_bytes, images)) / len(images)
+    return int(bs * (mean_image_bytes + input_bytes * ACTIVATION_FACTOR))
+
+
+@dataclass
+class TuningResult:
+    """The fastest batch size and thread count found by `tune`
+
+    Attributes:
+        bs: The fastest batch size
+        threads: The fastest intra-op thread count, None when thread counts weren't tuned
+        images_per_second: Throughput of the fastest batch size and thread count
+        measurements: Images per second for each batch size and thread count benchmarked
+    """
+
+    bs: int
+    threads: int | None
+    images_per_second: float
+    measurements: dict[tuple[int, int | None], float] = field(default_factory=dict)
+
+
+def benchmark(session: InferenceSession, files: Sequence[Path], images: Sequence[Image.Image], bs: int) -> float:
+    """Images per second predicting the first `bs` of `images` as one batch"""
+    start = time.perf_counter()
+    session.predict_images(list(files[:bs]), list(images[:bs]), bs)
+    return bs / (time.perf_counter() - start)
+
+
+def tune(
+    session: InferenceSession,
+    files: Sequence[Path],
+    images: Sequence[Image.Image],
+    batch_sizes: Iterable[int] = DEFAULT_BATCH_SIZES,
+    thread_counts: Iterable[int | None] = (None,),
+    memory_limit: int | None = None,
+) -> TuningResult:
+    """Benchmarks `session` on decoded `images` to find the batch size and thread count with the best throughput
+
+    Batch sizes larger than the number of sample `images`, or estimated to need more than `memory_limit`
+    bytes, aren't tried. Thread counts other than None are applied with `torch.set_num_threads`, and the
+    fastest is left applied.
+    """
+    height, width = models.image_input_size(session.image_processor)
+    input_bytes = 3 * height * width * 4
+    candidates = [bs for bs in batch_sizes if bs <= len(images)] or [len(images)]
+    if memory_limit:
+        fitting = [bs for bs in candidates if batch_memory(images, bs, input_bytes) <= memory_limit]
+        if len(fitting) < len(candidates):
+            logger.info(
+                f"Skipping batch sizes {sorted(set(candidates) - set(fitting))} which may exceed the memory limit"
+            )
+        candidates = fitting or [min(candidates)]
+    measurements = {}
+    for threads in thread_counts:
+        if threads:
+            torch.set_num_threads(threads)
+        session.predict_images(list(files[:1]), list(images[:1]), 1)
+        for bs in candidates:
+            measurements[bs, threads] = benchmark(session, files, images, bs)
+            logger.debug(f"bs={bs} threads={threads}: {measurements[bs, threads]:.1f} images/s")
+    (bs, threads), images_per_second = max(measurements.items(), key=lambda measurement: measurement[1])
+    if threads:
+        torch.set_num_threads(threads)
+    return TuningResult(bs, threads, images_per_second, measurements)
+
+
+def tune_batch_size(
+    session: InferenceSession,
+    files: Iterable[Path],
+    memory_limit: int | None = None,
+    tune_threads: bool = True,
+    min_size: int | None = None,
+) -> tuple[int, Iterable[Path]]:
+    """Tunes the batch size, and thread count if `tune_threads`, for `session` on the first images in `files`
+
+    The sample is taken from the front of `files`, which may be a stream, and the batch size is returned
+    along with all of `files`. See `load_image` for `min_size`.
+    """
+    sample_size = max(DEFAULT_BATCH_SIZES)
+    if isinstance(files, Sized):
+        sample = list(itertools.islice(files, sample_size))
+    else:
+        files = iter(files)
+        sample = list(itertools.islice(files, sample_size))
+        files = itertools.chain(sample, files)
+    decoded = decode.decode_batch(sample, min_size)
+    if not decoded.images:
+        logger.warning(f"No readable images to tune the batch size on, using {DEFAULT_BATCH_SIZE}")
+        return DEFAULT_BATCH_SIZE, files
+    thread_counts = default_thread_counts() if tune_threads else [None]
+    result = tune(session, decoded.files, decoded.images, thread_counts=thread_counts, memory_limit=memory_limit)
+    threads = f" with intra-op threads set to {result.threads}" if result.threads else ""
+    logger.info(f"Chose batch size {result.bs}{threads}, {result.images_per_second:.1f} images/s")
+    return result.bs, files
@@ -0,0 +1,445 @@
+"""Persistent prediction cache."""
+
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+import numpy as np
+import typer
+from loguru import logger
+from toolz import itertoolz
+
+from flyswot.config import APP_NAME
+from flyswot.inference import MultiPredictionBatch, RankedPredictionItem
+
+DEFAULT_MAX_SIZE_MB: int = 1024
+DEFAULT_TENSOR_CACHE_MAX_SIZE_MB: int = 4096
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    model TEXT NOT NULL,
+    path TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    predictions TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (model, path)
+);
+CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used);
+"""
+
+TENSOR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS configs (
+    config TEXT PRIMARY KEY,
+    dtype TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    slots INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tensors (
+    config TEXT NOT NULL,
+    path TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (config, path),
+    UNIQUE (config, slot)
+);
+CREATE INDEX IF NOT EXISTS tensors_last_used ON tensors (last_used);
+"""
+
+
+def default_cache_path() -> Path:
+    """Location of the prediction cache inside the flyswot app directory"""
+    return Path(typer.get_app_dir(APP_NAME)) / "prediction_cache.sqlite"
+
+
+def default_tensor_cache_dir() -> Path:
+    """Location of the preprocessed image cache inside the flyswot app directory"""
+    return Path(typer.get_app_dir(APP_NAME)) / "tensor_cache"
+
+
+def file_fingerprint(path: Path, hash_contents: bool = False) -> str:
+    """Fingerprint for the contents of `path` from its size and mtime, or a hash of the file if `hash_contents`"""
+    stat = Path(path).stat()
+    if not hash_contents:
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return f"{stat.st_size}:{digest.hexdigest()}"
+
+
+def serialize_top_predictions(top_predictions: list[list[tuple[float, str]]]) -> str:
+    """Serializes the score and label pairs for each head of a prediction as json"""
+    return json.dumps(top_predictions)
+
+
+def deserialize_top_predictions(serialized: str) -> list[list[tuple[float, str]]]:
+    """Inverse of `serialize_top_predictions`"""
+    return [[(score, label) for score, label in pairs] for pairs in json.loads(serialized)]
+
+
+class PredictionCache:
+    """SQLite backed cache of predictions keyed by file path, file fingerprint and model
+
+    Attributes:
+        model_key: Identifies the model, revision and settings the cached predictions were made with
+        path: The SQLite database file
+        max_size_mb: The least recently used predictions are evicted when the cache grows beyond this size
+        hash_contents: Fingerprint files with a hash of their contents rather than their size and mtime
+    """
+
+    def __init__(
+        self,
+        model_key: str,
+        path: Path | None = None,
+        max_size_mb: int = DEFAULT_MAX_SIZE_MB,
+        hash_contents: bool = False,
+    ):
+        """Open, or create, the cache at `path` for predictions from `model_key`"""
+        self.model_key = model_key
+        self.path = Path(path) if path else default_cache_path()
+        self.max_size_mb = max_size_mb
+        self.hash_contents = hash_contents
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self._fingerprints: dict[Path, str] = {}
+
+    def __enter__(self) -> "PredictionCache":
+        """Use the cache as a context manager which closes it on exit"""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Close the cache"""
+        self.close()
+
+    def lookup(self, files: Iterable[Path]) -> tuple[list[RankedPredictionItem], list[Path]]:
+        """Returns cached predictions for the unchanged `files` and the files which still need predicting"""
+        hits: list[RankedPredictionItem] = []
+        misses: list[Path] = []
+        now = time.time()
+        for chunk in itertoolz.partition_all(500, files):
+            fingerprints = {}
+            for file in chunk:
+                try:
+                    fingerprints[file] = file_fingerprint(file, self.hash_contents)
+                except OSError:
+                    continue
+            placeholders = ", ".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT path, fingerprint, predictions FROM predictions WHERE model = ? AND path IN ({placeholders})",  # noqa: S608
+                [self.model_key, *map(str, chunk)],
+            )
+            cached = {path: (fingerprint, predictions) for path, fingerprint, predictions in rows}
+            used = []
+            for file in chunk:
+                fingerprint = fingerprints.get(file)
+                cached_fingerprint, predictions = cached.get(str(file), (None, None))
+                if fingerprint and fingerprint == cached_fingerprint:
+                    hits.append(RankedPredictionItem(file, deserialize_top_predictions(predictions)))
+                    used.append((now, self.model_key, str(file)))
+                    continue
+                misses.append(file)
+                if fingerprint:
+                    self._fingerprints[file] = fingerprint
+            self.connection.executemany("UPDATE predictions SET last_used = ? WHERE model = ? AND path = ?", used)
+        self.connection.commit()
+        return hits, misses
+
+    def add(self, predictions: MultiPredictionBatch) -> None:
+        """Adds a batch of `predictions` to the cache"""
+        now = time.time()
+        rows = []
+        for item in predictions.batch:
+            fingerprint = self._fingerprints.pop(item.path, None)
+            if fingerprint is None:
+                try:
+                    fingerprint = file_fingerprint(item.path, self.hash_contents)
+                except OSError:
+                    continue
+            serialized = serialize_top_predictions(item.top_predictions)
+            size = len(serialized) + len(str(item.path))
+            rows.append((self.model_key, str(item.path), fingerprint, serialized, size, now))
+        self.connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+    def size_bytes(self) -> int:
+        """Approximate size of the cached predictions"""
+        (size,) = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()
+        return size
+
+    def evict(self) -> int:
+        """Removes the least recently used predictions until the cache is within `max_size_mb`
+
+        Returns the number of predictions removed.
+        """
+        excess = self.size_bytes() - self.max_size_mb * 1024 * 1024
+        if excess <= 0:
+            return 0
+        to_remove = []
+        for rowid, size in self.connection.execute("SELECT rowid, size FROM predictions ORDER BY last_used"):
+            to_remove.append((rowid,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany("DELETE FROM predictions WHERE rowid = ?", to_remove)
+        self.connection.commit()
+        return len(to_remove)
+
+    def close(self) -> None:
+        """Evicts predictions beyond the size limit and closes the cache"""
+        self.evict()
+        self.connection.close()
+
+
+class TensorCache:
+    """Cache of preprocessed model inputs keyed by file path, file fingerprint and preprocessing config
+
+    Images preprocessed with the same config have inputs of the same shape, so the inputs for a config are
+    stored as the rows, or slots, of one array file which is memory mapped, with a SQLite index of the slot
+    each file's input is in. Models whose image processors share a config share the cached inputs.
+
+    The least recently used inputs, across all configs, are evicted when the cache grows beyond
+    `max_size_mb`. Evicted slots are reused by later inputs, and the array files are compacted when growing
+    one would take the array files of all the configs beyond `max_size_mb`.
+
+    Attributes:
+        config_key: Identifies the preprocessing config, see `models.preprocessing_key`
+        directory: The directory holding the index and the array file for each config
+        max_size_mb: The least recently used inputs are evicted when the cache grows beyond this size
+        hash_contents: Fingerprint files with a hash of their contents rather than their size and mtime
+    """
+
+    def __init__(
+        self,
+        config_key: str,
+        directory: Path | None = None,
+        max_size_mb: int = DEFAULT_TENSOR_CACHE_MAX_SIZE_MB,
+        hash_contents: bool = False,
+    ):
+        """Open, or create, the cache in `directory` for inputs preprocessed with `config_key`"""
+        self.config_key = config_key
+        self.directory = Path(directory) if directory else default_tensor_cache_dir()
+        self.max_size_mb = max_size_mb
+        self.hash_contents = hash_contents
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.directory / "index.sqlite")
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(TENSOR_SCHEMA)
+        self.data_path = self.directory / f"{config_key}.bin"
+        self._data: np.memmap | None = None
+        self._fingerprints: dict[Path, str] = {}
+
+    def __enter__(self) -> "TensorCache":
+        """Use the cache as a context manager which closes it on exit"""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Close the cache"""
+        self.close()
+
+    def _layout(self) -> tuple[np.dtype, tuple[int, ...], int] | None:
+        """The dtype and shape of the config's inputs and the number of slots in its array file"""
+        row = self.connection.execute(
+            "SELECT dtype, shape, slots FROM configs WHERE config = ?", (self.config_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        dtype, shape, slots = row
+        return np.dtype(dtype), tuple(json.loads(shape)), slots
+
+    def _map(self) -> np.memmap:
+        """Memory maps the config's array file, mapping it again if it has grown"""
+        layout = self._layout()
+        if layout is None:
+            raise ValueError(f"No inputs have been cached for {self.config_key}")
+        dtype, shape, slots = layout
+        if self._data is None or len(self._data) != slots:
+            self._data = np.memmap(self.data_path, dtype=dtype, mode="r+", shape=(slots, *shape))
+        return self._data
+
+    def lookup(self, files: Iterable[Path]) -> tuple[list[Path], np.ndarray | None, list[Path]]:
+        """Returns the unchanged `files` with cached inputs, their inputs, and the files which still need preprocessing
+
+        The inputs are read straight from the memory mapped array file, None when no files are cached.
+        """
+        hits: list[Path] = []
+        slots: list[int] = []
+        misses: list[Path] = []
+        now = time.time()
+        for chunk in itertoolz.partition_all(500, files):
+            fingerprints = {}
+            for file in chunk:
+                try:
+                    fingerprints[file] = file_fingerprint(file, self.hash_contents)
+                except OSError:
+                    continue
+            placeholders = ", ".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT path, fingerprint, slot FROM tensors WHERE config = ? AND path IN ({placeholders})",  # noqa: S608
+                [self.config_key, *map(str, chunk)],
+            )
+            cached = {path: (fingerprint, slot) for path, fingerprint, slot in rows}
+            used = []
+            for file in chunk:
+                fingerprint = fingerprints.get(file)
+                cached_fingerprint, slot = cached.get(str(file), (None, None))
+                if fingerprint and fingerprint == cached_fingerprint:
+                    hits.append(file)
+                    slots.append(slot)
+                    used.append((now, self.config_key, str(file)))
+                    continue
+                misses.append(file)
+                if fingerprint:
+                    self._fingerprints[file] = fingerprint
+            self.connection.executemany("UPDATE tensors SET last_used = ? WHERE config = ? AND path = ?", used)
+        self.connection.commit()
+        if not hits:
+            return hits, None, misses
+        return hits, np.asarray(self._map()[slots]), misses
+
+    def add(self, files: list[Path], inputs: np.ndarray) -> None:
+        """Adds the preprocessed `inputs` of `files` to the cache
+
+        Inputs whose dtype or shape differs from the inputs already cached for the config aren't cached.
+        """
+        inputs = np.asarray(inputs)
+        layout = self._layout()
+        if not len(inputs) or layout and layout[:2] != (inputs.dtype, inputs.shape[1:]):
+            logger.debug(f"Not caching inputs of shape {inputs.shape[1:]} and dtype {inputs.dtype}")
+            return
+        entry_bytes = inputs[0].nbytes
+        max_bytes = self.max_size_mb * 1024 * 1024
+        capacity = max_bytes // entry_bytes
+        rows = []
+        for index, file in enumerate(files):
+            fingerprint = self._fingerprints.pop(file, None)
+            if fingerprint is None:
+                try:
+                    fingerprint = file_fingerprint(file, self.hash_contents)
+                except OSError:
+                    continue
+            rows.append((index, str(file), fingerprint))
+        rows = rows[:capacity]
+        if not rows:
+            return
+        placeholders = ", ".join("?" * len(rows))
+        self.connection.execute(
+            f"DELETE FROM tensors WHERE config = ? AND path IN ({placeholders})",  # noqa: S608
+            [self.config_key, *(path for _, path, _ in rows)],
+        )
+        self.evict(len(rows) * entry_bytes)
+        if self.disk_bytes() + len(rows) * entry_bytes > max_bytes:
+            self.compact()
+        layout = self._layout()
+        slots = layout[2] if layout else 0
+        used = {
+            slot for (slot,) in self.connection.execute("SELECT slot FROM tensors WHERE config = ?", (self.config_key,))
+        }
+        free = [slot for slot in range(slots) if slot not in used][: len(rows)]
+        if len(free) < len(rows):
+            headroom = max(0, max_bytes - self.disk_bytes()) // entry_bytes
+            grown = max(slots + len(rows) - len(free), min(slots * 2, slots + headroom))
+            free.extend(range(slots, slots + len(rows) - len(free)))
+            with open(self.data_path, "ab") as f:
+                f.truncate(grown * entry_bytes)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO configs VALUES (?, ?, ?, ?)",
+                (self.config_key, inputs.dtype.str, json.dumps(inputs.shape[1:]), grown),
+            )
+            self.connection.commit()
+        data = self._map()
+        data[free] = inputs[[index for index, _, _ in rows]]
+        data.flush()
+        now = time.time()
+        self.connection.executemany(
+            "INSERT INTO tensors VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (self.config_key, path, fingerprint, slot, entry_bytes, now)
+                for (_, path, fingerprint), slot in zip(rows, free, strict=True)
+            ],
+        )
+        self.connection.commit()
+
+    def size_bytes(self) -> int:
+        """Size of the cached inputs"""
+        (size,) = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM tensors").fetchone()
+        return size
+
+    def disk_bytes(self) -> int:
+        """Size of the array files of all the configs, including their free slots"""
+        return sum(
+            slots * np.dtype(dtype).itemsize * math.prod(json.loads(shape))
+            for dtype, shape, slots in self.connection.execute("SELECT dtype, shape, slots FROM configs")
+        )
+
+    def compact(self) -> None:
+        """Shrinks the array file of each config to its cached inputs, moving inputs into the evicted slots"""
+        self._data = None
+        for config, dtype, shape, slots in self.connection.execute(
+            "SELECT config, dtype, shape, slots FROM configs"
+        ).fetchall():
+            used = [
+                slot
+                for (slot,) in self.connection.execute(
+                    "SELECT slot FROM tensors WHERE config = ? ORDER BY slot", (config,)
+                )
+            ]
+            if len(used) == slots:
+                continue
+            data_path = self.directory / f"{config}.bin"
+            if not used:
+                data_path.unlink(missing_ok=True)
+                self.connection.execute("DELETE FROM configs WHERE config = ?", (config,))
+                self.connection.commit()
+                continue
+            entry_bytes = np.dtype(dtype).itemsize * math.prod(json.loads(shape))
+            free = sorted(set(range(len(used))) - set(used))
+            moved = [slot for slot in used if slot >= len(used)]
+            with open(data_path, "r+b") as f:
+                for to_slot, from_slot in zip(free, moved, strict=True):
+                    f.seek(from_slot * entry_bytes)
+                    entry = f.read(entry_bytes)
+                    f.seek(to_slot * entry_bytes)
+                    f.write(entry)
+            # The moved inputs are copied before the index points at them and it's updated before the file is
+            # truncated, so an interrupted compaction leaves a consistent cache
+            self.connection.executemany(
+                "UPDATE tensors SET slot = ? WHERE config = ? AND slot = ?",
+                [(to_slot, config, from_slot) for to_slot, from_slot in zip(free, moved, strict=True)],
+            )
+            self.connection.execute("UPDATE configs SET slots = ? WHERE config = ?", (len(used), config))
+            self.connection.commit()
+            os.truncate(data_path, len(used) * entry_bytes)
+
+    def evict(self, reserve_bytes: int = 0) -> int:
+        """Removes the least recently used inputs until the cache, plus `reserve_bytes`, is within `max_size_mb`
+
+        Returns the number of inputs removed.
+        """
+        excess = self.size_bytes() + reserve_bytes - self.max_size_mb * 1024 * 1024
+        to_remove = []
+        if excess > 0:
+            for rowid, size in self.connection.execute("SELECT rowid, size FROM tensors ORDER BY last_used"):
+                to_remove.append((rowid,))
+                excess -= size
+                if excess <= 0:
+                    break
+        self.connection.executemany("DELETE FROM tensors WHERE rowid = ?", to_remove)
+        self.connection.commit()
+        return len(to_remove)
+
+    def close(self) -> None:
+        """Evicts inputs beyond the size limit and closes the cache"""
+        self.evict()
+        self._data = None
+        self.connection.close()
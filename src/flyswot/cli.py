@@ -2,12 +2,17 @@
 
 import typer
 
-from flyswot import cli_inference, models
+from flyswot import cli_inference, embed, models, serve, watch
 
 app = typer.Typer()
 
+cli_inference.app.command(name="watch")(watch.watch)
+cli_inference.app.command(name="embed")(embed.embed)
+cli_inference.app.command(name="classify-embeddings")(embed.classify_embeddings)
+
 app.add_typer(cli_inference.app, name="predict", help="flyswot commands for making predictions")
 app.add_typer(models.app, name="model", help="flyswot commands for interacting with models")
+app.command(name="serve")(serve.serve)
 
 typer_click_object = typer.main.get_command(app)
 
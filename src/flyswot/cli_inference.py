@@ -1,36 +1,56 @@
 """Inference functionality"""
 
 import csv
+import heapq
+import json
 import mimetypes
+import multiprocessing
+import os
 import re
 import string
 import time
-from collections import OrderedDict, defaultdict
-from collections.abc import Iterable
+from collections import Counter, defaultdict, deque
+from collections.abc import Callable, Iterable, Iterator, Sized
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
 from dataclasses import asdict
 from datetime import datetime, timedelta
+from enum import Enum
 from functools import singledispatch
+from operator import itemgetter
 from pathlib import Path
 
+import numpy as np
 import PIL
+import torch
 import typer
 from loguru import logger
+from PIL import Image
 from rich import print
 from rich.columns import Columns
 from rich.layout import Layout
 from rich.markdown import Markdown
 from rich.panel import Panel
-from rich.progress import Progress
+from rich.progress import Progress, TaskID
 from rich.table import Table
 from rich.text import Text
 from toolz import itertoolz
-from toolz.dicttoolz import merge
-from transformers import AutoImageProcessor, AutoModelForImageClassification, pipeline
+from transformers import AutoConfig, AutoImageProcessor, AutoModelForImageClassification
 
-from flyswot import core, models
+from flyswot import autotune, core, decode, models
+from flyswot.cache import DEFAULT_MAX_SIZE_MB, DEFAULT_TENSOR_CACHE_MAX_SIZE_MB, PredictionCache, TensorCache
 from flyswot.console import console
-from flyswot.inference import InferenceSession, MultiLabelImagePredictionItem, MultiPredictionBatch, PredictionBatch
+from flyswot.index import FileIndex
+from flyswot.inference import (
+    ArrayPredictionBatch,
+    InferenceSession,
+    MultiLabelImagePredictionItem,
+    MultiPredictionBatch,
+    PredictionBatch,
+    RankedPredictionItem,
+)
 from flyswot.logo import flyswot_logo
+from flyswot.models import Backend
 
 app = typer.Typer()
 
@@ -38,10 +58,49 @@ app = typer.Typer()
 image_extensions = {k for k, v in mimetypes.types_map.items() if v.startswith("image/")}
 
 
+class ReportFormat(str, Enum):
+    """File formats predictions can be reported in"""
+
+    csv = "csv"
+    parquet = "parquet"
+    arrow = "arrow"
+
+    @property
+    def suffix(self) -> str:
+        """File extension for reports in this format"""
+        return f".{self.value}"
+
+
 @app.command()
-def predict_image(image: Path = typer.Argument(..., readable=True, resolve_path=True)) -> None:
-    """Predict a single image"""
-    pass  # pragma: no cover
+def predict_image(
+    image: Path = typer.Argument(..., exists=True, dir_okay=False, readable=True, resolve_path=True),
+    model_id: str = typer.Option(
+        "flyswot/convnext-tiny-224_flyswot",
+        help="The model used when no server is running",
+    ),
+    server: str = typer.Option("http://127.0.0.1:8765", help="URL of a server started with `flyswot serve`"),
+    socket_path: Path = typer.Option(None, "--socket", help="Unix socket of a server started with `flyswot serve`"),
+) -> None:
+    """Predict a single image
+
+    Uses a server started with `flyswot serve` when one is running, otherwise loads MODEL_ID.
+    """
+    from flyswot import serve  # serve builds on this module
+
+    try:
+        prediction = serve.request_prediction(image, url=server, socket_path=socket_path)
+    except ConnectionError:
+        logger.info(f"No server running at {socket_path or server}, loading {model_id}")
+        session = create_inference_session(model_id)
+        prediction = serve.prediction_to_json(session.predict_batch([image], 1).batch[0])
+    except ValueError as exception:
+        print(exception)
+        raise typer.Exit(code=1) from exception
+    table = Table("label", "confidence", title=str(image))
+    for scores in prediction["predictions"]:
+        for score in scores:
+            table.add_row(score["label"], f"{score['score']:.4f}")
+    print(table)
 
 
 def check_files(files: list, pattern: str, directory: Path) -> None:
@@ -66,34 +125,414 @@ def try_predict_batch(batch, inference_session, bs):
         return batch, bad_batch
 
 
-def predict_files(files: list[Path], inference_session, bs, csv_fname) -> tuple[set, int]:
-    """Predict files"""
-    with Progress() as progress:
-        total_progress = progress.add_task("prediction progress", total=len(files))
+def predict_bisecting(
+    files: list[Path], images: list[Image.Image], inference_session, bs: int
+) -> tuple[list[MultiPredictionBatch], dict[Path, str]]:
+    """Predict `images`, recursively splitting a batch in half when it fails to isolate the bad images
+
+    Returns the predictions for the good images and a mapping of bad images to the error they raised.
+    A single bad image in a batch of n costs O(log n) extra forward passes and the good images stay batched.
+    """
+    try:
+        return [inference_session.predict_images(files, images, bs)], {}
+    except (PIL.UnidentifiedImageError, ValueError) as exception:
+        if len(files) == 1:
+            logger.warning(f"Unable to predict {files[0]} because of {exception!r}")
+            return [], {Path(files[0]): repr(exception)}
+    middle = len(files) // 2
+    left_predictions, left_corrupt = predict_bisecting(files[:middle], images[:middle], inference_session, bs)
+    right_predictions, right_corrupt = predict_bisecting(files[middle:], images[middle:], inference_session, bs)
+    return left_predictions + right_predictions, left_corrupt | right_corrupt
+
+
+def predict_files(
+    files: Iterable[Path],
+    inference_session: InferenceSession,
+    bs,
+    csv_fname,
+    decode_workers: int = 4,
+    prefetch: int = 2,
+    decode_processes: bool = False,
+    reduced_decode: bool = True,
+    cache: PredictionCache | None = None,
+    append: bool = False,
+    report_format: ReportFormat = ReportFormat.csv,
+    label_counts: "LabelCounts | None" = None,
+    max_batch_bytes: int | None = None,
+) -> tuple[dict[Path, str], int]:
+    """Predict files, decoding upcoming batches in `decode_workers` workers whilst the model runs
+
+    When `reduced_decode` images are decoded at the smallest resolution the session's model can use. Files
+    with predictions in `cache` are written to the report without being decoded. When `append` predictions
+    are added to the existing report at `csv_fname` rather than starting a new one. The report is written in
+    `report_format` and the predicted labels are counted in `label_counts` as they are written. `files` can be a stream
+    of files which are still being found, prediction starts straight away with the progress bar showing
+    how many files have been found so far. Batches of large images are made smaller to keep each decoded batch
+    within `max_batch_bytes`.
+    Returns a mapping of corrupt images to the reason they couldn't be predicted and the number of images checked.
+    """
+    with (
+        Progress() as progress,
+        create_report_writer(csv_fname, report_format, append, inference_session.labels) as report,
+    ):
+        total_progress = progress.add_task(
+            "prediction progress", total=len(files) if isinstance(files, Sized) else None
+        )
+        corrupt_images: dict[Path, str] = {}
         images_checked = 0
-        bad_batch_files = []
-        for i, batch in enumerate(itertoolz.partition_all(bs, files)):
-            batch_predictions, bad_batch = try_predict_batch(batch, inference_session, bs)
-            if bad_batch:
-                bad_batch_files.append(batch)
-            if i == 0 and not bad_batch:
-                create_csv_header(batch_predictions, csv_fname)
-            if not bad_batch:
-                write_batch_preds_to_csv(batch_predictions, csv_fname)
-            progress.update(total_progress, advance=len(batch))
-            images_checked += len(batch)
-        corrupt_images = set()
-        if bad_batch_files:
-            for batch in bad_batch_files:
-                for file in batch:
-                    try:
-                        batch_predictions = inference_session.predict_batch([file], bs)
-                        write_batch_preds_to_csv(batch_predictions, csv_fname)
-                    except PIL.UnidentifiedImageError:
-                        corrupt_images.add(file)
+
+        def write(batch_predictions: list[MultiPredictionBatch], checked: int, cache=None) -> None:
+            nonlocal images_checked
+            write_predictions(batch_predictions, report, cache, label_counts)
+            progress.update(total_progress, advance=checked)
+            images_checked += checked
+
+        files = track_discovered_files(files, progress, total_progress)
+        decoded_batches = decode.prefetch_decoded_batches(
+            skip_preprocessed_files(
+                skip_cached_files(files, cache, bs, write),
+                inference_session,
+                bs,
+                lambda batch_predictions, checked: write(batch_predictions, checked, cache),
+            ),
+            bs,
+            workers=decode_workers,
+            prefetch=prefetch,
+            use_processes=decode_processes,
+            min_size=inference_session.decode_size if reduced_decode else None,
+            max_batch_bytes=max_batch_bytes,
+        )
+        for decoded in decoded_batches:
+            corrupt_images.update(decoded.failed)
+            batch_predictions = []
+            if decoded.files:
+                batch_predictions, corrupt = predict_bisecting(decoded.files, decoded.images, inference_session, bs)
+                corrupt_images.update(corrupt)
+            write(batch_predictions, len(decoded.files) + len(decoded.failed), cache)
         return corrupt_images, images_checked
 
 
+def track_discovered_files(files: Iterable[Path], progress: Progress, task: TaskID) -> Iterable[Path]:
+    """Shows how many of a stream of `files` have been found so far on `task`, setting its total once all are found"""
+    if isinstance(files, Sized):
+        return files
+    return _track_discovered_files(files, progress, task)
+
+
+def _track_discovered_files(files: Iterable[Path], progress: Progress, task: TaskID) -> Iterator[Path]:
+    found = 0
+    for found, file in enumerate(files, start=1):
+        progress.update(task, description=f"prediction progress ({found} found so far, still searching)")
+        yield file
+    progress.update(task, total=found, description="prediction progress")
+
+
+def write_predictions(
+    batch_predictions: list[MultiPredictionBatch],
+    report: "CsvReportWriter | ArrowReportWriter",
+    cache: PredictionCache | None = None,
+    label_counts: "LabelCounts | None" = None,
+) -> None:
+    """Writes `batch_predictions` to `report`, flushing it once they've all been written
+
+    The predictions are also added to `cache` and counted in `label_counts` if passed.
+    """
+    for predictions in batch_predictions:
+        report.write(predictions)
+        if cache:
+            cache.add(predictions)
+        if label_counts is not None:
+            label_counts.add(predictions)
+    report.flush()
+
+
+def skip_cached_files(
+    files: Iterable[Path],
+    cache: PredictionCache | None,
+    bs: int,
+    write: Callable[[list[MultiPredictionBatch], int], None],
+) -> Iterable[Path]:
+    """Passes the predictions `cache` holds for `files` to `write`, yielding the files which still need predicting
+
+    Files are looked up `bs` at a time so a stream of files is consumed as it is found.
+    """
+    if not cache:
+        return files
+    return _skip_cached_files(files, cache, bs, write)
+
+
+def _skip_cached_files(
+    files: Iterable[Path],
+    cache: PredictionCache,
+    bs: int,
+    write: Callable[[list[MultiPredictionBatch], int], None],
+) -> Iterator[Path]:
+    n_cached = 0
+    for chunk in itertoolz.partition_all(bs, files):
+        cached, misses = cache.lookup(chunk)
+        if cached:
+            write([MultiPredictionBatch(cached)], len(cached))
+            n_cached += len(cached)
+        yield from misses
+    if n_cached:
+        logger.info(f"Used cached predictions for {n_cached} unchanged files")
+
+
+def skip_preprocessed_files(
+    files: Iterable[Path],
+    inference_session,
+    bs: int,
+    write: Callable[[list[MultiPredictionBatch], int], None],
+) -> Iterable[Path]:
+    """Predicts `files` whose inputs are in the session's `tensor_cache` and passes them to `write`
+
+    Yields the files which still need decoding. Files are looked up `bs` at a time so a stream of files is
+    consumed as it is found.
+    """
+    if inference_session.tensor_cache is None:
+        return files
+    return _skip_preprocessed_files(files, inference_session, bs, write)
+
+
+def _skip_preprocessed_files(
+    files: Iterable[Path],
+    inference_session,
+    bs: int,
+    write: Callable[[list[MultiPredictionBatch], int], None],
+) -> Iterator[Path]:
+    n_cached = 0
+    for chunk in itertoolz.partition_all(bs, files):
+        cached, inputs, misses = inference_session.tensor_cache.lookup(chunk)
+        if cached:
+            write([inference_session.predict_preprocessed(cached, inputs, bs)], len(cached))
+            n_cached += len(cached)
+        yield from misses
+    if n_cached:
+        logger.info(f"Used cached preprocessed inputs for {n_cached} unchanged files")
+
+
+_worker_session: InferenceSession | None = None
+
+
+def _init_inference_worker(model_id: str, threads: int, session_options: dict) -> None:
+    """Loads the model once for an inference worker process and sets its intra-op thread budget"""
+    global _worker_session
+    torch.set_num_threads(threads)
+    _worker_session = create_inference_session(model_id, threads=threads, **session_options)
+
+
+def _predict_shard(
+    files: tuple[Path, ...], bs: int, reduced_decode: bool
+) -> tuple[list[MultiPredictionBatch], dict[Path, str]]:
+    """Decodes and predicts a shard of `files` inside an inference worker process"""
+    session = _worker_session
+    if session is None:
+        raise RuntimeError("The inference worker's model hasn't been loaded")
+    decoded = decode.decode_batch(files, session.decode_size if reduced_decode else None)
+    if not decoded.files:
+        return [], decoded.failed
+    batch_predictions, corrupt = predict_bisecting(decoded.files, decoded.images, session, bs)
+    return batch_predictions, decoded.failed | corrupt
+
+
+def predict_files_sharded(
+    files: Iterable[Path],
+    model_id: str,
+    bs: int,
+    csv_fname: Path,
+    workers: int,
+    threads_per_worker: int | None = None,
+    reduced_decode: bool = True,
+    cache: PredictionCache | None = None,
+    append: bool = False,
+    report_format: ReportFormat = ReportFormat.csv,
+    label_counts: "LabelCounts | None" = None,
+    **session_options,
+) -> tuple[dict[Path, str], int]:
+    """Predict files across `workers` inference processes which each load the model once
+
+    Files are split into shards of `bs` which are handed out to the workers, with at most two shards per
+    worker in flight so a stream of files is consumed as it is found. Each worker gets `threads_per_worker`
+    intra-op threads, by default an even share of the CPU cores. `session_options` are passed on to
+    `create_inference_session`. Predictions are written to `csv_fname` in the same order as `files`,
+    appending to an existing report if `append`, with predictions from `cache` written as they are found.
+    The report is written in `report_format` and the predicted labels are counted in `label_counts`.
+    """
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    labels = models.model_labels(model_id) if report_format != ReportFormat.csv else None
+    with Progress() as progress, create_report_writer(csv_fname, report_format, append, labels) as report:
+        total_progress = progress.add_task(
+            "prediction progress", total=len(files) if isinstance(files, Sized) else None
+        )
+        corrupt_images: dict[Path, str] = {}
+        images_checked = 0
+
+        def write(batch_predictions: list[MultiPredictionBatch], checked: int, cache=None) -> None:
+            nonlocal images_checked
+            write_predictions(batch_predictions, report, cache, label_counts)
+            progress.update(total_progress, advance=checked)
+            images_checked += checked
+
+        def write_shard(shard: tuple[Path, ...], result: Future) -> None:
+            batch_predictions, corrupt = result.result()
+            corrupt_images.update(corrupt)
+            write(batch_predictions, len(shard), cache)
+
+        files = skip_cached_files(track_discovered_files(files, progress, total_progress), cache, bs, write)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_inference_worker,
+            initargs=(model_id, threads, session_options),
+        ) as executor:
+            pending: deque[tuple[tuple[Path, ...], Future]] = deque()
+            for shard in itertoolz.partition_all(bs, files):
+                pending.append((shard, executor.submit(_predict_shard, shard, bs, reduced_decode)))
+                if len(pending) >= 2 * workers:
+                    write_shard(*pending.popleft())
+            while pending:
+                write_shard(*pending.popleft())
+        return corrupt_images, images_checked
+
+
+def prediction_cache_key(
+    model_id: str, backend: Backend, quantization: models.Quantization | None, reduced_decode: bool
+) -> str:
+    """Key identifying predictions made by `model_id` at its current revision with the given settings"""
+    precision = models.Quantization(quantization).value + "-int8" if quantization else "fp32"
+    decode_mode = "reduced" if reduced_decode else "full"
+    return f"{model_id}@{models.model_revision(model_id)}:{Backend(backend).value}:{precision}:{decode_mode}-decode"
+
+
+def create_tensor_cache(
+    inference_session: "HuggingFaceInferenceSession", reduced_decode: bool, max_size_mb: int, hash_contents: bool
+) -> TensorCache:
+    """Opens the cache of inputs preprocessed the way `inference_session` preprocesses images"""
+    min_size = inference_session.decode_size if reduced_decode else None
+    config_key = models.preprocessing_key(inference_session.image_processor, min_size)
+    return TensorCache(config_key, max_size_mb=max_size_mb, hash_contents=hash_contents)
+
+
+def create_corrupt_images_fname(csv_fname: Path) -> Path:
+    """Creates the filename for the corrupt images report which accompanies `csv_fname`"""
+    return csv_fname.with_name(f"{csv_fname.stem}_corrupt_images.csv")
+
+
+def write_corrupt_images_csv(corrupt_images: dict[Path, str], csv_fname: Path) -> Path:
+    """Writes `corrupt_images` and the reason they couldn't be predicted to a csv alongside `csv_fname`"""
+    corrupt_fname = create_corrupt_images_fname(csv_fname)
+    with open(corrupt_fname, mode="w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=["path", "directory", "error"])
+        writer.writeheader()
+        for path, error in sorted(corrupt_images.items()):
+            writer.writerow({"path": path, "directory": path.parent, "error": error})
+    return corrupt_fname
+
+
+def read_corrupt_images_csv(csv_fname: Path) -> dict[Path, str]:
+    """Reads the corrupt images report which accompanies `csv_fname`, if there is one"""
+    corrupt_fname = create_corrupt_images_fname(csv_fname)
+    if not corrupt_fname.exists():
+        return {}
+    with open(corrupt_fname, newline="", encoding="utf-8") as csv_file:
+        return {Path(row["path"]): row["error"] for row in csv.DictReader(csv_file)}
+
+
+def read_report_paths(csv_fname: Path) -> set[str]:
+    """Reads the paths of the images already written to the csv report `csv_fname`"""
+    with open(csv_fname, newline="", encoding="utf-8") as csv_file:
+        return {row["path"] for row in csv.DictReader(csv_file) if row.get("path")}
+
+
+def truncate_partial_row(csv_fname: Path, chunk_size: int = 4096) -> None:
+    """Truncates a row left half written at the end of `csv_fname` by an interrupted run"""
+    with open(csv_fname, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - chunk_size)
+            f.seek(start)
+            chunk = f.read(position - start)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                last_row_end = start + newline + 1
+                break
+            position = start
+        else:
+            last_row_end = 0
+        if last_row_end != end:
+            logger.warning(f"Removing a partially written row from the end of {csv_fname}")
+            f.truncate(last_row_end)
+
+
+# Options shared by the predict commands
+CSV_SAVE_DIR_ARGUMENT = typer.Argument(
+    ...,
+    writable=True,
+    resolve_path=True,
+    help="Directory used to store the csv report",
+)
+MODEL_ID_OPTION = typer.Option(
+    "flyswot/convnext-tiny-224_flyswot",
+    help="The model flyswot should use for making predictions",
+)
+PATTERN_OPTION = typer.Option(None, help="Pattern used to filter image filenames")
+IMAGE_FORMATS_OPTION = typer.Option(
+    default=[".tif"],
+    help="Image format(s) to check",
+)
+BS_OPTION = typer.Option(
+    "16", help="Batch Size, or auto to benchmark a few batch sizes and thread counts on the first images"
+)
+FIXED_BS_OPTION = typer.Option(16, help="Batch Size")
+DECODE_WORKERS_OPTION = typer.Option(
+    4, help="Number of workers decoding images ahead of the model, 0 decodes images on the main thread"
+)
+PREFETCH_OPTION = typer.Option(2, help="Number of batches to decode ahead of the model")
+WALK_WORKERS_OPTION = typer.Option(
+    8, help="Number of directories listed concurrently whilst searching for images, 1 searches serially"
+)
+DECODE_PROCESSES_OPTION = typer.Option(False, help="Decode images in worker processes instead of threads")
+WORKERS_OPTION = typer.Option(1, help="Number of inference processes, each loading its own copy of the model")
+THREADS_PER_WORKER_OPTION = typer.Option(
+    None, help="Intra-op threads for each inference process, defaults to an even share of the CPU cores"
+)
+BACKEND_OPTION = typer.Option(Backend.pytorch, help="Runtime used to run the model")
+QUANTIZE_OPTION = typer.Option(None, help="Run a dynamically quantized int8 version of the model")
+REDUCED_DECODE_OPTION = typer.Option(
+    True, help="Decode images at the smallest resolution the model can use rather than at full resolution"
+)
+USE_CACHE_OPTION = typer.Option(
+    False,
+    "--cache/--no-cache",
+    help="Reuse cached predictions for files which haven't changed since a previous run",
+)
+CACHE_MAX_MB_OPTION = typer.Option(DEFAULT_MAX_SIZE_MB, help="Size the prediction cache is trimmed to")
+CACHE_HASH_OPTION = typer.Option(
+    False, help="Detect changed files by hashing their contents rather than by their size and modification time"
+)
+USE_TENSOR_CACHE_OPTION = typer.Option(
+    False,
+    "--tensor-cache/--no-tensor-cache",
+    help="Cache each image's preprocessed model input so later runs, including runs of other models with the "
+    "same image processor config, skip decoding and resizing unchanged images",
+)
+TENSOR_CACHE_MAX_MB_OPTION = typer.Option(
+    DEFAULT_TENSOR_CACHE_MAX_SIZE_MB, help="Size the preprocessed input cache is trimmed to"
+)
+REPORT_FORMAT_OPTION = typer.Option(
+    ReportFormat.csv,
+    "--format",
+    help="Report format, parquet and arrow reports also store every label's score and need pyarrow",
+)
+MAX_MEMORY_MB_OPTION = typer.Option(
+    None,
+    help="Memory ceiling for decoded batches and --bs auto, batches of large images are made smaller to fit. "
+    "Defaults to half the available memory with --bs auto",
+)
+DIRECTORY_SUMMARY_OPTION = typer.Option(False, help="Also summarise the labels predicted in each directory")
+
+
 @app.command(name="directory")
 def predict_directory(
     directory: Path = typer.Argument(
@@ -102,46 +541,173 @@ def predict_directory(
         resolve_path=True,
         help="Directory to start searching for images from",
     ),
-    csv_save_dir: Path = typer.Argument(
-        ...,
-        writable=True,
+    csv_save_dir: Path = CSV_SAVE_DIR_ARGUMENT,
+    model_id: str = MODEL_ID_OPTION,
+    pattern: str = PATTERN_OPTION,
+    bs: str = BS_OPTION,
+    image_formats: list[str] = IMAGE_FORMATS_OPTION,
+    decode_workers: int = DECODE_WORKERS_OPTION,
+    prefetch: int = PREFETCH_OPTION,
+    decode_processes: bool = DECODE_PROCESSES_OPTION,
+    workers: int = WORKERS_OPTION,
+    threads_per_worker: int = THREADS_PER_WORKER_OPTION,
+    backend: Backend = BACKEND_OPTION,
+    reduced_decode: bool = REDUCED_DECODE_OPTION,
+    quantize: models.Quantization = typer.Option(
+        None,
+        help="Run an int8 version of the model. Static quantization needs the onnx backend and is calibrated on a sample of the images found",
+    ),
+    use_cache: bool = USE_CACHE_OPTION,
+    cache_max_mb: int = CACHE_MAX_MB_OPTION,
+    cache_hash: bool = CACHE_HASH_OPTION,
+    use_tensor_cache: bool = USE_TENSOR_CACHE_OPTION,
+    tensor_cache_max_mb: int = TENSOR_CACHE_MAX_MB_OPTION,
+    report_format: ReportFormat = REPORT_FORMAT_OPTION,
+    max_memory_mb: int = MAX_MEMORY_MB_OPTION,
+    directory_summary: bool = DIRECTORY_SUMMARY_OPTION,
+    resume: Path = typer.Option(
+        None,
+        exists=True,
+        dir_okay=False,
         resolve_path=True,
-        help="Directory used to store the csv report",
+        help="Resume an interrupted run by appending to its csv report, skipping images it already checked",
     ),
-    model_id: str = typer.Option(
-        "flyswot/convnext-tiny-224_flyswot",
-        help="The model flyswot should use for making predictions",
+    walk_workers: int = WALK_WORKERS_OPTION,
+    use_index: bool = typer.Option(
+        False,
+        "--index/--no-index",
+        help="Keep an index of the directory tree so later searches only list directories which have changed",
+    ),
+    changed_only: bool = typer.Option(
+        False,
+        help="Only predict images which are new or changed since the directory was last indexed. The index is only "
+        "updated once the run finishes, so images from a failed run are predicted again",
+    ),
+    full_rescan: bool = typer.Option(
+        False,
+        help="Re-list every directory rather than reusing the index for unchanged ones, finds images modified in place",
     ),
-    pattern: str = typer.Option(None, help="Pattern used to filter image filenames"),
-    bs: int = typer.Option(16, help="Batch Size"),
-    image_formats: list[str] = typer.Option(
-        default=[".tif"],
-        help="Image format(s) to check",
+    stream: bool = typer.Option(
+        False,
+        help="Start predicting images as they are found rather than once the search finishes, images aren't sorted",
+    ),
+    exclude_dir: list[str] = typer.Option(
+        [], help="Glob pattern(s) for names of directories which aren't searched, e.g. '.thumbnails' or '*backup*'"
+    ),
+    max_depth: int = typer.Option(None, help="Number of directory levels below DIRECTORY to search"),
+    skip_hidden: bool = typer.Option(False, help="Skip files and directories whose names start with a dot"),
+    prefer_ext: str = typer.Option(
+        None,
+        help="Comma separated extensions in order of preference, e.g. '.jpg,.tif'. Images sharing a name in the same "
+        "directory are only predicted once, using the most preferred extension. These extensions are added to the "
+        "image formats searched",
     ),
 ):
     """Predicts against all images stored under DIRECTORY which match PATTERN in the filename.
 
     By default searches for filenames containing 'fs'.
 
-    Creates a CSV report saved to `csv_save_dir`
+    Creates a CSV report, or a Parquet or Arrow IPC report, saved to `csv_save_dir`
     """
     start_time = time.perf_counter()
-    huggingfaceinference = HuggingFaceInferenceSession(model=model_id)
-    files = sorted(
-        itertoolz.concat(
-            core.get_image_files_from_pattern(directory, pattern, image_format) for image_format in image_formats
+    batch_size, memory_limit = resolve_batch_size(bs, workers, max_memory_mb)
+    if use_tensor_cache and (workers > 1 or backend != Backend.pytorch):
+        raise typer.BadParameter("--tensor-cache needs --backend pytorch and a single inference process")
+    if changed_only and not use_index:
+        raise typer.BadParameter("--changed-only needs --index")
+    if full_rescan and not use_index:
+        raise typer.BadParameter("--full-rescan needs --index")
+    if quantize == models.Quantization.static and backend != Backend.onnx:
+        raise typer.BadParameter("Static quantization is only supported with --backend onnx")
+    preferred_exts = core.parse_extensions(prefer_ext) if prefer_ext else []
+    if preferred_exts and stream:
+        raise typer.BadParameter("--prefer-ext needs every image to be found first, so can't be used with --stream")
+    image_formats = list(dict.fromkeys([*image_formats, *preferred_exts]))
+    if quantize == models.Quantization.static and stream:
+        raise typer.BadParameter(
+            "Static quantization is calibrated on the images found, so can't be used with --stream"
         )
-    )
-    check_files(files, pattern, directory)
+    if resume and (report_format != ReportFormat.csv or resume.suffix != ReportFormat.csv.suffix):
+        raise typer.BadParameter(f"Only {ReportFormat.csv.value} reports can be resumed", param_hint="--resume")
+    label_counts = LabelCounts(per_directory=directory_summary)
+    with ExitStack() as stack:
+        file_index = stack.enter_context(FileIndex()) if use_index else None
+        search = core.iter_image_files if stream else core.get_image_files_from_pattern
+        found = search(
+            directory,
+            pattern,
+            set(image_formats),
+            walk_workers=walk_workers,
+            index=file_index,
+            changed_only=changed_only,
+            directory_filter=core.DirectoryFilter(tuple(exclude_dir), max_depth, skip_hidden),
+            full_rescan=full_rescan,
+        )
+        if stream:
+            files = found
+            print(f"Predicting images in {directory} with extension(s) {image_formats} as they are found")
+        else:
+            files = sorted(found)
+            if preferred_exts:
+                files = sorted(core.filter_to_preferred_ext_by(files, preferred_exts, core.same_directory_stem))
+            if changed_only and not files:
+                print(f"No new or changed images in {directory} since it was last indexed")
+                raise typer.Exit()
+            check_files(files, pattern, directory)
+            print(
+                f"Found {len(files)} files matching {pattern or 'any pattern'} in {directory} "
+                f"with extension(s) {image_formats}"
+            )
+        previously_corrupt: dict[Path, str] = {}
+        append = False
+        if resume:
+            csv_fname = resume
+            truncate_partial_row(csv_fname)
+            append = csv_fname.stat().st_size > 0
+            previously_corrupt = read_corrupt_images_csv(csv_fname)
+            label_counts.add_csv_report(csv_fname)
+            checked = read_report_paths(csv_fname) | {str(path) for path in previously_corrupt}
+            files = (file for file in files if str(file) not in checked)
+            print(f"Resuming {csv_fname}, {len(checked)} images were already checked")
+            if not stream:
+                files = list(files)
+        else:
+            csv_fname = create_report_fname(csv_save_dir, report_format)
+        if backend == Backend.onnx:
+            export_dir = models.ensure_onnx_export(model_id)
+            if quantize:
+                models.quantize_onnx(export_dir, quantize, calibration_files=models.sample_files(files, 64))
+        corrupt_images, images_checked = run_predictions(
+            files,
+            csv_fname,
+            model_id=model_id,
+            batch_size=batch_size,
+            memory_limit=memory_limit,
+            label_counts=label_counts,
+            backend=backend,
+            quantize=quantize,
+            workers=workers,
+            threads_per_worker=threads_per_worker,
+            decode_workers=decode_workers,
+            prefetch=prefetch,
+            decode_processes=decode_processes,
+            reduced_decode=reduced_decode,
+            use_cache=use_cache,
+            cache_max_mb=cache_max_mb,
+            cache_hash=cache_hash,
+            use_tensor_cache=use_tensor_cache,
+            tensor_cache_max_mb=tensor_cache_max_mb,
+            report_format=report_format,
+            append=append,
+        )
+    if stream and not images_checked and not resume:
+        if changed_only:
+            print(f"No new or changed images in {directory} since it was last indexed")
+            raise typer.Exit()
+        check_files([], pattern, directory)
     if not pattern:
         pattern = "any pattern"
-    print(f"Found {len(files)} files matching {pattern} in {directory} with extension(s) {image_formats}")
-    csv_fname = create_csv_fname(csv_save_dir)
-    corrupt_images, images_checked = predict_files(
-        files, inference_session=huggingfaceinference, bs=bs, csv_fname=csv_fname
-    )
-    if corrupt_images:
-        print(corrupt_images)
+    report_corrupt_images(previously_corrupt | corrupt_images, csv_fname)
     delta = timedelta(seconds=time.perf_counter() - start_time)
     print_inference_summary(
         str(delta),
@@ -151,19 +717,229 @@ def predict_directory(
         image_formats,
         images_checked,
         model_id,
+        label_counts=label_counts,
+    )
+
+
+def resolve_batch_size(bs: str | int, workers: int, max_memory_mb: int | None) -> tuple[int | None, int | None]:
+    """Parses the `--bs` option, returning None when it should be tuned, and the memory ceiling in bytes"""
+    try:
+        batch_size = autotune.parse_batch_size(bs)
+    except ValueError as exception:
+        raise typer.BadParameter(str(exception), param_hint="--bs") from exception
+    if batch_size is None and workers > 1:
+        raise typer.BadParameter(
+            "auto tunes a single inference process so can't be used with --workers", param_hint="--bs"
+        )
+    if max_memory_mb:
+        return batch_size, max_memory_mb * 2**20
+    return batch_size, autotune.default_memory_limit() if batch_size is None else None
+
+
+def run_predictions(
+    files: Iterable[Path],
+    csv_fname: Path,
+    model_id: str,
+    batch_size: int | None,
+    memory_limit: int | None,
+    label_counts: "LabelCounts",
+    backend: Backend = Backend.pytorch,
+    quantize: models.Quantization | None = None,
+    workers: int = 1,
+    threads_per_worker: int | None = None,
+    decode_workers: int = 4,
+    prefetch: int = 2,
+    decode_processes: bool = False,
+    reduced_decode: bool = True,
+    use_cache: bool = False,
+    cache_max_mb: int = DEFAULT_MAX_SIZE_MB,
+    cache_hash: bool = False,
+    use_tensor_cache: bool = False,
+    tensor_cache_max_mb: int = DEFAULT_TENSOR_CACHE_MAX_SIZE_MB,
+    report_format: ReportFormat = ReportFormat.csv,
+    append: bool = False,
+) -> tuple[dict[Path, str], int]:
+    """Predicts `files` for the predict commands, returning the corrupt images and number of images checked
+
+    Uses `workers` inference processes when there is more than one, otherwise predicts in this process, tuning
+    the batch size on the first images when `batch_size` is None. The options match the predict commands'.
+    """
+    with ExitStack() as stack:
+        cache = None
+        if use_cache:
+            cache_key = prediction_cache_key(model_id, backend, quantize, reduced_decode)
+            cache = stack.enter_context(PredictionCache(cache_key, max_size_mb=cache_max_mb, hash_contents=cache_hash))
+        if workers > 1:
+            if batch_size is None:
+                raise ValueError("The batch size can only be tuned for a single inference process")
+            return predict_files_sharded(
+                files,
+                model_id=model_id,
+                bs=batch_size,
+                csv_fname=csv_fname,
+                workers=workers,
+                threads_per_worker=threads_per_worker,
+                reduced_decode=reduced_decode,
+                cache=cache,
+                append=append,
+                report_format=report_format,
+                label_counts=label_counts,
+                backend=backend,
+                quantization=quantize,
+            )
+        inference_session = create_inference_session(model_id, backend, quantization=quantize)
+        if batch_size is None:
+            batch_size, files = autotune.tune_batch_size(
+                inference_session,
+                files,
+                memory_limit,
+                tune_threads=backend == Backend.pytorch,
+                min_size=inference_session.decode_size if reduced_decode else None,
+            )
+            print(f"Using batch size {batch_size}")
+        if use_tensor_cache and isinstance(inference_session, HuggingFaceInferenceSession):
+            inference_session.tensor_cache = stack.enter_context(
+                create_tensor_cache(inference_session, reduced_decode, tensor_cache_max_mb, cache_hash)
+            )
+        return predict_files(
+            files,
+            inference_session=inference_session,
+            bs=batch_size,
+            csv_fname=csv_fname,
+            decode_workers=decode_workers,
+            prefetch=prefetch,
+            decode_processes=decode_processes,
+            reduced_decode=reduced_decode,
+            cache=cache,
+            append=append,
+            report_format=report_format,
+            label_counts=label_counts,
+            max_batch_bytes=memory_limit // (prefetch + 1) if memory_limit else None,
+        )
+
+
+@app.command(name="manifest")
+def predict_manifest(
+    manifest: typer.FileText = typer.Argument(
+        ...,
+        help="File listing the images to predict, one path per line or a csv file, use - to read from stdin",
+    ),
+    csv_save_dir: Path = CSV_SAVE_DIR_ARGUMENT,
+    column: str = typer.Option(
+        None, help="Read the image paths from this column of a csv manifest, defaults to 'path' for .csv files"
+    ),
+    base_dir: Path = typer.Option(
+        None, help="Directory relative paths in the manifest are relative to, defaults to the current directory"
+    ),
+    model_id: str = MODEL_ID_OPTION,
+    bs: str = BS_OPTION,
+    decode_workers: int = DECODE_WORKERS_OPTION,
+    prefetch: int = PREFETCH_OPTION,
+    decode_processes: bool = DECODE_PROCESSES_OPTION,
+    workers: int = WORKERS_OPTION,
+    threads_per_worker: int = THREADS_PER_WORKER_OPTION,
+    backend: Backend = BACKEND_OPTION,
+    reduced_decode: bool = REDUCED_DECODE_OPTION,
+    quantize: models.Quantization = QUANTIZE_OPTION,
+    use_cache: bool = USE_CACHE_OPTION,
+    cache_max_mb: int = CACHE_MAX_MB_OPTION,
+    cache_hash: bool = CACHE_HASH_OPTION,
+    use_tensor_cache: bool = USE_TENSOR_CACHE_OPTION,
+    tensor_cache_max_mb: int = TENSOR_CACHE_MAX_MB_OPTION,
+    report_format: ReportFormat = REPORT_FORMAT_OPTION,
+    max_memory_mb: int = MAX_MEMORY_MB_OPTION,
+    directory_summary: bool = DIRECTORY_SUMMARY_OPTION,
+):
+    """Predicts the images listed in MANIFEST without searching for them.
+
+    Paths are read lazily and streamed into inference, so a manifest produced by another tool, e.g. `find`,
+    can be piped in on stdin. Missing or unreadable files are reported as corrupt images.
+    """
+    start_time = time.perf_counter()
+    batch_size, memory_limit = resolve_batch_size(bs, workers, max_memory_mb)
+    if use_tensor_cache and (workers > 1 or backend != Backend.pytorch):
+        raise typer.BadParameter("--tensor-cache needs --backend pytorch and a single inference process")
+    if quantize == models.Quantization.static:
+        raise typer.BadParameter("Static quantization needs a sample of the images, use `predict directory`")
+    if column is None and manifest.name.endswith(".csv"):
+        column = "path"
+    try:
+        files = core.read_manifest(manifest, column, base_dir)
+    except ValueError as exception:
+        raise typer.BadParameter(str(exception), param_hint="--column") from exception
+    csv_save_dir.mkdir(parents=True, exist_ok=True)
+    csv_fname = create_report_fname(csv_save_dir, report_format)
+    label_counts = LabelCounts(per_directory=directory_summary)
+    if backend == Backend.onnx:
+        models.ensure_onnx_export(model_id)
+    corrupt_images, images_checked = run_predictions(
+        files,
+        csv_fname,
+        model_id=model_id,
+        batch_size=batch_size,
+        memory_limit=memory_limit,
+        label_counts=label_counts,
+        backend=backend,
+        quantize=quantize,
+        workers=workers,
+        threads_per_worker=threads_per_worker,
+        decode_workers=decode_workers,
+        prefetch=prefetch,
+        decode_processes=decode_processes,
+        reduced_decode=reduced_decode,
+        use_cache=use_cache,
+        cache_max_mb=cache_max_mb,
+        cache_hash=cache_hash,
+        use_tensor_cache=use_tensor_cache,
+        tensor_cache_max_mb=tensor_cache_max_mb,
+        report_format=report_format,
+    )
+    if not images_checked and not corrupt_images:
+        print(f"[red]No images listed in {manifest.name}")
+        raise typer.Exit(code=1)
+    report_corrupt_images(corrupt_images, csv_fname)
+    delta = timedelta(seconds=time.perf_counter() - start_time)
+    print_inference_summary(
+        str(delta),
+        None,
+        None,
+        csv_fname,
+        None,
+        images_checked,
+        model_id,
+        file_summary=create_manifest_summary_markdown(manifest.name, images_checked, len(corrupt_images)),
+        label_counts=label_counts,
+    )
+
+
+def report_corrupt_images(corrupt_images: dict[Path, str], csv_fname: Path) -> None:
+    """Writes `corrupt_images` alongside the csv report `csv_fname` and prints where to find them"""
+    if not corrupt_images:
+        return
+    corrupt_fname = write_corrupt_images_csv(corrupt_images, csv_fname)
+    print(
+        Panel(
+            Text(f"{len(corrupt_images)} images couldn't be predicted, see: {corrupt_fname.as_uri()}"),
+            title=":warning: Corrupt images :warning:",
+        )
     )
 
 
 def print_inference_summary(
     time_delta: str,
-    pattern: str,
-    directory: Path,
+    pattern: str | None,
+    directory: Path | None,
     csv_fname: Path,
-    image_format: list[str] | str,
+    image_format: list[str] | str | None,
     matched_file_count: int,
     model_id: str | None = None,
+    file_summary: Panel | None = None,
+    label_counts: "LabelCounts | None" = None,
 ):
-    """prints summary report"""
+    """prints summary report, `file_summary` replaces the summary of the files searched for
+
+    The prediction summary is made from `label_counts` when passed, otherwise by reading the report back.
+    """
     print(flyswot_logo())
     if model_id:
         print(Panel(Columns([models.hub_model_link(model_id)]), title="Model Info"))
@@ -171,9 +947,9 @@ def print_inference_summary(
     print(
         Panel(
             Text(
-                f"CSV report file at: {csv_fname.as_uri()}",
+                f"{csv_fname.suffix.lstrip('.').upper()} report file at: {csv_fname.as_uri()}",
             ),
-            title=" :clipboard: CSV report :clipboard:",
+            title=" :clipboard: Report :clipboard:",
         )
     )
     print(
@@ -182,16 +958,21 @@ def print_inference_summary(
             title=":stopwatch: Time taken to run :stopwatch:",
         )
     )
-    print(create_file_summary_markdown(pattern, matched_file_count, directory, image_format))
-    inference_summary_columns = get_inference_table_columns(csv_fname)
+    print(file_summary or create_file_summary_markdown(pattern, matched_file_count, directory, image_format))
+    if label_counts is None:
+        inference_summary_columns = get_inference_table_columns(csv_fname)
+    else:
+        inference_summary_columns = label_counts.tables()
     print(Panel(Columns(inference_summary_columns), title="Prediction Summary"))
+    if label_counts is not None and label_counts.per_directory:
+        print(Panel(Columns(label_counts.directory_tables()), title="Prediction Summary by Directory"))
 
 
 def create_file_summary_markdown(
-    pattern: str,
+    pattern: str | None,
     matched_file_count: int,
-    directory: Path,
-    image_formats: list[str] | str,
+    directory: Path | None,
+    image_formats: list[str] | str | None,
 ) -> Panel:
     """creates Markdown summary containing number of files checked by flyswot vs total images files under directory"""
     return Panel(
@@ -206,9 +987,25 @@ def create_file_summary_markdown(
     )
 
 
+def create_manifest_summary_markdown(manifest_name: str, checked_count: int, corrupt_count: int) -> Panel:
+    """creates Markdown summary of the number of images listed in a manifest which flyswot checked"""
+    return Panel(
+        Markdown(
+            f"""
+    - flyswot read the images to check from `{manifest_name}`
+    - flyswot checked **{checked_count}** listed images, **{corrupt_count}** of which couldn't be predicted
+    """
+        ),
+        title=":file_folder: files checked :file_folder:",
+    )
+
+
 def get_inference_table_columns(csv_fname: Path) -> list[Table]:
     """print_inference_summary from `fname`"""
-    labels_to_print = labels_from_csv(csv_fname)
+    if Path(csv_fname).suffix == ReportFormat.csv.suffix:
+        labels_to_print = labels_from_csv(csv_fname)
+    else:
+        labels_to_print = labels_from_arrow(csv_fname)
     return [print_table(labels, f"Prediction summary {i + 1}", print=False) for i, labels in enumerate(labels_to_print)]
 
 
@@ -226,16 +1023,102 @@ def labels_from_csv(fname: Path) -> list[list[str]]:
     return [columns[k] for k in columns if label_regex.match(k)]
 
 
+def labels_from_arrow(fname: Path) -> list[list[str]]:
+    """Gets top labels from Parquet or Arrow IPC report `fname`, reading only the top label columns"""
+    import pyarrow
+
+    if Path(fname).suffix == ReportFormat.parquet.suffix:
+        import pyarrow.parquet
+
+        names = pyarrow.parquet.read_schema(fname).names
+        table = pyarrow.parquet.read_table(fname, columns=[name for name in names if label_regex.match(name)])
+    else:
+        table = pyarrow.ipc.open_file(pyarrow.memory_map(str(fname))).read_all()
+    return [table.column(name).to_pylist() for name in table.column_names if label_regex.match(name)]
+
+
+class LabelCounts:
+    """Counts of the top label predicted by each head, updated as predictions are written to a report
+
+    This lets the end of run summary be made without reading the report back.
+
+    Attributes:
+        heads: A Counter of top labels for each prediction head
+        per_directory: Whether the labels are also counted for each directory
+        directories: The Counters for each head of each directory, when counting `per_directory`
+    """
+
+    def __init__(self, per_directory: bool = False):
+        """Create empty counts"""
+        self.per_directory = per_directory
+        self.heads: list[Counter] = []
+        self.directories: defaultdict[str, list[Counter]] = defaultdict(list)
+
+    @staticmethod
+    def _count(counters: list[Counter], labels: Iterable[str]) -> None:
+        for i, label in enumerate(labels):
+            if i == len(counters):
+                counters.append(Counter())
+            counters[i][label] += 1
+
+    def add(self, predictions: MultiPredictionBatch) -> None:
+        """Counts the top labels of `predictions`"""
+        if isinstance(predictions, ArrayPredictionBatch):
+            paths, predicted_labels = predictions.paths, predictions.predicted_labels.tolist()
+        else:
+            paths = [item.path for item in predictions.batch]
+            predicted_labels = [item.predicted_labels for item in predictions.batch]
+        for path, labels in zip(paths, predicted_labels, strict=True):
+            self._count(self.heads, labels)
+            if self.per_directory:
+                self._count(self.directories[str(path.parent)], labels)
+
+    def add_csv_report(self, csv_fname: Path) -> None:
+        """Counts the top labels of the predictions already in csv report `csv_fname`, i.e. when resuming"""
+        with open(csv_fname, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            label_columns = [i for i, name in enumerate(header) if label_regex.match(name)]
+            for row in reader:
+                labels = [row[i] for i in label_columns]
+                self._count(self.heads, labels)
+                if self.per_directory:
+                    self._count(self.directories[row[1]], labels)
+
+    def tables(self) -> list[Table]:
+        """Summary tables of the labels predicted by each head"""
+        return [frequency_table(counts, f"Prediction summary {i + 1}") for i, counts in enumerate(self.heads)]
+
+    def directory_tables(self) -> list[Table]:
+        """Tables of the labels predicted by each head in each directory"""
+        tables = []
+        for i, counts in enumerate(self.heads):
+            labels = sorted(counts)
+            table = Table("Directory", *labels, "Total", show_header=True, title=f"Prediction summary {i + 1}")
+            for directory, directory_counts in sorted(self.directories.items()):
+                head_counts = directory_counts[i] if i < len(directory_counts) else Counter()
+                table.add_row(directory, *(str(head_counts[label]) for label in labels), str(head_counts.total()))
+            tables.append(table)
+        return tables
+
+
 def print_table(decoded: list, header: str = "Prediction summary", print: bool = True) -> Table:
     """Prints table summary of predicted labels"""
+    table = frequency_table(itertoolz.frequencies(decoded), header)
+    if print:
+        console.print(table)
+    return table
+
+
+def frequency_table(frequencies: dict[str, int], header: str = "Prediction summary") -> Table:
+    """Creates table summarising the count and percentage of each label in `frequencies`"""
     table = Table(show_header=True, title=header)
     table.add_column(
         "Class",
     )
     table.add_column("Count")
     table.add_column("Percentage")
-    total = len(decoded)
-    frequencies = itertoolz.frequencies(decoded)
+    total = sum(frequencies.values())
     for is_last_element, var in core.signal_last(frequencies.items()):
         key, value = var
         count = value
@@ -245,8 +1128,6 @@ def print_table(decoded: list, header: str = "Prediction summary", print: bool =
             table.add_row("Total", str(total), "")
         else:
             table.add_row(key, str(count), f"{percentage}")
-    if print:
-        console.print(table)
     return table
 
 
@@ -284,18 +1165,8 @@ def _(batch: PredictionBatch, csv_path: Path):
 
 @create_csv_header.register
 def _(batch: MultiPredictionBatch, csv_path: Path, top_n: int = 2) -> None:
-    item = batch.batch[0]
-    pred = OrderedDict()
-    pred["path"] = asdict(item)["path"]
-    pred["directory"] = asdict(item)["path"].parent
-    for i, _ in enumerate(item.predictions):
-        for j in range(top_n):
-            pred[f"prediction_label_{string.ascii_letters[i]}_{j}"] = ""
-            pred[f"confidence_label_{string.ascii_letters[i]}_{j}"] = ""
-    with open(csv_path, mode="w", newline="", encoding="utf-8") as csv_file:
-        field_names = list(pred.keys())
-        writer = csv.DictWriter(csv_file, fieldnames=field_names)
-        writer.writeheader()
+    with CsvReportWriter(csv_path, top_n=top_n) as report:
+        report.write_header(batch.batch[0])
 
 
 @singledispatch
@@ -314,61 +1185,445 @@ def _(predictions: PredictionBatch, csv_fpath: Path) -> None:
             row = asdict(pred)
             row["directory"] = pred.path.parent
             writer.writerow(row)
+        sync_to_disk(csv_file)
 
 
-@logger.catch()
 @write_batch_preds_to_csv.register
 def _(predictions: MultiPredictionBatch, csv_fpath: Path, top_n: int = 2) -> None:
-    for pred in predictions.batch:
-        row = OrderedDict()
-        row["path"] = asdict(pred)["path"]
-        row["directory"] = asdict(pred)["path"].parent
-        for i, v in enumerate(pred.predictions):
-            sorted_predictions = sorted(v.items(), reverse=True)
-            for j in range(top_n):
-                row[f"prediction_label_{i}_{j}"] = sorted_predictions[j][1]
-                row[f"confidence_label_{i}_{j}"] = sorted_predictions[j][0]
-        with open(csv_fpath, mode="a", newline="", encoding="utf-8") as csv_file:
-            field_names = list(row.keys())
-            writer = csv.DictWriter(csv_file, fieldnames=field_names)
+    with CsvReportWriter(csv_fpath, append=True, top_n=top_n) as report:
+        report.write(predictions)
+        report.flush()
+
+
+class CsvReportWriter:
+    """Writes `MultiPredictionBatch` predictions to the csv report `csv_fname`
+
+    The report is opened once and rows are written through a single csv writer, with the header written
+    before the first row unless `append`ing to an existing report. Rows are buffered until `flush` is called,
+    which callers do at batch boundaries so the report is left consistent if a run is interrupted.
+
+    Attributes:
+        csv_fname: The csv report
+        top_n: Number of labels, and their confidences, written for each prediction
+    """
+
+    def __init__(self, csv_fname: Path, append: bool = False, top_n: int = 2):
+        """Open `csv_fname`, truncating it unless `append`"""
+        self.csv_fname = csv_fname
+        self.top_n = top_n
+        self.header_written = append
+        self._file = open(csv_fname, mode="a" if append else "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+
+    def __enter__(self) -> "CsvReportWriter":
+        """Use the writer as a context manager which closes the report on exit"""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Flush and close the report"""
+        self.close()
+
+    def write_header(self, item: MultiLabelImagePredictionItem | RankedPredictionItem) -> None:
+        """Writes the header for reports of predictions shaped like `item`"""
+        header = ["path", "directory"]
+        for i in range(len(item.top_predictions)):
+            for j in range(self.top_n):
+                header += [
+                    f"prediction_label_{string.ascii_letters[i]}_{j}",
+                    f"confidence_label_{string.ascii_letters[i]}_{j}",
+                ]
+        self._writer.writerow(header)
+        self.header_written = True
+
+    def write(self, predictions: MultiPredictionBatch) -> None:
+        """Writes a row for each prediction in `predictions`"""
+        if predictions.batch and not self.header_written:
+            self.write_header(predictions.batch[0])
+        for row in self._rows(predictions):
             try:
-                writer.writerow(row)
+                self._writer.writerow(row)
             except UnicodeEncodeError as exception:
                 logger.error(f"Unable to write prediction to CSV because of {exception}")
-                continue
+
+    def _rows(self, predictions: MultiPredictionBatch) -> Iterator[list]:
+        if isinstance(predictions, ArrayPredictionBatch):
+            labels = predictions.labels
+            top_indices = predictions.top_indices[..., : self.top_n].tolist()
+            top_scores = predictions.top_scores[..., : self.top_n].tolist()
+            for path, heads_indices, heads_scores in zip(predictions.paths, top_indices, top_scores, strict=True):
+                row: list = [path, path.parent]
+                for indices, scores in zip(heads_indices, heads_scores, strict=True):
+                    for j in range(self.top_n):
+                        row += [labels[indices[j]], scores[j]] if j < len(indices) else ["", ""]
+                yield row
+            return
+        for item in predictions.batch:
+            row: list = [item.path, item.path.parent]
+            for pairs in item.top_predictions:
+                top = heapq.nlargest(self.top_n, pairs, key=itemgetter(0))
+                for j in range(self.top_n):
+                    row += [top[j][1], top[j][0]] if j < len(top) else ["", ""]
+            yield row
+
+    def flush(self) -> None:
+        """Writes the buffered rows and syncs the report to disk"""
+        sync_to_disk(self._file)
+
+    def close(self) -> None:
+        """Flushes and closes the report"""
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+class ArrowReportWriter:
+    """Writes `MultiPredictionBatch` predictions to a Parquet or Arrow IPC report `fname`
+
+    Each prediction head gets its top label and confidence, as in the csv report, and the full score vector
+    as a fixed width float column, `scores_a`, `scores_b`, etc. Scores for labels the model didn't return
+    are NaN. The labels the score vectors are ordered by are stored in the schema metadata. Rows are buffered
+    and written as a row group, or record batch, once `row_group_size` rows are waiting at a batch boundary.
+    Requires pyarrow, install it with `pip install flyswot[arrow]`.
+
+    Attributes:
+        fname: The report
+        labels: Labels in score vector order, taken from the first prediction when not passed
+        report_format: Either `ReportFormat.parquet` or `ReportFormat.arrow`
+        row_group_size: Number of rows buffered before they are written
+    """
+
+    def __init__(
+        self,
+        fname: Path,
+        labels: list[str] | None = None,
+        report_format: ReportFormat = ReportFormat.parquet,
+        row_group_size: int = 8192,
+    ):
+        """Create writer for `fname`, the report is created when the first row group is written"""
+        try:
+            import pyarrow
+        except ImportError:  # pragma: no cover
+            raise ImportError(
+                f"{report_format.value} reports require pyarrow, install it with `pip install flyswot[arrow]`"
+            ) from None
+        self._pa = pyarrow
+        self.fname = fname
+        self.labels = list(labels) if labels else None
+        self.report_format = ReportFormat(report_format)
+        self.row_group_size = row_group_size
+        self._heads: int | None = None
+        self._label_index: dict[str, int] = {}
+        self._writer = None
+        self._rows: defaultdict[str, list] = defaultdict(list)
+        self._buffered = 0
+
+    def __enter__(self) -> "ArrowReportWriter":
+        """Use the writer as a context manager which closes the report on exit"""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Write the buffered rows and close the report"""
+        self.close()
+
+    def write(self, predictions: MultiPredictionBatch) -> None:
+        """Buffers a row for each prediction in `predictions`"""
+        if isinstance(predictions, ArrayPredictionBatch) and len(predictions):
+            self.labels = self.labels or list(predictions.labels)
+            if list(predictions.labels) == self.labels:
+                self._write_array_batch(predictions)
+                return
+        for item in predictions.batch:
+            if self._heads is None:
+                self._heads = len(item.top_predictions)
+                self.labels = self.labels or sorted(label for _, label in item.top_predictions[0])
+                self._label_index = {label: i for i, label in enumerate(self.labels)}
+            self._rows["path"].append(str(item.path))
+            self._rows["directory"].append(str(item.path.parent))
+            for i, pairs in enumerate(item.top_predictions):
+                letter = string.ascii_letters[i]
+                scores = np.full(len(self._label_index), np.nan, dtype=np.float32)
+                for score, label in pairs:
+                    if label in self._label_index:
+                        scores[self._label_index[label]] = score
+                top_score, top_label = max(pairs, key=itemgetter(0))
+                self._rows[f"prediction_label_{letter}_0"].append(top_label)
+                self._rows[f"confidence_label_{letter}_0"].append(top_score)
+                self._rows[f"scores_{letter}"].append(scores)
+            self._buffered += 1
+
+    def _write_array_batch(self, predictions: ArrayPredictionBatch) -> None:
+        self._heads = self._heads or predictions.scores.shape[1]
+        self._label_index = {label: i for i, label in enumerate(predictions.labels)}
+        self._rows["path"].extend(map(str, predictions.paths))
+        self._rows["directory"].extend(str(path.parent) for path in predictions.paths)
+        top_labels = predictions.predicted_labels
+        for i in range(self._heads):
+            letter = string.ascii_letters[i]
+            self._rows[f"prediction_label_{letter}_0"].extend(top_labels[:, i].tolist())
+            self._rows[f"confidence_label_{letter}_0"].extend(predictions.top_scores[:, i, 0].tolist())
+            self._rows[f"scores_{letter}"].extend(predictions.scores[:, i])
+        self._buffered += len(predictions)
+
+    def schema(self):
+        """The report's Arrow schema"""
+        pa = self._pa
+        fields = [pa.field("path", pa.string()), pa.field("directory", pa.string())]
+        for i in range(self._heads or 1):
+            letter = string.ascii_letters[i]
+            fields += [
+                pa.field(f"prediction_label_{letter}_0", pa.string()),
+                pa.field(f"confidence_label_{letter}_0", pa.float32()),
+                pa.field(f"scores_{letter}", pa.list_(pa.float32(), len(self.labels or []))),
+            ]
+        return pa.schema(fields, metadata={"flyswot.labels": json.dumps(self.labels or [])})
+
+    def _write_rows(self) -> None:
+        pa = self._pa
+        schema = self.schema()
+        if self._writer is None:
+            if self.report_format == ReportFormat.parquet:
+                import pyarrow.parquet
+
+                self._writer = pyarrow.parquet.ParquetWriter(self.fname, schema, compression="zstd")
+            else:
+                self._writer = pa.ipc.new_file(str(self.fname), schema)
+        arrays = []
+        for field in schema:
+            values = self._rows[field.name]
+            if pa.types.is_fixed_size_list(field.type):
+                flat = np.stack(values).ravel() if values else np.empty(0, dtype=np.float32)
+                arrays.append(pa.FixedSizeListArray.from_arrays(pa.array(flat, pa.float32()), field.type.list_size))
+            else:
+                arrays.append(pa.array(values, field.type))
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+        self._rows.clear()
+        self._buffered = 0
+
+    def flush(self) -> None:
+        """Writes the buffered rows as a row group if at least `row_group_size` rows are waiting"""
+        if self._buffered >= self.row_group_size:
+            self._write_rows()
+
+    def close(self) -> None:
+        """Writes any buffered rows and closes the report"""
+        if self._buffered or self._writer is None:
+            self._write_rows()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def create_report_writer(
+    fname: Path, report_format: ReportFormat, append: bool = False, labels: list[str] | None = None
+) -> CsvReportWriter | ArrowReportWriter:
+    """Creates the writer for a `report_format` report at `fname`, only csv reports can be appended to"""
+    if report_format == ReportFormat.csv:
+        return CsvReportWriter(fname, append=append)
+    if append:
+        raise ValueError(f"Predictions can't be appended to an existing {report_format.value} report")
+    return ArrowReportWriter(fname, labels, report_format)
+
+
+def create_report_fname(report_directory: Path, report_format: ReportFormat = ReportFormat.csv) -> Path:
+    """Creates a filename for a `report_format` report in `report_directory`"""
+    return create_csv_fname(report_directory).with_suffix(ReportFormat(report_format).suffix)
+
+
+def sync_to_disk(file) -> None:
+    """Flushes `file` and syncs it to disk so a report is left consistent at batch boundaries"""
+    file.flush()
+    os.fsync(file.fileno())
 
 
 class HuggingFaceInferenceSession(InferenceSession):
-    "Huggingface inference session"
+    """Huggingface inference session
+
+    Images are preprocessed with the model's image processor and run through the model directly, one forward
+    pass per batch under `torch.inference_mode`, with the softmax, or sigmoid for multi-label models, and top-k
+    done as batched tensor ops rather than per image by a `transformers` pipeline.
+    """
 
-    def __init__(self, model: str):
-        """Create Hugging Face Inference Session"""
+    def __init__(self, model: str, quantization: models.Quantization | None = None):
+        """Create Hugging Face Inference Session, optionally with dynamically quantized int8 linear layers"""
         self.model = AutoModelForImageClassification.from_pretrained(model)
+        config = self.model.config
+        self.labels = [config.id2label[i] for i in range(len(config.id2label))]
+        if quantization == models.Quantization.dynamic:
+            self.model = models.quantize_dynamic_pytorch(self.model)
+        elif quantization:
+            raise ValueError(f"{quantization} quantization isn't supported by the PyTorch backend")
+        self.model.eval()
+        self.multi_label = config.problem_type == "multi_label_classification" or len(self.labels) == 1
         self.image_processor = AutoImageProcessor.from_pretrained(model)
-        self.session = pipeline(
-            "image-classification",
-            model=self.model,
-            image_processor=self.image_processor,
-        )
+        self.decode_size = models.decode_size(self.image_processor)
+        self.tensor_cache: TensorCache | None = None
+
+    def predict_image(self, image: Path) -> list[dict[str, float | str]]:
+        """Predict single Image."""
+        pairs = self.predict_batch([image], 1).batch[0].top_predictions[0]
+        return [{"score": score, "label": label} for score, label in pairs[:10]]
+
+    def predict_batch(self, batch: Iterable[Path], bs: int) -> MultiPredictionBatch:
+        """Predict batch of images"""
+        files = [Path(file) for file in batch]
+        return self.predict_images(files, [decode.load_image(file, self.decode_size) for file in files], bs)
+
+    def predict_images(self, files: list[Path], images: list[Image.Image], bs: int) -> MultiPredictionBatch:
+        """Predict batch of decoded `images` loaded from `files`, adding their inputs to `tensor_cache` if set"""
+        if self.tensor_cache is None:
+            return ArrayPredictionBatch(files, self.predict_scores(images, bs), self.labels)
+        inputs = self.preprocess(images)
+        self.tensor_cache.add(files, inputs)
+        return self.predict_preprocessed(files, inputs, bs)
+
+    def preprocess(self, images: list[Image.Image]) -> np.ndarray:
+        """Compact model inputs for decoded `images`, to be cached and passed to `predict_preprocessed`
+
+        These are the resized uint8 pixels, before rescaling and normalizing, when the image processor makes
+        them, otherwise its float16 output.
+        """
+        pixels = self.image_processor(images, do_rescale=False, do_normalize=False, return_tensors="np")
+        pixels = pixels["pixel_values"]
+        if pixels.dtype == np.uint8 or (pixels.min() >= 0 and pixels.max() <= 255 and np.all(pixels == pixels.round())):
+            return pixels.astype(np.uint8)
+        return self._rescale_and_normalize(torch.from_numpy(pixels).float()).numpy().astype(np.float16)
+
+    def pixel_values(self, inputs: np.ndarray) -> torch.Tensor:
+        """Rescales and normalizes `inputs` made by `preprocess` into the model's float32 pixel values"""
+        pixel_values = torch.from_numpy(np.asarray(inputs)).float()
+        if inputs.dtype != np.uint8:
+            return pixel_values
+        return self._rescale_and_normalize(pixel_values)
+
+    def _rescale_and_normalize(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        config = self.image_processor.to_dict()
+        if config.get("do_rescale"):
+            pixel_values *= config["rescale_factor"]
+        if config.get("do_normalize"):
+            mean = torch.tensor(config["image_mean"]).view(-1, 1, 1)
+            std = torch.tensor(config["image_std"]).view(-1, 1, 1)
+            pixel_values = (pixel_values - mean) / std
+        return pixel_values
+
+    def predict_preprocessed(self, files: list[Path], inputs: np.ndarray, bs: int) -> MultiPredictionBatch:
+        """Predict batch of `files` from their `inputs` made by `preprocess`, skipping decoding and preprocessing"""
+        chunks = (self.pixel_values(inputs[start : start + bs]) for start in range(0, len(inputs), bs))
+        logits = self._forward(chunks)
+        scores = torch.sigmoid(logits) if self.multi_label else torch.softmax(logits, dim=-1)
+        return ArrayPredictionBatch(files, scores.numpy(), self.labels)
+
+    def _forward(self, pixel_values: Iterable[torch.Tensor]) -> torch.Tensor:
+        logits = [torch.empty((0, len(self.labels)))]
+        with torch.inference_mode():
+            for chunk in pixel_values:
+                logits.append(self.model(pixel_values=chunk).logits.float())
+        return torch.cat(logits)
+
+    def _logits(self, images: list[Image.Image], bs: int) -> torch.Tensor:
+        chunks = itertoolz.partition_all(bs, images)
+        return self._forward(self.image_processor(list(chunk), return_tensors="pt")["pixel_values"] for chunk in chunks)
 
-    def predict_image(self, image: Path) -> list[dict[str, float]]:
+    def predict_logits(self, images: list[Image.Image], bs: int) -> np.ndarray:
+        """Logits for decoded `images`, with shape (images, labels), running the model on `bs` images at a time"""
+        return self._logits(images, bs).numpy()
+
+    def predict_scores(self, images: list[Image.Image], bs: int) -> np.ndarray:
+        """Probabilities for decoded `images`, with shape (images, labels)"""
+        logits = self._logits(images, bs)
+        scores = torch.sigmoid(logits) if self.multi_label else torch.softmax(logits, dim=-1)
+        return scores.numpy()
+
+    def predict_features(self, images: list[Image.Image], bs: int) -> np.ndarray:
+        """Pooled backbone features for decoded `images`, the input to the model's classification head"""
+        head = models.classification_head(self.model)
+        features: list[torch.Tensor] = []
+        handle = head.register_forward_pre_hook(lambda module, args: features.append(args[0].flatten(1).float()))
+        try:
+            self._logits(images, bs)
+        finally:
+            handle.remove()
+        if not features:
+            return np.empty((0, models.head_in_features(head) or 0), dtype=np.float32)
+        return torch.cat(features).numpy()
+
+
+class OnnxInferenceSession(InferenceSession):
+    "ONNX Runtime inference session"
+
+    def __init__(self, model: str | Path, threads: int | None = None, quantization: models.Quantization | None = None):
+        """Create ONNX Runtime Inference Session from an exported model directory or a hub model id
+
+        Hub models are exported to ONNX, and cached, the first time they are used. When `quantization` is
+        passed the cached int8 version of the export is used.
+        """
+        try:
+            import onnxruntime
+        except ImportError:  # pragma: no cover
+            raise ImportError(
+                "The ONNX backend requires onnxruntime, install it with `pip install flyswot[onnx]`"
+            ) from None
+        model_path = models.ensure_onnx_export(str(model))
+        onnx_path = model_path / models.ONNX_MODEL_NAME
+        if quantization:
+            onnx_path = models.quantize_onnx(model_path, quantization)
+        config = AutoConfig.from_pretrained(model_path)
+        self.labels = [config.id2label[i] for i in range(len(config.id2label))]
+        self.multi_label = config.problem_type == "multi_label_classification" or len(self.labels) == 1
+        self.image_processor = AutoImageProcessor.from_pretrained(model_path)
+        self.decode_size = models.decode_size(self.image_processor)
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+
+    def predict_image(self, image: Path) -> list[dict[str, float | str]]:
         """Predict single Image."""
-        return self.session(str(image), top_k=10)
+        pairs = self.predict_batch([image], 1).batch[0].top_predictions[0]
+        return [{"score": score, "label": label} for score, label in pairs[:10]]
 
     def predict_batch(self, batch: Iterable[Path], bs: int) -> MultiPredictionBatch:
         """Predict batch of images"""
-        str_batch = [str(file) for file in batch]
-        predictions: list[list[dict[str, float]]] = self.session(str_batch, batch_size=bs, top_k=20)
-        prediction_dicts = [self._process_prediction_dict(pred) for pred in predictions]
-        all_pred = []
-        for file, pred in zip(str_batch, prediction_dicts, strict=False):
-            item_pred = [pred]
-            prediction = MultiLabelImagePredictionItem(Path(file), item_pred)
-            all_pred.append(prediction)
-        return MultiPredictionBatch(all_pred)
-
-    def _process_prediction_dict(self, prediction_item: list[dict[str, float]]) -> dict[float, str]:
-        return merge([{prediction["score"]: prediction["label"]} for prediction in prediction_item])
+        files = [Path(file) for file in batch]
+        return self.predict_images(files, [decode.load_image(file, self.decode_size) for file in files], bs)
+
+    def predict_images(self, files: list[Path], images: list[Image.Image], bs: int) -> MultiPredictionBatch:
+        """Predict batch of decoded `images` loaded from `files`"""
+        return ArrayPredictionBatch(files, self.predict_scores(images, bs), self.labels)
+
+    def predict_logits(self, images: list[Image.Image], bs: int) -> np.ndarray:
+        """Logits for decoded `images`, with shape (images, labels), running the model on `bs` images at a time"""
+        logits = [np.empty((0, len(self.labels)), dtype=np.float32)]
+        for chunk_images in itertoolz.partition_all(bs, images):
+            pixel_values = self.image_processor(list(chunk_images), return_tensors="np")["pixel_values"]
+            outputs = self.session.run(["logits"], {"pixel_values": pixel_values.astype(np.float32)})
+            logits.append(np.asarray(outputs[0]))
+        return np.concatenate(logits)
+
+    def predict_scores(self, images: list[Image.Image], bs: int) -> np.ndarray:
+        """Probabilities for decoded `images`, with shape (images, labels), from a sigmoid for multi-label models"""
+        logits = self.predict_logits(images, bs)
+        return self._sigmoid(logits) if self.multi_label else self._softmax(logits)
+
+    @staticmethod
+    def _sigmoid(logits: np.ndarray) -> np.ndarray:
+        return 1 / (1 + np.exp(-logits))
+
+    @staticmethod
+    def _softmax(logits: np.ndarray) -> np.ndarray:
+        exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def create_inference_session(
+    model_id: str,
+    backend: Backend = Backend.pytorch,
+    threads: int | None = None,
+    quantization: models.Quantization | None = None,
+) -> InferenceSession:
+    """Creates an inference session running `model_id` with `backend`"""
+    if backend == Backend.onnx:
+        return OnnxInferenceSession(model_id, threads=threads, quantization=quantization)
+    return HuggingFaceInferenceSession(model=model_id, quantization=quantization)
 
 
 if __name__ == "__main__":
@@ -1,18 +1,25 @@
 """Core functionality."""
 
+import csv
 import fnmatch
 import mimetypes
 import os
+import re
 import time
-from collections.abc import Iterable, Iterator
+from collections.abc import Callable, Hashable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
 from loguru import logger
 from toolz import itertoolz
 
 from flyswot.console import console
 
+if TYPE_CHECKING:  # pragma: no cover
+    from flyswot.index import FileIndex
+
 IMAGE_EXTENSIONS: set[str] = {k for k, v in mimetypes.types_map.items() if v.startswith("image/")}
 
 
@@ -21,10 +28,14 @@ def count_files_with_ext(directory: Path, ext: str) -> int:
     return itertoolz.count(Path(directory).rglob(f"*{ext}"))
 
 
-def create_file_search_message(directory: Path, pattern: str | None, ext: str | set[str] | None) -> str:
+def create_file_search_message(
+    directory: Path, pattern: str | Iterable[str] | None, ext: str | Iterable[str] | None
+) -> str:
     """Creates a message to show pattern and ext used for search"""
-    if isinstance(ext, set):
+    if ext and not isinstance(ext, str):
         ext = ", ".join(sorted(ext))
+    if pattern and not isinstance(pattern, str):
+        pattern = ", ".join(pattern)
     if pattern and ext:
         message = f"Searching for files in {directory} matching {pattern} with extension {ext}"
     if pattern and not ext:
@@ -59,16 +70,99 @@ def create_file_search_message(directory: Path, pattern: str | None, ext: str |
 #                     yield file
 
 
-def yield_all_files(directory: Path) -> Iterator[Path]:  # pragma: no cover
-    """Yield all files recursively from directory."""
+@dataclass(frozen=True)
+class DirectoryFilter:
+    """Rules for pruning a walk of a directory tree
+
+    Attributes:
+        exclude: Glob patterns matched against directory names, matching directories aren't descended into
+        max_depth: Number of levels below the starting directory to descend into, None for no limit
+        skip_hidden: Skip files and directories whose names start with a dot
+    """
+
+    exclude: tuple[str, ...] = ()
+    max_depth: int | None = None
+    skip_hidden: bool = False
+    _excluded: re.Pattern | None = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        """Compile the exclude patterns"""
+        patterns = [fnmatch.translate(os.path.normcase(pattern)) for pattern in self.exclude]
+        object.__setattr__(self, "_excluded", re.compile("|".join(patterns)) if patterns else None)
+
+    def descend(self, name: str, depth: int) -> bool:
+        """Checks if the directory `name`, `depth` levels below the starting directory, should be walked"""
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        if self.skip_hidden and name.startswith("."):
+            return False
+        return self._excluded is None or self._excluded.match(os.path.normcase(name)) is None
+
+    def keep_file(self, name: str) -> bool:
+        """Checks if the file `name` should be yielded"""
+        return not (self.skip_hidden and name.startswith("."))
+
+
+NO_FILTER = DirectoryFilter()
+
+
+def yield_all_files(
+    directory: Path, directory_filter: DirectoryFilter = NO_FILTER, depth: int = 0
+) -> Iterator[Path]:  # pragma: no cover
+    """Yield all files recursively from directory, pruning directories rejected by `directory_filter`."""
     with os.scandir(directory) as it:
         for entry in it:
             if entry.is_dir():
-                yield from yield_all_files(Path(entry.path))
-            if entry.is_file:
+                if directory_filter.descend(entry.name, depth + 1):
+                    yield from yield_all_files(Path(entry.path), directory_filter, depth + 1)
+            elif entry.is_file() and directory_filter.keep_file(entry.name):
                 yield Path(entry)
 
 
+def _scan_directory(
+    directory: str, depth: int, directory_filter: DirectoryFilter
+) -> tuple[list[Path], list[tuple[str, int]]]:
+    """Lists the files and the subdirectories to walk of `directory`, which is `depth` levels deep"""
+    files, subdirectories = [], []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if directory_filter.descend(entry.name, depth + 1):
+                        subdirectories.append((entry.path, depth + 1))
+                elif entry.is_file() and directory_filter.keep_file(entry.name):
+                    files.append(Path(entry.path))
+    except OSError as exception:
+        logger.warning(f"Unable to list {directory}: {exception}")
+    return files, subdirectories
+
+
+def yield_all_files_parallel(
+    directory: Path, workers: int = 8, directory_filter: DirectoryFilter = NO_FILTER
+) -> Iterator[Path]:
+    """Yield all files recursively from `directory`, listing up to `workers` directories concurrently
+
+    Files are yielded as soon as their directory has been listed so their order isn't deterministic. This
+    hides the latency of listing directories on network mounted storage. Directories rejected by
+    `directory_filter` aren't listed.
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flyswot-walk") as executor:
+        pending = {executor.submit(_scan_directory, os.fspath(directory), 0, directory_filter)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subdirectories = future.result()
+                    pending.update(
+                        executor.submit(_scan_directory, subdirectory, depth, directory_filter)
+                        for subdirectory, depth in subdirectories
+                    )
+                    yield from files
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 def file_can_be_read(path) -> bool:  # pragma: no cover
     """Checks if a file can be opened."""
     return os.access(path, os.R_OK)
@@ -87,44 +181,161 @@ def filter_readable_files(files: Iterator[Path]) -> Iterator[Path]:  # pragma: n
 @logger.catch()
 def get_image_files_from_pattern(
     directory: Path,
-    filename_pattern: str | None = None,
-    image_formats: str | set[str] | None = None,
+    filename_pattern: str | Iterable[str] | None = None,
+    image_formats: str | Iterable[str] | None = None,
     check_opens: bool = True,
+    walk_workers: int = 1,
+    index: "FileIndex | None" = None,
+    changed_only: bool = False,
+    directory_filter: DirectoryFilter = NO_FILTER,
+    full_rescan: bool = False,
 ) -> Iterator[Path]:
-    """yield image files from `directory` matching pattern with `ext`"""
+    """yield image files from `directory` matching any of `filename_pattern` with any of `image_formats`
+
+    The tree is walked once whatever the number of patterns and formats. When `walk_workers` is more than 1
+    directories are listed concurrently and files are yielded in no particular order. When an `index` is
+    passed the tree is scanned incrementally using it, with `changed_only` only new and changed files are
+    yielded and `full_rescan` re-lists every directory rather than reusing unchanged ones. Directories
+    rejected by `directory_filter` are pruned from the walk rather than listed.
+    """
     message = create_file_search_message(directory, filename_pattern, image_formats)
     with console.status(message, spinner="dots"):
         time.sleep(1)
-        all_files = yield_all_files(directory)
-        if check_opens:
-            all_files = filter_readable_files(all_files)
-        for file in all_files:
-            name = file.name
-            filename_pattern = f"*{filename_pattern}*" if filename_pattern else "*"
-            if not image_formats:
-                image_formats = IMAGE_EXTENSIONS
-            if isinstance(image_formats, str):
-                image_formats = {image_formats}
-            if fnmatch.fnmatch(name, filename_pattern) and file.suffix in image_formats:
-                yield file
+        yield from iter_image_files(
+            directory,
+            filename_pattern,
+            image_formats,
+            check_opens,
+            walk_workers,
+            index,
+            changed_only,
+            directory_filter,
+            full_rescan,
+        )
+
+
+def iter_image_files(
+    directory: Path,
+    filename_pattern: str | Iterable[str] | None = None,
+    image_formats: str | Iterable[str] | None = None,
+    check_opens: bool = True,
+    walk_workers: int = 1,
+    index: "FileIndex | None" = None,
+    changed_only: bool = False,
+    directory_filter: DirectoryFilter = NO_FILTER,
+    full_rescan: bool = False,
+) -> Iterator[Path]:
+    """Lazily yield image files from `directory` as they are found, see `get_image_files_from_pattern`
+
+    Unlike `get_image_files_from_pattern` no status is shown so files can be consumed whilst other output,
+    such as a progress bar, is displayed.
+    """
+    matches = compile_file_matcher(filename_pattern, image_formats)
+    if index:
+        scan = index.scan(directory, full_rescan=full_rescan, directory_filter=directory_filter)
+        logger.info(
+            f"{len(scan.new)} new, {len(scan.changed)} changed and {len(scan.deleted)} deleted files in "
+            f"{directory} since it was last indexed"
+        )
+        all_files = iter(scan.new + scan.changed if changed_only else scan.files)
+    elif walk_workers > 1:
+        all_files = yield_all_files_parallel(directory, walk_workers, directory_filter)
+    else:
+        all_files = yield_all_files(directory, directory_filter)
+    matching_files = filter(matches, all_files)
+    if check_opens:
+        matching_files = filter_readable_files(matching_files)
+    yield from matching_files
+
+
+def compile_file_matcher(
+    filename_pattern: str | Iterable[str] | None = None, image_formats: str | Iterable[str] | None = None
+) -> Callable[[Path], bool]:
+    """Compiles filename patterns and image formats into a function checking if a file matches
+
+    A file matches when its name contains any of `filename_pattern` and its extension is any of
+    `image_formats`, defaulting to all image extensions.
+    """
+    if isinstance(image_formats, str):
+        image_formats = {image_formats}
+    formats = frozenset(image_formats or IMAGE_EXTENSIONS)
+    if isinstance(filename_pattern, str):
+        filename_pattern = [filename_pattern]
+    patterns = [os.path.normcase(f"*{pattern}*") for pattern in filename_pattern or [] if pattern]
+    regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns)) if patterns else None
+
+    def matches(file: Path) -> bool:
+        return file.suffix in formats and (regex is None or regex.match(os.path.normcase(file.name)) is not None)
+
+    return matches
 
 
 @logger.catch()
 def filter_to_preferred_ext(files: Iterable[Path], exts: list[str]) -> Iterable[Path]:
-    """Filter files to preferred extension."""
-    files = list(files)
-    files_without_ext = (file.with_suffix("") for file in files if not file.name.startswith("."))
-    file_names_without_ext = (file.name for file in files_without_ext)
-    unique = set(itertoolz.unique(file_names_without_ext))
+    """Filter files sharing a name, ignoring the extension and directory, to the one with the most preferred of `exts`
+
+    See `filter_to_preferred_ext_by`, use it with `same_directory_stem` to only group files in the same directory.
+    """
+    yield from filter_to_preferred_ext_by(files, exts, key=lambda file: file.stem)
+
+
+def same_directory_stem(file: Path) -> tuple[Path, str]:
+    """Groups files by their directory and name ignoring the extension, see `filter_to_preferred_ext_by`"""
+    return file.parent, file.stem
+
+
+def filter_to_preferred_ext_by(
+    files: Iterable[Path], exts: list[str], key: Callable[[Path], Hashable]
+) -> Iterable[Path]:
+    """Filter files with the same `key` to the one with the most preferred of `exts`
+
+    Files are grouped in a single pass over `files` without touching the file system. Groups without any of
+    `exts` keep their first file and files whose name starts with a dot are dropped.
+    """
+    rank = {ext: i for i, ext in enumerate(exts)}
+    preferred: dict[Hashable, Path] = {}
+    seen = 0
     for file in files:
-        file_without_suffix = file.with_suffix("")
-        for ext in exts:
-            if file_without_suffix.name in unique:
-                if file.with_suffix(ext).is_file():
-                    yield file.with_suffix(ext)
-                else:
-                    yield file
-                unique.discard(file_without_suffix.name)
+        if file.name.startswith("."):
+            continue
+        seen += 1
+        current = preferred.get(key(file))
+        if current is None or rank.get(file.suffix, len(rank)) < rank.get(current.suffix, len(rank)):
+            preferred[key(file)] = file
+    if dropped := seen - len(preferred):
+        logger.info(f"Skipping {dropped} files which have a copy with a more preferred extension out of {exts}")
+    yield from preferred.values()
+
+
+def parse_extensions(extensions: str) -> list[str]:
+    """Parses a comma separated list of file extensions, e.g. 'jpg,.tif', into ['.jpg', '.tif']"""
+    return [f".{ext.strip().lstrip('.')}" for ext in extensions.split(",") if ext.strip().lstrip(".")]
+
+
+def read_manifest(lines: Iterable[str], column: str | None = None, base_dir: Path | None = None) -> Iterator[Path]:
+    """Lazily reads image paths from the lines of a manifest, without searching the file system
+
+    Without `column` each line holds a single path, blank lines and lines starting with `#` are skipped. With
+    `column` the lines are read as a csv file and the paths are taken from `column`. Relative paths are
+    relative to `base_dir`, the current directory by default.
+
+    Raises:
+        ValueError: The csv manifest has no `column` column
+    """
+    if column:
+        reader = csv.DictReader(lines)
+        if reader.fieldnames is None or column not in reader.fieldnames:
+            raise ValueError(f"Manifest has no {column} column, found columns: {reader.fieldnames}")
+        paths = (row[column] for row in reader)
+    else:
+        paths = (line for line in lines if not line.lstrip().startswith("#"))
+    return _manifest_paths(paths, base_dir)
+
+
+def _manifest_paths(paths: Iterable[str | None], base_dir: Path | None) -> Iterator[Path]:
+    for path in paths:
+        if path and path.strip():
+            yield Path(base_dir or "") / Path(path.strip()).expanduser()
 
 
 def signal_last(it: Iterable[Any]) -> Iterable[tuple[bool, Any]]:
@@ -0,0 +1,169 @@
+"""Image decoding functionality."""
+
+from collections import deque
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from loguru import logger
+from PIL import Image, ImageOps, TiffImagePlugin
+from toolz import itertoolz
+
+DECODE_ERRORS = (OSError, ValueError)  # PIL.UnidentifiedImageError is an OSError
+REDUCED_RESOLUTION_SUBFILE = 1  # NewSubfileType bit marking a reduced resolution version of a TIFF image
+
+
+def _select_reduced_frame(image: Image.Image, min_size: int) -> None:
+    """Seek a TIFF to its smallest reduced resolution subfile which is still at least `min_size` on the shortest edge"""
+    if not isinstance(image, TiffImagePlugin.TiffImageFile) or image.n_frames < 2:
+        return
+    best_frame, best_size = 0, min(image.size)
+    for frame in range(1, image.n_frames):
+        image.seek(frame)
+        is_reduced = image.tag_v2.get(254, 0) & REDUCED_RESOLUTION_SUBFILE
+        if is_reduced and min_size <= min(image.size) < best_size:
+            best_frame, best_size = frame, min(image.size)
+    image.seek(best_frame)
+
+
+def load_image(path: Path, min_size: int | None = None) -> Image.Image:
+    """Open and fully decode the image at `path` as an RGB image
+
+    When `min_size` is passed the image is decoded at the smallest resolution which keeps its shortest edge
+    at least `min_size`. This uses a TIFF's embedded reduced resolution subfiles or JPEG draft mode when
+    available, otherwise the decoded image is reduced by an integer factor.
+    """
+    with Image.open(path) as image:
+        if min_size:
+            _select_reduced_frame(image, min_size)
+            image.draft("RGB", (min_size, min_size))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+    if min_size and (factor := min(image.size) // min_size) > 1:
+        image = image.reduce(factor)
+    return image
+
+
+@dataclass
+class DecodedBatch:
+    """A batch of decoded images ready to be passed to a model
+
+    Attributes:
+        files: The paths for the images which decoded successfully
+        images: The decoded images, in the same order as `files`
+        failed: The paths for images which couldn't be decoded mapped to the reason
+    """
+
+    files: list[Path]
+    images: list[Image.Image]
+    failed: dict[Path, str] = field(default_factory=dict)
+
+
+def decode_batch(files: Iterable[Path], min_size: int | None = None) -> DecodedBatch:
+    """Decode `files` on the current thread, see `load_image` for `min_size`"""
+    decoded = DecodedBatch([], [])
+    for file in files:
+        try:
+            image = load_image(file, min_size)
+        except DECODE_ERRORS as exception:
+            decoded.failed[Path(file)] = repr(exception)
+            continue
+        decoded.files.append(Path(file))
+        decoded.images.append(image)
+    return decoded
+
+
+def estimated_decoded_size(path: Path, min_size: int | None = None) -> int:
+    """Estimates the memory, in bytes, the image at `path` takes once decoded, reading only its header
+
+    See `load_image` for `min_size`. Images which can't be opened are estimated at 0 bytes.
+    """
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except DECODE_ERRORS:
+        return 0
+    if min_size and (factor := min(width, height) // min_size) > 1:
+        width, height = width // factor, height // factor
+    return width * height * 3
+
+
+def memory_bounded_batches(
+    files: Iterable[Path], bs: int, max_batch_bytes: int, min_size: int | None = None
+) -> Iterator[list[Path]]:
+    """Yield batches of up to `bs` files, ending a batch early when decoding it would take over `max_batch_bytes`
+
+    A single image larger than `max_batch_bytes` is yielded as a batch on its own.
+    """
+    batch: list[Path] = []
+    batch_bytes = 0
+    for file in files:
+        size = estimated_decoded_size(file, min_size)
+        if batch and (len(batch) == bs or batch_bytes + size > max_batch_bytes):
+            if len(batch) < bs:
+                logger.info(f"Reducing a batch to {len(batch)} large images to stay within the memory limit")
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(file)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _collect_batch(files: Sequence[Path], futures: Sequence[Future]) -> DecodedBatch:
+    """Wait for `futures` decoding `files` and collect them into a `DecodedBatch`"""
+    decoded = DecodedBatch([], [])
+    for file, future in zip(files, futures, strict=True):
+        try:
+            image = future.result()
+        except DECODE_ERRORS as exception:
+            decoded.failed[Path(file)] = repr(exception)
+            continue
+        decoded.files.append(Path(file))
+        decoded.images.append(image)
+    return decoded
+
+
+def create_executor(workers: int, use_processes: bool = False) -> Executor:
+    """Creates a pool of `workers` threads, or processes if `use_processes`, for decoding images"""
+    if use_processes:
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flyswot-decode")
+
+
+def prefetch_decoded_batches(
+    files: Iterable[Path],
+    bs: int,
+    workers: int = 4,
+    prefetch: int = 2,
+    use_processes: bool = False,
+    min_size: int | None = None,
+    max_batch_bytes: int | None = None,
+) -> Iterator[DecodedBatch]:
+    """Yield batches of `bs` decoded images from `files`, decoding up to `prefetch` batches ahead
+
+    Images are decoded by a pool of `workers` threads (or processes if `use_processes`) so decoding of
+    upcoming batches overlaps with inference on the current one. When `workers` is 0 images are decoded
+    on the calling thread. Batches are yielded in the same order as `files`. See `load_image` for `min_size`.
+    When `max_batch_bytes` is passed batches are made smaller where needed to keep the estimated memory of
+    each decoded batch within it.
+    """
+    if max_batch_bytes:
+        batches = memory_bounded_batches(files, bs, max_batch_bytes, min_size)
+    else:
+        batches = itertoolz.partition_all(bs, files)
+    if workers < 1:
+        yield from (decode_batch(batch, min_size) for batch in batches)
+        return
+    executor = create_executor(workers, use_processes)
+    pending: deque[tuple[Sequence[Path], list[Future]]] = deque()
+    try:
+        for batch in batches:
+            pending.append((batch, [executor.submit(load_image, file, min_size) for file in batch]))
+            if len(pending) > prefetch:
+                yield _collect_batch(*pending.popleft())
+        while pending:
+            yield _collect_batch(*pending.popleft())
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,372 @@
+"""Backbone feature store and classification of stored features."""
+
+import json
+import os
+import time
+from collections.abc import Iterable
+from datetime import timedelta
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import PIL
+import torch
+import typer
+from loguru import logger
+from PIL import Image
+from rich import print
+from rich.markdown import Markdown
+from rich.panel import Panel
+from rich.progress import Progress
+from toolz import itertoolz
+
+from flyswot import cli_inference, core, decode, models
+from flyswot.cache import file_fingerprint
+from flyswot.inference import ArrayPredictionBatch
+
+FEATURES_FNAME = "features.f32"
+PATHS_FNAME = "paths.txt"
+META_FNAME = "meta.json"
+
+
+def store_key(model_id: str, revision: str) -> str:
+    """Name of the store directory holding features from `revision` of `model_id`"""
+    return f"{model_id.strip('/').replace('/', '--')}@{revision}"
+
+
+class EmbeddingStore:
+    """Append only store of float32 backbone features, one row per image path, which can be memory mapped
+
+    Features are stored as raw rows in `features.f32`, with the path and file fingerprint of row i on line i
+    of `paths.txt`, separated by a tab, so `features()` maps the whole store without reading it. Features are
+    written before their paths, so after an interruption rows without a path are dropped when the store is
+    next opened. An image which changes is stored again, its latest row supersedes the earlier ones.
+
+    Attributes:
+        directory: The directory holding the store
+        model_id: The model the features were extracted with
+        revision: The revision of `model_id`, see `models.model_revision`
+        dim: The number of features stored for each image, None until features are added
+    """
+
+    def __init__(self, directory: Path, model_id: str | None = None, revision: str | None = None):
+        """Open the store in `directory`, creating it for `revision` of `model_id` if it doesn't exist
+
+        Raises:
+            FileNotFoundError: there's no store in `directory` and no `model_id` to create one for
+        """
+        self.directory = Path(directory)
+        meta_fname = self.directory / META_FNAME
+        meta: dict[str, Any]
+        if meta_fname.exists():
+            meta = json.loads(meta_fname.read_text(encoding="utf-8"))
+        elif model_id is None:
+            raise FileNotFoundError(f"No embedding store in {self.directory}")
+        else:
+            meta = {"model_id": model_id, "revision": revision, "dim": None, "dtype": "float32"}
+            self.directory.mkdir(parents=True, exist_ok=True)
+            meta_fname.write_text(json.dumps(meta), encoding="utf-8")
+        self.model_id = meta["model_id"]
+        self.revision = meta["revision"]
+        self.dim: int | None = meta["dim"]
+        self._paths, self._fingerprints = self._recover()
+        self._latest = {path: row for row, path in enumerate(self._paths)}
+        self._pending: dict[Path, str] = {}
+        self._features_file = open(self.directory / FEATURES_FNAME, "ab")
+        self._paths_file = open(self.directory / PATHS_FNAME, "a", encoding="utf-8")
+
+    @classmethod
+    def for_model(cls, store_dir: Path, model_id: str) -> "EmbeddingStore":
+        """Open, or create, the store in `store_dir` for the current revision of `model_id`"""
+        revision = models.model_revision(model_id)
+        return cls(Path(store_dir) / store_key(model_id, revision), model_id, revision)
+
+    def _recover(self) -> tuple[list[str], list[str]]:
+        """Reads the stored paths and fingerprints, dropping a partly written path and features without a path"""
+        paths_fname = self.directory / PATHS_FNAME
+        features_fname = self.directory / FEATURES_FNAME
+        text = paths_fname.read_text(encoding="utf-8") if paths_fname.exists() else ""
+        if text and not text.endswith("\n"):
+            text = text[: text.rfind("\n") + 1]
+            paths_fname.write_text(text, encoding="utf-8")
+        paths, fingerprints = [], []
+        for line in text.splitlines():
+            path, _, fingerprint = line.rpartition("\t")
+            paths.append(path)
+            fingerprints.append(fingerprint)
+        row_bytes = (self.dim or 0) * np.dtype(np.float32).itemsize
+        if features_fname.exists() and features_fname.stat().st_size != len(paths) * row_bytes:
+            logger.warning(f"Dropping features without a path from {features_fname}")
+            os.truncate(features_fname, len(paths) * row_bytes)
+        return paths, fingerprints
+
+    def __enter__(self) -> "EmbeddingStore":
+        """Use the store as a context manager which closes it on exit"""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Close the store"""
+        self.close()
+
+    def __len__(self) -> int:
+        """Number of images with stored features"""
+        return len(self._latest)
+
+    @property
+    def paths(self) -> list[str]:
+        """The path of each row of `features()`"""
+        return self._paths
+
+    def current_rows(self) -> list[int]:
+        """The rows of `features()` holding the latest features of each image, in the order they were stored"""
+        return sorted(self._latest.values())
+
+    def changed(self, files: Iterable[Path]) -> list[Path]:
+        """Returns the `files` which aren't in the store, or have changed since their features were stored"""
+        changed = []
+        for file in files:
+            try:
+                fingerprint = file_fingerprint(file)
+            except OSError:
+                changed.append(file)
+                continue
+            row = self._latest.get(str(file))
+            if row is None or self._fingerprints[row] != fingerprint:
+                self._pending[file] = fingerprint
+                changed.append(file)
+        return changed
+
+    def add(self, paths: list[Path], features: np.ndarray) -> None:
+        """Appends the `features` of `paths`, with shape (paths, dim)
+
+        Raises:
+            ValueError: `features` doesn't have a row of `dim` features for each path
+        """
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        if features.ndim != 2 or len(features) != len(paths):
+            raise ValueError(f"Expected a row of features for each of {len(paths)} paths, got {features.shape}")
+        if self.dim is None:
+            self.dim = features.shape[1]
+            meta = {"model_id": self.model_id, "revision": self.revision, "dim": self.dim, "dtype": "float32"}
+            (self.directory / META_FNAME).write_text(json.dumps(meta), encoding="utf-8")
+        elif features.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim} features for each path, got {features.shape[1]}")
+        fingerprints = []
+        for path in paths:
+            fingerprint = self._pending.pop(path, None)
+            if fingerprint is None:
+                try:
+                    fingerprint = file_fingerprint(path)
+                except OSError:
+                    fingerprint = ""
+            fingerprints.append(fingerprint)
+        self._features_file.write(features.tobytes())
+        cli_inference.sync_to_disk(self._features_file)
+        rows = list(zip(paths, fingerprints, strict=True))
+        self._paths_file.writelines(f"{path}\t{fingerprint}\n" for path, fingerprint in rows)
+        cli_inference.sync_to_disk(self._paths_file)
+        for path, fingerprint in rows:
+            self._latest[str(path)] = len(self._paths)
+            self._paths.append(str(path))
+            self._fingerprints.append(fingerprint)
+
+    def features(self) -> np.ndarray:
+        """Read only memory map of the stored features, with shape (paths, dim)"""
+        if not self._paths or self.dim is None:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(
+            self.directory / FEATURES_FNAME, dtype=np.float32, mode="r", shape=(len(self._paths), self.dim)
+        )
+
+    def close(self) -> None:
+        """Closes the store"""
+        self._features_file.close()
+        self._paths_file.close()
+
+
+def embed_images(
+    files: list[Path], images: list[Image.Image], session: cli_inference.HuggingFaceInferenceSession, bs: int
+) -> tuple[list[Path], np.ndarray, dict[Path, str]]:
+    """Extract features for `images`, one at a time if the batch fails, returning the files they are for
+
+    Returns the files with features, their features and a mapping of images which failed to the error raised.
+    """
+    try:
+        return files, session.predict_features(images, bs), {}
+    except (PIL.UnidentifiedImageError, ValueError) as exception:
+        if len(files) == 1:
+            logger.warning(f"Unable to embed {files[0]} because of {exception!r}")
+            return [], np.empty((0, 0), dtype=np.float32), {Path(files[0]): repr(exception)}
+    embedded, features, failed = [], [], {}
+    for file, image in zip(files, images, strict=True):
+        file_embedded, file_features, file_failed = embed_images([file], [image], session, bs)
+        embedded.extend(file_embedded)
+        failed.update(file_failed)
+        if file_embedded:
+            features.append(file_features)
+    return embedded, np.concatenate(features) if features else np.empty((0, 0), dtype=np.float32), failed
+
+
+def classify_features(
+    session: cli_inference.HuggingFaceInferenceSession, features: np.ndarray, bs: int = 4096
+) -> np.ndarray:
+    """Applies the classification head of `session`'s model to stored `features`, `bs` rows at a time
+
+    Returns the probabilities for each label, with shape (rows, labels).
+    """
+    head = models.classification_head(session.model)
+    scores = [np.empty((0, len(session.labels)), dtype=np.float32)]
+    with torch.inference_mode():
+        for start in range(0, len(features), bs):
+            logits = head(torch.from_numpy(np.array(features[start : start + bs]))).float()
+            chunk_scores = torch.sigmoid(logits) if session.multi_label else torch.softmax(logits, dim=-1)
+            scores.append(chunk_scores.numpy())
+    return np.concatenate(scores)
+
+
+def head_input_size(session: cli_inference.HuggingFaceInferenceSession) -> int | None:
+    """Number of features the classification head of `session`'s model takes, None if it can't be told"""
+    return models.head_in_features(models.classification_head(session.model))
+
+
+def embed(
+    directory: Path = typer.Argument(
+        ...,
+        exists=True,
+        file_okay=False,
+        resolve_path=True,
+        help="Directory to start searching for images from",
+    ),
+    store_dir: Path = typer.Argument(
+        ...,
+        file_okay=False,
+        resolve_path=True,
+        help="Directory holding the embedding stores, one for each model and revision",
+    ),
+    model_id: str = cli_inference.MODEL_ID_OPTION,
+    pattern: str = cli_inference.PATTERN_OPTION,
+    bs: int = cli_inference.FIXED_BS_OPTION,
+    image_formats: list[str] = cli_inference.IMAGE_FORMATS_OPTION,
+    decode_workers: int = cli_inference.DECODE_WORKERS_OPTION,
+    prefetch: int = cli_inference.PREFETCH_OPTION,
+    walk_workers: int = cli_inference.WALK_WORKERS_OPTION,
+):
+    """Stores the pooled backbone features of images under DIRECTORY which match PATTERN.
+
+    Features are appended to a memory mappable store in STORE_DIR for the model and its revision, images
+    already in the store are skipped unless they have changed. Use `predict classify-embeddings` to classify the stored images.
+    """
+    start_time = time.perf_counter()
+    session = cli_inference.HuggingFaceInferenceSession(model_id)
+    files = sorted(core.get_image_files_from_pattern(directory, pattern, set(image_formats), walk_workers=walk_workers))
+    cli_inference.check_files(files, pattern, directory)
+    corrupt_images: dict[Path, str] = {}
+    with EmbeddingStore.for_model(store_dir, model_id) as store, Progress() as progress:
+        found = len(files)
+        files = store.changed(files)
+        task = progress.add_task("embedding progress", total=len(files))
+        for decoded in decode.prefetch_decoded_batches(
+            files, bs, workers=decode_workers, prefetch=prefetch, min_size=session.decode_size
+        ):
+            corrupt_images.update(decoded.failed)
+            if decoded.files:
+                embedded, features, failed = embed_images(decoded.files, decoded.images, session, bs)
+                corrupt_images.update(failed)
+                if embedded:
+                    store.add(embedded, features)
+            progress.update(task, advance=len(decoded.files) + len(decoded.failed))
+    if corrupt_images:
+        cli_inference.report_corrupt_images(corrupt_images, store.directory / "embed.csv")
+    delta = timedelta(seconds=time.perf_counter() - start_time)
+    print(
+        Panel(
+            Markdown(
+                f"""
+    - flyswot stored the features of **{len(files) - len(corrupt_images)}** new or changed images, skipping **{found - len(files)}** already stored
+    - **{len(corrupt_images)}** images couldn't be embedded
+    - The store at `{store.directory}` holds **{len(store)}** images with **{store.dim}** features each
+    - Time taken: {delta}
+    """
+            ),
+            title=":file_cabinet: Embedding store :file_cabinet:",
+        )
+    )
+
+
+def classify_embeddings(
+    store_dir: Path = typer.Argument(
+        ...,
+        exists=True,
+        file_okay=False,
+        resolve_path=True,
+        help="An embedding store, or the directory holding the embedding stores",
+    ),
+    csv_save_dir: Path = typer.Argument(
+        ...,
+        writable=True,
+        resolve_path=True,
+        help="Directory used to store the report",
+    ),
+    model_id: str = cli_inference.MODEL_ID_OPTION,
+    embedding_model: str = typer.Option(
+        None, help="The model the stored features were extracted with, defaults to --model-id"
+    ),
+    bs: int = typer.Option(4096, help="Number of stored features classified at a time"),
+    report_format: cli_inference.ReportFormat = cli_inference.REPORT_FORMAT_OPTION,
+    directory_summary: bool = cli_inference.DIRECTORY_SUMMARY_OPTION,
+):
+    """Predicts labels for the images in an embedding store by applying a classification head to their features.
+
+    No images are decoded and the backbone isn't run, so a new head can be applied to a large collection
+    quickly. Creates a report saved to `csv_save_dir`.
+    """
+    start_time = time.perf_counter()
+    if (store_dir / META_FNAME).exists():
+        store = EmbeddingStore(store_dir)
+    else:
+        embedding_model = embedding_model or model_id
+        try:
+            store = EmbeddingStore(store_dir / store_key(embedding_model, models.model_revision(embedding_model)))
+        except FileNotFoundError as exception:
+            raise typer.BadParameter(f"{exception}, run `predict embed` first", param_hint="STORE_DIR") from exception
+    with store:
+        session = cli_inference.HuggingFaceInferenceSession(model_id)
+        in_features = head_input_size(session)
+        if in_features is not None and store.dim is not None and in_features != store.dim:
+            raise typer.BadParameter(
+                f"The classification head of {model_id} takes {in_features} features "
+                f"but {store.directory} stores {store.dim}",
+                param_hint="--model-id",
+            )
+        csv_save_dir.mkdir(parents=True, exist_ok=True)
+        report_fname = cli_inference.create_report_fname(csv_save_dir, report_format)
+        label_counts = cli_inference.LabelCounts(per_directory=directory_summary)
+        features = store.features()
+        rows = store.current_rows()
+        paths = [Path(store.paths[row]) for row in rows]
+        with cli_inference.create_report_writer(report_fname, report_format, labels=session.labels) as report:
+            for start, batch_rows in enumerate(itertoolz.partition_all(bs, rows)):
+                batch_paths = paths[start * bs : start * bs + len(batch_rows)]
+                scores = classify_features(session, features[list(batch_rows)], bs)
+                batch = ArrayPredictionBatch(batch_paths, scores, session.labels)
+                cli_inference.write_predictions([batch], report, label_counts=label_counts)
+    delta = timedelta(seconds=time.perf_counter() - start_time)
+    cli_inference.print_inference_summary(
+        str(delta),
+        "any pattern",
+        store.directory,
+        report_fname,
+        [],
+        len(paths),
+        model_id,
+        file_summary=Panel(
+            Markdown(
+                f"""
+    - flyswot classified the **{len(paths)}** images stored in `{store.directory}`
+    - The features were extracted with {store.model_id} at revision `{store.revision}`
+    """
+            ),
+            title=":file_folder: files checked :file_folder:",
+        ),
+        label_counts=label_counts,
+    )
@@ -0,0 +1,200 @@
+"""Persistent index of scanned directory trees."""
+
+import os
+import sqlite3
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import typer
+from loguru import logger
+
+from flyswot.config import APP_NAME
+from flyswot.core import NO_FILTER, DirectoryFilter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+"""
+UNSCANNED = -1  # modification time of directories which have been listed but not scanned
+
+
+def default_index_path() -> Path:
+    """Location of the file index inside the flyswot app directory"""
+    return Path(typer.get_app_dir(APP_NAME)) / "file_index.sqlite"
+
+
+@dataclass
+class ScanResult:
+    """Files found by a scan and how they differ from the previous scan
+
+    Attributes:
+        files: All the files found
+        new: Files which weren't found by the previous scan
+        changed: Files whose size or modification time differs from the previous scan
+        deleted: Files found by the previous scan which no longer exist
+    """
+
+    files: list[Path] = field(default_factory=list)
+    new: list[Path] = field(default_factory=list)
+    changed: list[Path] = field(default_factory=list)
+    deleted: list[Path] = field(default_factory=list)
+
+
+class FileIndex:
+    """SQLite backed index of the files, sizes and modification times under scanned directories
+
+    A directory's modification time only changes when entries are added to, removed from or renamed within
+    it. Re-scans therefore reuse the indexed listing of directories whose modification time is unchanged,
+    costing one stat per directory rather than a listing and a stat per file. Files modified in place inside
+    an unchanged directory aren't detected, use `full_rescan` to re-list every directory.
+
+    Scans are only saved by `commit`, which happens when the index is used as a context manager and exits
+    without an exception. A run which fails part way through therefore finds the same new and changed files
+    next time rather than losing them.
+
+    Attributes:
+        path: The SQLite database file
+    """
+
+    def __init__(self, path: Path | None = None):
+        """Open, or create, the index at `path`"""
+        self.path = Path(path) if path else default_index_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self) -> "FileIndex":
+        """Use the index as a context manager which closes it on exit"""
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        """Commit the scans made, unless an exception was raised, and close the index"""
+        if exc_type is None:
+            self.commit()
+        self.close()
+
+    def scan(
+        self, directory: Path, full_rescan: bool = False, directory_filter: DirectoryFilter = NO_FILTER
+    ) -> ScanResult:
+        """Scans `directory` recursively, updating the index and returning how its files have changed
+
+        Directories rejected by `directory_filter` aren't scanned and files it rejects aren't reported. Rejected
+        directories are still recorded in the index, so a later scan with a different filter descends into them.
+        The index isn't updated on disk until `commit` is called.
+        """
+        result = ScanResult()
+        pending = [(os.fspath(directory), 0)]
+        while pending:
+            current, depth = pending.pop()
+            try:
+                mtime_ns = os.stat(current).st_mtime_ns
+            except FileNotFoundError:
+                result.deleted.extend(self._remove_tree(current))
+                continue
+            except OSError as exception:
+                logger.warning(f"Unable to scan {current}: {exception}")
+                continue
+            indexed = self.connection.execute("SELECT mtime_ns FROM directories WHERE path = ?", (current,)).fetchone()
+            if indexed and indexed[0] == mtime_ns and not full_rescan:
+                rows = self.connection.execute("SELECT path FROM files WHERE directory = ?", (current,))
+                result.files.extend(
+                    Path(path) for (path,) in rows if directory_filter.keep_file(os.path.basename(path))
+                )
+                rows = self.connection.execute("SELECT path FROM directories WHERE parent = ?", (current,))
+                subdirectories = [path for (path,) in rows]
+            else:
+                subdirectories = self._rescan_directory(current, mtime_ns, result, directory_filter)
+            pending.extend(
+                (subdirectory, depth + 1)
+                for subdirectory in subdirectories
+                if directory_filter.descend(os.path.basename(subdirectory), depth + 1)
+            )
+        return result
+
+    def _rescan_directory(
+        self, directory: str, mtime_ns: int, result: ScanResult, directory_filter: DirectoryFilter
+    ) -> list[str]:
+        """Lists `directory`, recording changes to its files in `result`, and returns its subdirectories"""
+        files, subdirectories = {}, []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            subdirectories.append(entry.path)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                    except OSError as exception:
+                        logger.warning(f"Unable to stat {entry.path}: {exception}")
+        except OSError as exception:
+            logger.warning(f"Unable to list {directory}: {exception}")
+            return []
+        indexed = {
+            path: (size, file_mtime_ns)
+            for path, size, file_mtime_ns in self.connection.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE directory = ?", (directory,)
+            )
+        }
+        for path, signature in files.items():
+            if not directory_filter.keep_file(os.path.basename(path)):
+                continue
+            result.files.append(Path(path))
+            if path not in indexed:
+                result.new.append(Path(path))
+            elif indexed[path] != signature:
+                result.changed.append(Path(path))
+        deleted = [path for path in indexed if path not in files]
+        result.deleted.extend(map(Path, deleted))
+        self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in deleted])
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            [(path, directory, size, file_mtime_ns) for path, (size, file_mtime_ns) in files.items()],
+        )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO directories VALUES (?, ?, ?)",
+            [(subdirectory, directory, UNSCANNED) for subdirectory in subdirectories],
+        )
+        listed = set(subdirectories)
+        for (subdirectory,) in self.connection.execute(
+            "SELECT path FROM directories WHERE parent = ?", (directory,)
+        ).fetchall():
+            if subdirectory not in listed:
+                result.deleted.extend(self._remove_tree(subdirectory))
+        parent = os.path.dirname(directory)
+        self.connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (directory, parent, mtime_ns))
+        return subdirectories
+
+    def _remove_tree(self, directory: str) -> list[Path]:
+        """Removes `directory` and everything below it from the index, returning the files removed"""
+        removed = []
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            rows = self.connection.execute("SELECT path FROM files WHERE directory = ?", (current,))
+            removed.extend(Path(path) for (path,) in rows)
+            rows = self.connection.execute("SELECT path FROM directories WHERE parent = ?", (current,))
+            pending.extend(path for (path,) in rows)
+            self.connection.execute("DELETE FROM files WHERE directory = ?", (current,))
+            self.connection.execute("DELETE FROM directories WHERE path = ?", (current,))
+        return removed
+
+    def commit(self) -> None:
+        """Saves the scans made since the last commit"""
+        self.connection.commit()
+
+    def close(self) -> None:
+        """Closes the index, discarding uncommitted scans"""
+        self.connection.close()
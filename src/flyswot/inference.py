@@ -1,13 +1,34 @@
 """Core inference functionality."""
 
+import sys
 from abc import ABC, abstractmethod
-from collections.abc import Iterable
+from collections.abc import Iterable, Sequence
 from dataclasses import dataclass
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:  # pragma: no cover
+    from transformers.image_processing_utils import BaseImageProcessor
+
+    from flyswot.cache import TensorCache
 
 
 class InferenceSession(ABC):
-    """Abstract class for inference sessions"""
+    """Abstract class for inference sessions
+
+    Attributes:
+        labels: The model's labels, in the order of its scores
+        image_processor: The `transformers` image processor preparing decoded images for the model
+        decode_size: Smallest shortest edge images can be decoded at for the model, None decodes at full resolution
+        tensor_cache: Cache of preprocessed model inputs, None for sessions which don't preprocess with it
+    """
+
+    labels: list[str]
+    image_processor: "BaseImageProcessor"
+    decode_size: int | None = None
+    tensor_cache: "TensorCache | None" = None
 
     @abstractmethod
     def __init__(self, model: str | Path):  # pragma: no cover
@@ -24,6 +45,11 @@ class InferenceSession(ABC):
         """Predict a batch"""
         pass
 
+    @abstractmethod
+    def predict_images(self, files: list[Path], images: list, bs: int):  # pragma: no cover
+        """Predict a batch of already decoded `images` loaded from `files`"""
+        pass
+
 
 @dataclass
 class ImagePredictionArgmaxItem:
@@ -54,13 +80,14 @@ class MultiLabelImagePredictionItem:
     path: Path
     predictions: list[dict[float, str]]
 
+    @property
+    def top_predictions(self) -> list[list[tuple[float, str]]]:
+        """The score and label pairs for each head"""
+        return [list(prediction.items()) for prediction in self.predictions]
+
     def _get_top_labels(self) -> list[str]:
         """Get top labels"""
-        top_labels = []
-        for prediction in self.predictions:
-            top_label = sorted(prediction.items(), reverse=True)[0][1]
-            top_labels.append(top_label)
-        return top_labels
+        return [prediction[max(prediction)] for prediction in self.predictions]
 
     # Post init that gets top prediction label from predictions
     def __post_init__(self):
@@ -68,6 +95,22 @@ class MultiLabelImagePredictionItem:
         self.predicted_labels = self._get_top_labels()
 
 
+@dataclass
+class RankedPredictionItem:
+    """Multiple predictions for a single image as score and label pairs, highest score first
+
+    Unlike `MultiLabelImagePredictionItem` labels with tied scores are all kept.
+    """
+
+    path: Path
+    top_predictions: list[list[tuple[float, str]]]
+
+    @property
+    def predicted_labels(self) -> list[str]:
+        """The top label for each head"""
+        return [pairs[0][1] for pairs in self.top_predictions]
+
+
 @dataclass
 class PredictionBatch:
     """Container for ImagePredictionItems"""
@@ -83,7 +126,7 @@ class PredictionBatch:
 class MultiPredictionBatch:
     """Container for MultiLabelImagePredictionItems"""
 
-    batch: list[MultiLabelImagePredictionItem]
+    batch: Sequence[MultiLabelImagePredictionItem | RankedPredictionItem]
 
     def _get_predicted_labels(self) -> Iterable:
         """Returns a iterable of all predicted labels in batch"""
@@ -96,3 +139,119 @@ class MultiPredictionBatch:
         #     for pred in zip(*[o.predictions for o in self.batch])
         # )
         self.batch_labels = self._get_predicted_labels()
+
+
+_vocabs: dict[tuple[str, ...], tuple[str, ...]] = {}
+
+
+def intern_labels(labels: Iterable[str]) -> tuple[str, ...]:
+    """Returns a single shared tuple of interned strings for each distinct sequence of `labels`"""
+    labels = tuple(sys.intern(str(label)) for label in labels)
+    return _vocabs.setdefault(labels, labels)
+
+
+class PredictionView:
+    """A single image's predictions, viewed from the arrays of an `ArrayPredictionBatch`
+
+    Has the `path`, `predicted_labels` and `top_predictions` of a `MultiLabelImagePredictionItem` without
+    holding a copy of its predictions.
+    """
+
+    __slots__ = ("_batch", "_index")
+
+    def __init__(self, batch: "ArrayPredictionBatch", index: int):
+        """View of the `index`th image in `batch`"""
+        self._batch = batch
+        self._index = index
+
+    @property
+    def path(self) -> Path:
+        """The Path to the image"""
+        return self._batch.paths[self._index]
+
+    @property
+    def scores(self) -> np.ndarray:
+        """Score for every label for each head, a view into the batch's score matrix"""
+        return self._batch.scores[self._index]
+
+    @property
+    def top_predictions(self) -> list[list[tuple[float, str]]]:
+        """The top score and label pairs for each head, highest first, including labels with tied scores"""
+        labels = self._batch.labels
+        return [
+            [(score, labels[label]) for label, score in zip(indices, scores, strict=True)]
+            for indices, scores in zip(
+                self._batch.top_indices[self._index].tolist(), self._batch.top_scores[self._index].tolist(), strict=True
+            )
+        ]
+
+    @property
+    def predicted_labels(self) -> list[str]:
+        """The top label for each head"""
+        return [self._batch.labels[label] for label in self._batch.top_indices[self._index, :, 0]]
+
+    def __repr__(self) -> str:
+        """Show the path and top labels"""
+        return f"PredictionView(path={self.path!r}, predicted_labels={self.predicted_labels!r})"
+
+
+class ArrayPredictionBatch(MultiPredictionBatch):
+    """Predictions for a batch of images held in NumPy arrays
+
+    Scores for every label are stored as a float32 matrix indexed against a shared, interned, tuple of
+    labels, rather than as a dict per image and head. The top `top_k` labels are found for the whole batch
+    at once. The `batch` and `batch_labels` attributes of `MultiPredictionBatch` are available as views.
+
+    Attributes:
+        paths: The images in the batch
+        labels: The labels the score columns correspond to
+        scores: Scores with shape (images, heads, labels)
+        top_indices: Label indices of the `top_k` highest scores, with shape (images, heads, top_k)
+        top_scores: The `top_k` highest scores, with shape (images, heads, top_k)
+    """
+
+    def __init__(self, paths: Sequence[Path], scores: np.ndarray, labels: Iterable[str], top_k: int = 20):
+        """Create batch from `scores` for `paths`, shaped (images, labels) or (images, heads, labels)"""
+        self.paths = [path if isinstance(path, Path) else Path(path) for path in paths]
+        self.labels = intern_labels(labels)
+        scores = np.asarray(scores, dtype=np.float32)
+        self.scores = scores[:, np.newaxis, :] if scores.ndim == 2 else scores
+        if len(self.paths) != len(self.scores) or self.scores.shape[-1] != len(self.labels):
+            raise ValueError(f"Scores of shape {self.scores.shape} don't match {len(self.paths)} paths and labels")
+        top_k = min(top_k, len(self.labels))
+        index_type = np.uint16 if len(self.labels) <= np.iinfo(np.uint16).max else np.uint32
+        self.top_indices = np.argsort(-self.scores, axis=-1, kind="stable")[..., :top_k].astype(index_type)
+        self.top_scores = np.take_along_axis(self.scores, self.top_indices.astype(np.intp), axis=-1)
+
+    @property
+    def batch(self) -> list[PredictionView]:
+        """Views of each image's predictions"""
+        return [PredictionView(self, index) for index in range(len(self.paths))]
+
+    @property
+    def batch_labels(self) -> Iterable[list[str]]:
+        """Iterable of the top label for each head of each image"""
+        return (item.predicted_labels for item in self.batch)
+
+    @property
+    def predicted_labels(self) -> np.ndarray:
+        """The top label for each head of each image, with shape (images, heads)"""
+        return np.asarray(self.labels, dtype=object)[self.top_indices[..., 0]]
+
+    def __len__(self) -> int:
+        """Number of images in the batch"""
+        return len(self.paths)
+
+    def __eq__(self, other) -> bool:
+        """Batches are equal when they hold the same paths, labels and scores"""
+        if not isinstance(other, ArrayPredictionBatch):
+            return NotImplemented
+        return (
+            self.paths == other.paths
+            and self.labels == other.labels
+            and np.array_equal(self.scores, other.scores, equal_nan=True)
+        )
+
+    def __repr__(self) -> str:
+        """Show the batch size and labels"""
+        return f"ArrayPredictionBatch({len(self)} images, labels={self.labels!r})"
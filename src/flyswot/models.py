@@ -1,16 +1,29 @@
 """Model Commands."""
 
+import copy
 import fnmatch
+import hashlib
+import json
+import math
+import time
+from collections.abc import Callable, Iterable
 from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
 
+import numpy as np
 import requests
+import torch
 import typer
-from huggingface_hub import hf_hub_url, snapshot_download
+from huggingface_hub import hf_hub_download, hf_hub_url, snapshot_download
 from rich import print
 from rich.markdown import Markdown
+from rich.table import Table
 from toolz import itertoolz, recipes
+from transformers import AutoConfig, AutoImageProcessor, AutoModelForImageClassification
+from transformers.image_processing_utils import BaseImageProcessor
 
+from flyswot import core, decode
 from flyswot.config import APP_NAME, MODEL_REPO_ID
 from flyswot.console import console
 
@@ -88,6 +101,384 @@ def ensure_model(model_dir: Path) -> LocalModel:  # pragma: no cover
     raise typer.Exit()
 
 
+ONNX_MODEL_NAME: str = "model.onnx"
+
+
+def model_cache_dir(model_id: str, kind: str, model_dir: Path | None = None, revision: str | None = None) -> Path:
+    """Directory used to cache `kind` versions, i.e. onnx exports, of `revision` of hub model `model_id`"""
+    name = model_id.replace("/", "--")
+    return ensure_model_dir(model_dir) / kind / (f"{name}@{revision}" if revision else name)
+
+
+def image_input_size(image_processor: BaseImageProcessor) -> tuple[int, int]:
+    """Returns the (height, width) of the images `image_processor` passes to the model"""
+    config = image_processor.to_dict()
+    size = config.get("crop_size") or config["size"]
+    if "height" in size:
+        return size["height"], size["width"]
+    edge = size.get("shortest_edge", 224)
+    return edge, edge
+
+
+def decode_size(image_processor: BaseImageProcessor) -> int:
+    """Smallest shortest edge an image can be decoded at without `image_processor` having to upscale it
+
+    This is the size images are resized to before any crop, so a processor that resizes to 256 and crops to 224
+    needs images decoded at 256 or more.
+    """
+    config = image_processor.to_dict()
+    size = config["size"]
+    if "shortest_edge" not in size:
+        return max(size["height"], size["width"])
+    if crop_pct := config.get("crop_pct"):
+        return math.ceil(size["shortest_edge"] / crop_pct)
+    return size["shortest_edge"]
+
+
+def preprocessing_key(image_processor, min_size: int | None = None) -> str:
+    """Key identifying the model inputs `image_processor` makes from images decoded with `min_size`
+
+    Models whose image processors share a config, whichever model they come from, share a key.
+    """
+    config = image_processor.to_dict()
+    for key in ("processor_class", "_processor_class"):
+        config.pop(key, None)
+    serialized = json.dumps({"config": config, "min_size": min_size}, sort_keys=True, default=str)
+    return hashlib.blake2b(serialized.encode(), digest_size=16).hexdigest()
+
+
+class _LogitsOnly(torch.nn.Module):
+    """Wraps an image classification model so it returns only the logits tensor"""
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """Returns logits for `pixel_values`"""
+        return self.model(pixel_values=pixel_values).logits
+
+
+@app.command(name="export-onnx")
+def export_onnx(
+    model_id: str = typer.Argument("flyswot/convnext-tiny-224_flyswot", help="The hub model to export to ONNX"),
+    model_dir: Path | None = typer.Option(
+        None,
+        envvar="MODEL_DIR",
+        help="Optionally specify a directory to store model files in",
+    ),
+    force: bool = typer.Option(False, help="Export again even if a cached export exists"),
+) -> Path:
+    """Exports a hub model to ONNX and caches it locally along with its config and image processor
+
+    Exports are cached for each revision of the model, so an updated model is exported again.
+    """
+    export_dir = model_cache_dir(model_id, "onnx", model_dir, revision=model_revision(model_id))
+    onnx_path = export_dir / ONNX_MODEL_NAME
+    if onnx_path.exists() and not force:
+        print(f"Using cached ONNX export of {model_id} in {export_dir}")
+        return export_dir
+    model = AutoModelForImageClassification.from_pretrained(model_id).eval()
+    image_processor = AutoImageProcessor.from_pretrained(model_id)
+    height, width = image_input_size(image_processor)
+    export_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = onnx_path.with_suffix(".onnx.tmp")
+    with console.status(f"Exporting {model_id} to ONNX", spinner="dots"):
+        torch.onnx.export(
+            _LogitsOnly(model),
+            (torch.randn(1, 3, height, width),),
+            str(tmp_path),
+            input_names=["pixel_values"],
+            output_names=["logits"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+            dynamo=False,
+        )
+    model.config.save_pretrained(export_dir)
+    image_processor.save_pretrained(export_dir)
+    tmp_path.replace(onnx_path)
+    print(f"Exported {model_id} to {onnx_path}")
+    return export_dir
+
+
+def model_revision(model_id: str) -> str:
+    """Returns the hub commit for `model_id`, or a fingerprint of the model files when `model_id` is a local directory"""
+    model_path = Path(model_id)
+    if model_path.is_dir():
+        digest = hashlib.blake2b(digest_size=8)
+        for file in sorted(model_path.iterdir()):
+            if file.is_file():
+                stat = file.stat()
+                digest.update(f"{file.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
+    return Path(hf_hub_download(model_id, "config.json")).parent.name
+
+
+def model_labels(model_id: str) -> list[str]:
+    """Returns the labels `model_id` predicts, in the order of its outputs"""
+    id2label = AutoConfig.from_pretrained(model_id).id2label
+    return [id2label[i] for i in range(len(id2label))]
+
+
+def classification_head(model: torch.nn.Module) -> torch.nn.Module:
+    """Returns the classification head of Hugging Face image classification `model`, i.e. its `classifier` layer
+
+    Raises:
+        ValueError: `model` has no classification head
+    """
+    try:
+        head = model.get_submodule("classifier")
+    except AttributeError as exception:
+        raise ValueError(f"{type(model).__name__} has no classifier head") from exception
+    if isinstance(head, torch.nn.Identity):
+        raise ValueError(f"{type(model).__name__} has no classifier head")
+    return head
+
+
+def head_in_features(head: torch.nn.Module) -> int | None:
+    """Number of features classification `head` takes, from its first linear layer, None if it has none"""
+    return next((module.in_features for module in head.modules() if isinstance(module, torch.nn.Linear)), None)
+
+
+def ensure_onnx_export(model: str) -> Path:
+    """Returns `model` if it is a directory containing an ONNX export, otherwise the cached export of hub model `model`"""
+    if (Path(model) / ONNX_MODEL_NAME).exists():
+        return Path(model)
+    return export_onnx(model, model_dir=None, force=False)
+
+
+class Backend(str, Enum):
+    """Runtimes available for running models"""
+
+    pytorch = "pytorch"
+    onnx = "onnx"
+
+
+class Quantization(str, Enum):
+    """int8 quantization modes"""
+
+    dynamic = "dynamic"
+    static = "static"
+
+
+def quantized_onnx_path(export_dir: Path, quantization: Quantization) -> Path:
+    """Path of the cached int8 version of the ONNX export in `export_dir`"""
+    return export_dir / f"model.{Quantization(quantization).value}-int8.onnx"
+
+
+def quantize_dynamic_pytorch(model: torch.nn.Module) -> torch.nn.Module:
+    """Dynamically quantizes the linear layers of `model` to int8, in place, for CPU inference
+
+    Requires torchao, install it with `pip install flyswot[quantize]`.
+    """
+    try:
+        from torchao.quantization import Int8DynamicActivationInt8WeightConfig, quantize_
+    except ImportError as exception:
+        raise ImportError(
+            "Quantizing with the PyTorch backend requires torchao, install it with `pip install flyswot[quantize]`"
+        ) from exception
+    quantize_(model, Int8DynamicActivationInt8WeightConfig())
+    return model
+
+
+def sample_files(files: Iterable[Path], sample_size: int) -> list[Path]:
+    """Takes `sample_size` files evenly spaced through `files`"""
+    files = sorted(files)
+    if len(files) <= sample_size:
+        return files
+    step = len(files) / sample_size
+    return [files[int(i * step)] for i in range(sample_size)]
+
+
+def preprocess_images(image_processor, files: list[Path]) -> np.ndarray:
+    """Decodes `files` and returns the pixel values `image_processor` creates for them, skipping corrupt files"""
+    decoded = decode.decode_batch(files)
+    if not decoded.images:
+        raise ValueError("None of the sample images could be decoded")
+    return image_processor(decoded.images, return_tensors="np")["pixel_values"].astype(np.float32)
+
+
+def quantize_onnx(
+    export_dir: Path,
+    quantization: Quantization,
+    calibration_files: list[Path] | None = None,
+    force: bool = False,
+    bs: int = 16,
+) -> Path:
+    """Creates and caches an int8 version of the ONNX export in `export_dir`
+
+    Dynamic quantization only quantizes the weights of the matrix multiplications. Static quantization also
+    quantizes activations, using ranges calibrated on `calibration_files`.
+    """
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quantize_dynamic,
+        quantize_static,
+    )
+
+    quantized_path = quantized_onnx_path(export_dir, quantization)
+    if quantized_path.exists() and not force:
+        return quantized_path
+    tmp_path = quantized_path.with_suffix(".onnx.tmp")
+    with console.status(f"Creating {Quantization(quantization).value} int8 model", spinner="dots"):
+        if quantization == Quantization.dynamic:
+            quantize_dynamic(
+                export_dir / ONNX_MODEL_NAME,
+                tmp_path,
+                weight_type=QuantType.QInt8,
+                op_types_to_quantize=["MatMul", "Gemm"],
+            )
+        else:
+            if not calibration_files:
+                raise ValueError("Static quantization needs calibration images")
+            image_processor = AutoImageProcessor.from_pretrained(export_dir)
+
+            class ImageCalibrationReader(CalibrationDataReader):
+                def __init__(self):
+                    self.batches = (
+                        {"pixel_values": preprocess_images(image_processor, list(batch))}
+                        for batch in itertoolz.partition_all(bs, calibration_files)
+                    )
+
+                def get_next(self):
+                    return next(self.batches, None)
+
+            quantize_static(
+                export_dir / ONNX_MODEL_NAME,
+                tmp_path,
+                ImageCalibrationReader(),
+                quant_format=QuantFormat.QDQ,
+                per_channel=True,
+                weight_type=QuantType.QInt8,
+            )
+    tmp_path.replace(quantized_path)
+    print(f"Saved int8 model to {quantized_path}")
+    return quantized_path
+
+
+def compare_logits(
+    runners: dict[str, Callable[[np.ndarray], np.ndarray]], pixel_values: list[np.ndarray]
+) -> dict[str, float]:
+    """Compares the predictions of the `int8` runner against the `fp32` runner on batches of `pixel_values`
+
+    Each runner returns the logits for a batch of pixel values.
+    """
+    outputs = {}
+    timings = {}
+    for name, run in runners.items():
+        start = time.perf_counter()
+        logits = np.concatenate([run(batch) for batch in pixel_values])
+        timings[name] = time.perf_counter() - start
+        exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        outputs[name] = exp / exp.sum(axis=-1, keepdims=True)
+    images = len(outputs["fp32"])
+    return {
+        "images": images,
+        "top_1_agreement": float((outputs["fp32"].argmax(-1) == outputs["int8"].argmax(-1)).mean()),
+        "max_confidence_difference": float(np.abs(outputs["fp32"] - outputs["int8"]).max()),
+        "mean_confidence_difference": float(np.abs(outputs["fp32"] - outputs["int8"]).mean()),
+        "fp32_images_per_second": images / timings["fp32"],
+        "int8_images_per_second": images / timings["int8"],
+    }
+
+
+def agreement_report(reference: Path, quantized: Path, files: list[Path], bs: int = 16) -> dict[str, float]:
+    """Compares predictions from the `quantized` ONNX model against the fp32 `reference` ONNX model on `files`"""
+    import onnxruntime
+
+    image_processor = AutoImageProcessor.from_pretrained(reference.parent)
+    pixel_values = [preprocess_images(image_processor, list(batch)) for batch in itertoolz.partition_all(bs, files)]
+    runners = {}
+    for name, path in (("fp32", reference), ("int8", quantized)):
+        session = onnxruntime.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+        runners[name] = lambda batch, session=session: np.asarray(session.run(["logits"], {"pixel_values": batch})[0])
+    return compare_logits(runners, pixel_values)
+
+
+def pytorch_agreement_report(model_id: str, files: list[Path], bs: int = 16) -> dict[str, float]:
+    """Compares predictions from the dynamically quantized PyTorch `model_id` against the fp32 model on `files`
+
+    This is the int8 model the PyTorch backend runs with `--quantize dynamic`.
+    """
+    model = AutoModelForImageClassification.from_pretrained(model_id).eval()
+    image_processor = AutoImageProcessor.from_pretrained(model_id)
+    pixel_values = [preprocess_images(image_processor, list(batch)) for batch in itertoolz.partition_all(bs, files)]
+    quantized = quantize_dynamic_pytorch(copy.deepcopy(model))
+
+    def runner(module: torch.nn.Module) -> Callable[[np.ndarray], np.ndarray]:
+        def run(batch: np.ndarray) -> np.ndarray:
+            with torch.inference_mode():
+                return module(pixel_values=torch.from_numpy(batch)).logits.float().numpy()
+
+        return run
+
+    return compare_logits({"fp32": runner(model), "int8": runner(quantized)}, pixel_values)
+
+
+def print_agreement_report(report: dict[str, float], mode: Quantization) -> None:
+    """Prints the agreement `report` for the `mode` int8 model"""
+    table = Table(title=f"{Quantization(mode).value} int8 vs fp32 agreement")
+    table.add_column("Metric")
+    table.add_column("Value")
+    for metric, value in report.items():
+        table.add_row(metric.replace("_", " "), f"{value:.4g}")
+    console.print(table)
+
+
+@app.command(name="quantize")
+def quantize(
+    model_id: str = typer.Argument("flyswot/convnext-tiny-224_flyswot", help="The hub model to quantize"),
+    mode: Quantization = typer.Option(Quantization.dynamic, help="int8 quantization mode"),
+    sample_dir: Path | None = typer.Option(
+        None,
+        help="Directory of local images used to calibrate static quantization and report agreement with the fp32 model",
+    ),
+    sample_size: int = typer.Option(64, help="Number of images sampled from SAMPLE_DIR"),
+    image_formats: list[str] = typer.Option(default=[".tif"], help="Image format(s) to sample"),
+    model_dir: Path | None = typer.Option(
+        None,
+        envvar="MODEL_DIR",
+        help="Optionally specify a directory to store model files in",
+    ),
+    force: bool = typer.Option(False, help="Quantize again even if a cached int8 model exists"),
+    backend: Backend = typer.Option(
+        Backend.onnx,
+        help="Runtime the int8 model is for. The PyTorch backend quantizes when the model is loaded, so only "
+        "the agreement report is saved",
+    ),
+) -> Path:
+    """Creates and caches an int8 version of a hub model and reports its agreement with the fp32 model
+
+    Returns the int8 ONNX model, or with the PyTorch backend the agreement report.
+    """
+    sample = []
+    if sample_dir:
+        files = list(core.get_image_files_from_pattern(sample_dir, None, set(image_formats), check_opens=False))
+        sample = sample_files(files, sample_size)
+    if mode == Quantization.static and not sample:
+        raise typer.BadParameter("Static quantization needs calibration images, pass them with --sample-dir")
+    if backend == Backend.pytorch:
+        if mode != Quantization.dynamic:
+            raise typer.BadParameter("The PyTorch backend only supports dynamic quantization", param_hint="--mode")
+        if not sample:
+            raise typer.BadParameter("The agreement report needs sample images", param_hint="--sample-dir")
+        report_dir = model_cache_dir(model_id, "pytorch", model_dir, revision=model_revision(model_id))
+        report_path = report_dir / f"model.{mode.value}-int8.agreement.json"
+        report = pytorch_agreement_report(model_id, sample)
+        report_dir.mkdir(parents=True, exist_ok=True)
+        report_path.write_text(json.dumps(report, indent=2))
+        print_agreement_report(report, mode)
+        return report_path
+    export_dir = export_onnx(model_id, model_dir=model_dir, force=False)
+    quantized_path = quantize_onnx(export_dir, mode, calibration_files=sample, force=force)
+    if sample:
+        report = agreement_report(export_dir / ONNX_MODEL_NAME, quantized_path, sample)
+        quantized_path.with_suffix(".agreement.json").write_text(json.dumps(report, indent=2))
+        print_agreement_report(report, mode)
+    return quantized_path
+
+
 def is_pipe(c: tuple) -> bool:
     """Checks if | in c"""
     return "|" in c
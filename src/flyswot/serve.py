@@ -0,0 +1,408 @@
+"""Long-running inference server which keeps a model loaded between requests."""
+
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from operator import itemgetter
+from pathlib import Path
+
+import typer
+from loguru import logger
+from rich import print
+from toolz import itertoolz
+
+from flyswot import cli_inference, decode, models
+from flyswot.inference import InferenceSession, MultiLabelImagePredictionItem
+
+DEFAULT_HOST: str = "127.0.0.1"
+DEFAULT_PORT: int = 8765
+DEFAULT_URL: str = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+
+
+class CorruptImageError(ValueError):
+    """Raised for a requested image which couldn't be decoded or predicted"""
+
+
+@dataclass
+class ServerMetrics:
+    """Thread safe request, batch and latency counters for a running server
+
+    Attributes:
+        requests: Number of predictions requested
+        errors: Number of requests which failed
+        batches: Number of micro-batches passed to the model
+        batched_images: Number of images across all micro-batches
+        latencies: Latencies, in seconds, of the most recent requests
+    """
+
+    requests: int = 0
+    errors: int = 0
+    batches: int = 0
+    batched_images: int = 0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=1000))
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record_batch(self, size: int) -> None:
+        """Records a micro-batch of `size` images"""
+        with self.lock:
+            self.batches += 1
+            self.batched_images += size
+
+    def record_request(self, latency: float, failed: bool = False) -> None:
+        """Records a finished request which took `latency` seconds"""
+        with self.lock:
+            self.requests += 1
+            self.errors += failed
+            self.latencies.append(latency)
+
+    def snapshot(self, queue_depth: int) -> dict:
+        """Current metrics with latency percentiles in milliseconds"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            snapshot: dict = {
+                "queue_depth": queue_depth,
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_images / self.batches if self.batches else 0.0,
+            }
+        if latencies:
+            snapshot["latency_ms"] = {
+                "p50": percentile(latencies, 50) * 1000,
+                "p95": percentile(latencies, 95) * 1000,
+                "max": latencies[-1] * 1000,
+            }
+        return snapshot
+
+
+def percentile(ordered: list[float], q: int) -> float:
+    """Nearest rank `q`th percentile of the sorted values `ordered`"""
+    return ordered[min(len(ordered) - 1, len(ordered) * q // 100)]
+
+
+class MicroBatcher:
+    """Merges concurrent single image requests into micro-batches for an inference session
+
+    A batch is passed to the model once `max_batch_size` images are waiting or `max_wait` seconds after
+    the first image in the batch arrived, whichever comes first.
+    """
+
+    def __init__(self, session: InferenceSession, max_batch_size: int = 16, max_wait: float = 0.01):
+        """Create a micro-batcher for `session` and start its batching thread"""
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = ServerMetrics()
+        self._queue: queue.Queue[tuple[Path, Future] | None] = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="flyswot-batcher", daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of images waiting to be batched"""
+        return self._queue.qsize()
+
+    def submit(self, image: Path) -> Future:
+        """Queues `image` for prediction, returning a future for its `MultiLabelImagePredictionItem`"""
+        future: Future = Future()
+        self._queue.put((Path(image), future))
+        return future
+
+    def predict(self, image: Path, timeout: float | None = None) -> MultiLabelImagePredictionItem:
+        """Predicts `image` as part of the next micro-batch"""
+        start = time.perf_counter()
+        try:
+            prediction = self.submit(image).result(timeout)
+        except Exception:
+            self.metrics.record_request(time.perf_counter() - start, failed=True)
+            raise
+        self.metrics.record_request(time.perf_counter() - start)
+        return prediction
+
+    def close(self) -> None:
+        """Finishes the queued requests and stops the batching thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self) -> tuple[list[tuple[Path, Future]], bool]:
+        """Waits for the next micro-batch, returning it and whether the batcher was closed"""
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self) -> None:
+        closed = False
+        while not closed:
+            batch, closed = self._next_batch()
+            if batch:
+                self._predict(batch)
+
+    def _predict(self, batch: list[tuple[Path, Future]]) -> None:
+        """Predicts a micro-batch and resolves each request's future"""
+        self.metrics.record_batch(len(batch))
+        futures: dict[Path, list[Future]] = {}
+        for path, future in batch:
+            futures.setdefault(path, []).append(future)
+        try:
+            decoded = decode.decode_batch(futures, self.session.decode_size)
+            corrupt = dict(decoded.failed)
+            predictions = []
+            if decoded.files:
+                batch_predictions, failed = cli_inference.predict_bisecting(
+                    decoded.files, decoded.images, self.session, len(decoded.files)
+                )
+                corrupt.update(failed)
+                predictions = [item for predictions in batch_predictions for item in predictions.batch]
+        except Exception as exception:
+            for future in itertoolz.concat(futures.values()):
+                future.set_exception(exception)
+            return
+        for item in predictions:
+            for future in futures[item.path]:
+                future.set_result(item)
+        for path, reason in corrupt.items():
+            for future in futures[path]:
+                future.set_exception(CorruptImageError(reason))
+
+
+def prediction_to_json(prediction: MultiLabelImagePredictionItem, top_n: int = 5) -> dict:
+    """Converts `prediction` to a json serializable dict holding the `top_n` labels for each prediction"""
+    return {
+        "path": str(prediction.path),
+        "predicted_labels": prediction.predicted_labels,
+        "predictions": [
+            [
+                {"label": label, "score": score}
+                for score, label in sorted(pairs, key=itemgetter(0), reverse=True)[:top_n]
+            ]
+            for pairs in prediction.top_predictions
+        ],
+    }
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """Handles requests to a prediction server
+
+    `GET /health` reports the model being served, `GET /metrics` reports the queue depth, batch and latency
+    metrics and `POST /predict` with a json body of `{"path": "<image path>"}` returns the prediction for an
+    image readable by the server.
+    """
+
+    server: "PredictionServer"
+    server_version = "flyswot"
+
+    def do_GET(self) -> None:  # noqa: N802
+        """Serve health and metrics"""
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "model": self.server.model_id})
+        elif self.path == "/metrics":
+            batcher = self.server.batcher
+            self._send_json(200, batcher.metrics.snapshot(batcher.queue_depth))
+        else:
+            self._send_json(404, {"error": f"Unknown endpoint {self.path}"})
+
+    def do_POST(self) -> None:  # noqa: N802
+        """Serve predictions"""
+        if self.path != "/predict":
+            self._send_json(404, {"error": f"Unknown endpoint {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            image = Path(body["path"])
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {"error": 'Expected a json body of {"path": "<image path>"}'})
+            return
+        if not image.is_file():
+            self._send_json(404, {"error": f"{image} isn't a file"})
+            return
+        try:
+            prediction = self.server.batcher.predict(image, timeout=self.server.request_timeout)
+        except CorruptImageError as exception:
+            self._send_json(422, {"error": str(exception)})
+            return
+        except Exception as exception:
+            logger.exception(f"Prediction failed for {image}")
+            self._send_json(500, {"error": repr(exception)})
+            return
+        self._send_json(200, prediction_to_json(prediction))
+
+    def _send_json(self, status: int, content: dict) -> None:
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        """Client address for logging, Unix socket clients don't have one"""
+        return self.client_address[0] if self.client_address else "unix-socket"
+
+    def log_message(self, format: str, *args) -> None:
+        """Log requests with loguru rather than to stderr"""
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class PredictionServer(socketserver.BaseServer):
+    """Server for `PredictionRequestHandler` holding the micro-batcher requests are passed to
+
+    Attributes:
+        batcher: Micro-batcher predicting requested images
+        model_id: The model being served
+        request_timeout: Longest time, in seconds, to wait for a prediction, None to wait indefinitely
+    """
+
+    batcher: MicroBatcher
+    model_id: str
+    request_timeout: float | None
+
+
+class PredictionHTTPServer(PredictionServer, ThreadingHTTPServer):
+    """Prediction server listening on a host and port"""
+
+
+class ThreadingUnixHTTPServer(PredictionServer, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Prediction server listening on a Unix domain socket"""
+
+    daemon_threads = True
+
+
+def create_server(
+    batcher: MicroBatcher,
+    model_id: str,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    socket_path: Path | None = None,
+    request_timeout: float | None = 60.0,
+) -> PredictionServer:
+    """Creates a prediction server for `batcher` listening on `socket_path` if passed, otherwise `host`:`port`"""
+    if socket_path:
+        socket_path = Path(socket_path)
+        if socket_path.is_socket():
+            socket_path.unlink()
+        server: PredictionServer = ThreadingUnixHTTPServer(str(socket_path), PredictionRequestHandler)
+    else:
+        server = PredictionHTTPServer((host, port), PredictionRequestHandler)
+    server.batcher = batcher
+    server.model_id = model_id
+    server.request_timeout = request_timeout
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection to a server listening on a Unix domain socket"""
+
+    def __init__(self, socket_path: Path, timeout: float | None = None):
+        """Create connection to the server listening on `socket_path`"""
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = str(socket_path)
+
+    def connect(self) -> None:
+        """Connect to the Unix socket"""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(
+    method: str,
+    endpoint: str,
+    body: dict | None = None,
+    url: str = DEFAULT_URL,
+    socket_path: Path | None = None,
+    timeout: float | None = 60.0,
+) -> tuple[int, dict]:
+    """Sends a request to a prediction server, returning the status and json response
+
+    Raises `ConnectionError` if no server is listening.
+    """
+    if socket_path:
+        connection = UnixHTTPConnection(socket_path, timeout=timeout)
+    else:
+        parsed = urllib.parse.urlsplit(url)
+        connection = http.client.HTTPConnection(parsed.hostname or DEFAULT_HOST, parsed.port, timeout=timeout)
+    try:
+        payload = json.dumps(body) if body is not None else None
+        connection.request(method, endpoint, body=payload, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    except FileNotFoundError as exception:
+        raise ConnectionRefusedError(f"No server listening on {socket_path}") from exception
+    finally:
+        connection.close()
+
+
+def request_prediction(
+    image: Path, url: str = DEFAULT_URL, socket_path: Path | None = None, timeout: float | None = 60.0
+) -> dict:
+    """Requests the prediction for `image` from a running prediction server
+
+    Raises `ConnectionError` if no server is listening and `ValueError` if the server couldn't predict `image`.
+    """
+    status, response = request(
+        "POST", "/predict", {"path": str(Path(image).resolve())}, url, socket_path, timeout=timeout
+    )
+    if status != 200:
+        raise ValueError(f"Server couldn't predict {image}: {response.get('error')}")
+    return response
+
+
+def serve(
+    model_id: str = cli_inference.MODEL_ID_OPTION,
+    host: str = typer.Option(DEFAULT_HOST, help="Host to listen on"),
+    port: int = typer.Option(DEFAULT_PORT, help="Port to listen on"),
+    socket_path: Path = typer.Option(
+        None, "--socket", resolve_path=True, help="Listen on a Unix domain socket instead of host and port"
+    ),
+    max_batch_size: int = typer.Option(16, help="Largest micro-batch of concurrent requests passed to the model"),
+    max_wait_ms: float = typer.Option(
+        10.0, help="Longest time a request waits for other requests to batch with before it's predicted"
+    ),
+    backend: cli_inference.Backend = cli_inference.BACKEND_OPTION,
+    quantize: models.Quantization = cli_inference.QUANTIZE_OPTION,
+) -> None:
+    """Serves predictions from a model kept loaded between requests.
+
+    Concurrent requests are merged into micro-batches. Use `flyswot predict image` to request predictions,
+    `GET /metrics` reports the queue depth and request latencies.
+    """
+    if quantize == models.Quantization.static:
+        raise typer.BadParameter("Static quantization needs a sample of the images, use `predict directory`")
+    session = cli_inference.create_inference_session(model_id, backend, quantization=quantize)
+    batcher = MicroBatcher(session, max_batch_size=max_batch_size, max_wait=max_wait_ms / 1000)
+    server = create_server(batcher, model_id, host, port, socket_path)
+    address = socket_path or f"http://{host}:{server.server_address[1]}"
+    print(f"Serving {model_id} on {address}, press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if socket_path and socket_path.is_socket():
+            os.remove(socket_path)
+    print(f"Stopped serving, metrics: {batcher.metrics.snapshot(batcher.queue_depth)}")
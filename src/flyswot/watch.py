@@ -0,0 +1,313 @@
+"""Watch folder functionality."""
+
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import typer
+from loguru import logger
+from rich import print
+
+from flyswot import cli_inference, core, decode
+from flyswot.inference import InferenceSession
+
+FileSignature = tuple[int, int]
+
+
+def file_signature(path: Path) -> FileSignature | None:
+    """Size and modification time of `path`, None if it no longer exists"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class PollingWatcher:
+    """Finds new and modified files under `directory` by periodically rescanning it
+
+    Files already under `directory` when the watcher is created aren't reported.
+    """
+
+    def __init__(self, directory: Path):
+        """Create watcher for `directory`"""
+        self.directory = Path(directory)
+        self._seen = self._scan()
+
+    def _scan(self) -> dict[Path, FileSignature]:
+        signatures = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = Path(root) / name
+                if signature := file_signature(path):
+                    signatures[path] = signature
+        return signatures
+
+    def changes(self) -> set[Path]:
+        """Files created or modified since the last call"""
+        current = self._scan()
+        changed = {path for path, signature in current.items() if self._seen.get(path) != signature}
+        self._seen = current
+        return changed
+
+    def close(self) -> None:
+        """Stop watching"""
+
+
+class EventWatcher:
+    """Receives new and modified files under `directory` from file system events, i.e. inotify on Linux
+
+    Requires watchdog, install it with `pip install flyswot[watch]`.
+    """
+
+    def __init__(self, directory: Path):
+        """Create watcher for `directory` and start receiving its events"""
+        from watchdog.events import FileSystemEvent, FileSystemEventHandler
+        from watchdog.observers import Observer
+
+        watcher = self
+
+        class ChangedFilesHandler(FileSystemEventHandler):
+            def on_any_event(self, event: FileSystemEvent) -> None:
+                watcher._on_event(event)
+
+        self.directory = Path(directory)
+        self._changed: set[Path] = set()
+        self._lock = threading.Lock()
+        self._observer = Observer()
+        self._observer.schedule(ChangedFilesHandler(), str(self.directory), recursive=True)
+        self._observer.start()
+
+    def _on_event(self, event) -> None:
+        if event.is_directory or event.event_type not in {"created", "modified", "moved", "closed"}:
+            return
+        path = event.dest_path if event.event_type == "moved" else event.src_path
+        with self._lock:
+            self._changed.add(Path(os.fsdecode(path)))
+
+    def changes(self) -> set[Path]:
+        """Files created or modified since the last call"""
+        with self._lock:
+            changed, self._changed = self._changed, set()
+        return changed
+
+    def close(self) -> None:
+        """Stop watching"""
+        self._observer.stop()
+        self._observer.join()
+
+
+def create_watcher(directory: Path, polling: bool = False) -> PollingWatcher | EventWatcher:
+    """Creates a watcher for `directory` using file system events where possible, falling back to polling"""
+    if not polling:
+        try:
+            return EventWatcher(directory)
+        except ImportError:
+            logger.warning("watchdog isn't installed, falling back to polling, see `pip install flyswot[watch]`")
+        except OSError as exception:
+            logger.warning(f"Unable to watch {directory} for file system events, falling back to polling: {exception}")
+    return PollingWatcher(directory)
+
+
+class SettlingFiles:
+    """Files waiting for their size and modification time to stop changing before they're predicted
+
+    This avoids predicting images which are still being written by a scanner.
+    """
+
+    def __init__(self, settle: float):
+        """Create an empty set of files which settle after `settle` seconds"""
+        self.settle = settle
+        self._pending: dict[Path, tuple[FileSignature, float]] = {}
+
+    def __len__(self) -> int:
+        """Number of files waiting to settle"""
+        return len(self._pending)
+
+    def add(self, files: set[Path]) -> None:
+        """Adds new or modified `files`"""
+        now = time.monotonic()
+        for file in files:
+            signature = file_signature(file)
+            previous = self._pending.get(file)
+            if signature is None:
+                self._pending.pop(file, None)
+            elif previous is None or previous[0] != signature:
+                self._pending[file] = (signature, now)
+
+    def ready(self) -> list[Path]:
+        """Removes and returns the files which haven't changed for `settle` seconds"""
+        now = time.monotonic()
+        ready = []
+        for file, (signature, since) in list(self._pending.items()):
+            current = file_signature(file)
+            if current is None:
+                del self._pending[file]
+            elif current != signature:
+                self._pending[file] = (current, now)
+            elif now - since >= self.settle:
+                ready.append(file)
+                del self._pending[file]
+        return sorted(ready)
+
+
+def rolling_report_fname(csv_directory: Path, when: datetime | None = None) -> Path:
+    """Creates the filename for the report predictions made on the day of `when` are appended to"""
+    when = when or datetime.now()
+    return Path(csv_directory) / f"{when:%Y_%m_%d}_watch.csv"
+
+
+class RollingReport:
+    """A csv report, and its corrupt images report, which rolls over to a new file each day"""
+
+    def __init__(self, csv_directory: Path):
+        """Create report in `csv_directory`"""
+        self.csv_directory = Path(csv_directory)
+        self.csv_fname: Path | None = None
+        self.corrupt_images: dict[Path, str] = {}
+        self._writer: cli_inference.CsvReportWriter | None = None
+
+    def _roll(self) -> tuple[cli_inference.CsvReportWriter, Path]:
+        """Current day's report writer and filename, rolling over to a new report if the day has changed"""
+        csv_fname = rolling_report_fname(self.csv_directory)
+        if csv_fname == self.csv_fname and self._writer is not None:
+            return self._writer, csv_fname
+        self.close()
+        self.csv_fname = csv_fname
+        existing = csv_fname.exists() and csv_fname.stat().st_size > 0
+        if existing:
+            cli_inference.truncate_partial_row(csv_fname)
+        self._writer = cli_inference.CsvReportWriter(csv_fname, append=existing)
+        self.corrupt_images = cli_inference.read_corrupt_images_csv(csv_fname)
+        logger.info(f"Writing predictions to {csv_fname}")
+        return self._writer, csv_fname
+
+    def write(self, batch_predictions: list, corrupt_images: dict[Path, str]) -> None:
+        """Appends `batch_predictions` and `corrupt_images` to the current day's reports"""
+        writer, csv_fname = self._roll()
+        cli_inference.write_predictions(batch_predictions, writer)
+        if corrupt_images:
+            self.corrupt_images.update(corrupt_images)
+            cli_inference.write_corrupt_images_csv(self.corrupt_images, csv_fname)
+
+    def close(self) -> None:
+        """Closes the current day's report"""
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+
+def predict_new_files(files: list[Path], session: InferenceSession, bs: int, report: RollingReport) -> None:
+    """Predicts `files` and appends the predictions to `report`"""
+    decoded = decode.decode_batch(files, session.decode_size)
+    corrupt_images = dict(decoded.failed)
+    batch_predictions = []
+    if decoded.files:
+        batch_predictions, corrupt = cli_inference.predict_bisecting(decoded.files, decoded.images, session, bs)
+        corrupt_images.update(corrupt)
+    report.write(batch_predictions, corrupt_images)
+    logger.info(f"Predicted {len(files) - len(corrupt_images)} new images, {len(corrupt_images)} couldn't be predicted")
+
+
+def watch_files(
+    watcher: PollingWatcher | EventWatcher,
+    session: InferenceSession,
+    report: RollingReport,
+    pattern: str | None = None,
+    image_formats: set[str] | None = None,
+    bs: int = 16,
+    max_wait: float = 5.0,
+    settle: float = 2.0,
+    interval: float = 1.0,
+    stop: threading.Event | None = None,
+    initial_files: list[Path] | None = None,
+) -> None:
+    """Predicts new and modified files reported by `watcher` which match `pattern` and `image_formats`
+
+    Files are predicted once they've stopped changing for `settle` seconds. They are batched until `bs`
+    files are ready or the first ready file has waited `max_wait` seconds. Runs until `stop` is set.
+    """
+    stop = stop or threading.Event()
+    matches = core.compile_file_matcher(pattern, image_formats)
+    settling = SettlingFiles(settle)
+    batch: list[Path] = list(initial_files or [])
+    batch_started = time.monotonic()
+    while not stop.is_set():
+        changed = set(filter(matches, watcher.changes()))
+        settling.add(changed)
+        ready = settling.ready()
+        if ready and not batch:
+            batch_started = time.monotonic()
+        batch.extend(file for file in ready if file not in batch)
+        while len(batch) >= bs:
+            predict_new_files(batch[:bs], session, bs, report)
+            batch = batch[bs:]
+            batch_started = time.monotonic()
+        if batch and time.monotonic() - batch_started >= max_wait:
+            predict_new_files(batch, session, bs, report)
+            batch = []
+        stop.wait(interval)
+    if batch:
+        predict_new_files(batch, session, bs, report)
+
+
+def watch(
+    directory: Path = typer.Argument(
+        ...,
+        exists=True,
+        file_okay=False,
+        resolve_path=True,
+        help="Directory to watch for new images",
+    ),
+    csv_save_dir: Path = typer.Argument(
+        ...,
+        writable=True,
+        resolve_path=True,
+        help="Directory used to store the daily csv reports",
+    ),
+    model_id: str = cli_inference.MODEL_ID_OPTION,
+    pattern: str = cli_inference.PATTERN_OPTION,
+    bs: int = cli_inference.FIXED_BS_OPTION,
+    image_formats: list[str] = cli_inference.IMAGE_FORMATS_OPTION,
+    max_wait: float = typer.Option(5.0, help="Longest time, in seconds, a new image waits to be batched"),
+    settle: float = typer.Option(
+        2.0,
+        help="Time, in seconds, a new image must stay unchanged before it's predicted, so partial writes are skipped",
+    ),
+    interval: float = typer.Option(1.0, help="Time, in seconds, between checks for new images"),
+    polling: bool = typer.Option(False, help="Rescan the directory for changes instead of using file system events"),
+    include_existing: bool = typer.Option(False, help="Also predict the matching images already in the directory"),
+    backend: cli_inference.Backend = cli_inference.BACKEND_OPTION,
+) -> None:
+    """Watches DIRECTORY, predicting new or modified images matching PATTERN as they arrive.
+
+    Predictions are appended to a report in `csv_save_dir` which rolls over each day.
+    """
+    csv_save_dir.mkdir(parents=True, exist_ok=True)
+    session = cli_inference.create_inference_session(model_id, backend)
+    watcher = create_watcher(directory, polling)
+    initial_files = None
+    if include_existing:
+        initial_files = sorted(core.get_image_files_from_pattern(directory, pattern, set(image_formats)))
+    print(f"Watching {directory} for images matching {pattern or 'any pattern'} with extension(s) {image_formats}")
+    report = RollingReport(csv_save_dir)
+    try:
+        watch_files(
+            watcher,
+            session,
+            report,
+            pattern=pattern,
+            image_formats=set(image_formats),
+            bs=bs,
+            max_wait=max_wait,
+            settle=settle,
+            interval=interval,
+            initial_files=initial_files,
+        )
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        watcher.close()
+        report.close()
@@ -0,0 +1,24 @@
+"""Shared fixtures."""
+
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tmpdir_factory):
+    """A tiny randomly initialised ConvNext model saved locally so tests don't need the hub"""
+    from transformers import ConvNextConfig, ConvNextForImageClassification, ConvNextImageProcessor
+
+    model_dir = Path(tmpdir_factory.mktemp("tiny_model"))
+    labels = ["flysheet", "cover", "other"]
+    config = ConvNextConfig(
+        hidden_sizes=[8, 16, 32, 64],
+        depths=[1, 1, 1, 1],
+        num_labels=len(labels),
+        id2label=dict(enumerate(labels)),
+        label2id={label: i for i, label in enumerate(labels)},
+    )
+    ConvNextForImageClassification(config).save_pretrained(model_dir)
+    ConvNextImageProcessor(size={"shortest_edge": 224}).save_pretrained(model_dir)
+    return str(model_dir)
@@ -0,0 +1,68 @@
+"""Tests for autotune module."""
+
+import os
+import shutil
+
+import pytest
+import torch
+
+from flyswot import autotune, cli_inference, decode
+
+# flake8: noqa
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    "test_files",
+)
+
+
+@pytest.fixture()
+def image_files(tmp_path):
+    for i in range(6):
+        shutil.copyfile(os.path.join(FIXTURE_DIR, "fly_fse.jpg"), tmp_path / f"{i}.jpg")
+    return sorted(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize("bs,expected", [("auto", None), ("AUTO", None), ("8", 8), (4, 4)])
+def test_parse_batch_size(bs, expected):
+    assert autotune.parse_batch_size(bs) == expected
+
+
+@pytest.mark.parametrize("bs", ["0", "big"])
+def test_parse_batch_size_rejects_invalid(bs):
+    with pytest.raises(ValueError):
+        autotune.parse_batch_size(bs)
+
+
+def test_tune(tiny_model, image_files):
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    decoded = decode.decode_batch(image_files, session.decode_size)
+    threads = torch.get_num_threads()
+    try:
+        result = autotune.tune(session, decoded.files, decoded.images, batch_sizes=(2, 4, 8), thread_counts=(1, 2))
+        assert set(result.measurements) == {(2, 1), (4, 1), (2, 2), (4, 2)}
+        assert result.images_per_second == max(result.measurements.values())
+        assert torch.get_num_threads() == result.threads
+    finally:
+        torch.set_num_threads(threads)
+    input_bytes = 3 * 224 * 224 * 4
+    memory_limit = autotune.batch_memory(decoded.images, 2, input_bytes)
+    result = autotune.tune(session, decoded.files, decoded.images, batch_sizes=(2, 4), memory_limit=memory_limit)
+    assert set(result.measurements) == {(2, None)}
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_tune_batch_size_keeps_every_file(tiny_model, image_files, stream):
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    files = iter(image_files) if stream else image_files
+    bs, files = autotune.tune_batch_size(session, files, tune_threads=False)
+    assert bs == 4
+    assert list(files) == image_files
+
+
+def test_available_memory_reads_meminfo(tmp_path):
+    meminfo = tmp_path / "meminfo"
+    meminfo.write_text("MemTotal:       16384000 kB\nMemFree:         1024000 kB\nMemAvailable:    8192000 kB\n")
+    assert autotune.available_memory(meminfo) == 8192000 * 1024
+    # Falls back to the free memory reported by sysconf
+    assert autotune.available_memory(tmp_path / "missing") > 0
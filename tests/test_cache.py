@@ -0,0 +1,150 @@
+"""Tests for cache module."""
+
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from flyswot import cache
+from flyswot import inference
+
+# flake8: noqa
+
+
+def make_batch(files, score=0.9):
+    items = [inference.MultiLabelImagePredictionItem(file, [{score: "flysheet", 1 - score: "other"}]) for file in files]
+    return inference.MultiPredictionBatch(items)
+
+
+@pytest.fixture()
+def image_files(tmp_path):
+    files = []
+    for i in range(10):
+        file = tmp_path / f"image_{i}.tif"
+        file.write_bytes(b"image" * i)
+        files.append(file)
+    return files
+
+
+def test_serialize_top_predictions_round_trip():
+    top_predictions = [[(0.75, "flysheet"), (0.25, "other")], [(0.4, "a"), (0.4, "b"), (0.2, "c")]]
+    assert cache.deserialize_top_predictions(cache.serialize_top_predictions(top_predictions)) == top_predictions
+
+
+def test_add_keeps_tied_scores_of_array_batches(tmp_path, image_files):
+    scores = np.array([[0.4, 0.4, 0.2]], dtype=np.float32)
+    batch = inference.ArrayPredictionBatch(image_files[:1], scores, ["a", "b", "c"])
+    with cache.PredictionCache("model@1", path=tmp_path / "cache.sqlite") as prediction_cache:
+        prediction_cache.add(batch)
+        (serialized,) = prediction_cache.connection.execute("SELECT predictions FROM predictions").fetchone()
+        hits, _ = prediction_cache.lookup(image_files[:1])
+    assert [label for _, label in json.loads(serialized)[0]] == ["a", "b", "c"]
+    assert hits[0].predicted_labels == batch.batch[0].predicted_labels == ["a"]
+    assert hits[0].top_predictions == batch.batch[0].top_predictions
+
+
+def test_file_fingerprint_changes_with_content(tmp_path):
+    file = tmp_path / "image.tif"
+    file.write_bytes(b"abc")
+    fingerprint = cache.file_fingerprint(file)
+    hashed = cache.file_fingerprint(file, hash_contents=True)
+    file.write_bytes(b"abcd")
+    assert cache.file_fingerprint(file) != fingerprint
+    assert cache.file_fingerprint(file, hash_contents=True) != hashed
+
+
+def test_lookup_returns_cached_predictions(tmp_path, image_files):
+    with cache.PredictionCache("model@1", path=tmp_path / "cache.sqlite") as prediction_cache:
+        hits, misses = prediction_cache.lookup(image_files)
+        assert not hits
+        assert misses == image_files
+        prediction_cache.add(make_batch(image_files[:6]))
+    with cache.PredictionCache("model@1", path=tmp_path / "cache.sqlite") as prediction_cache:
+        hits, misses = prediction_cache.lookup(image_files)
+    assert [hit.path for hit in hits] == image_files[:6]
+    assert hits[0].top_predictions == [[(0.9, "flysheet"), (1 - 0.9, "other")]]
+    assert hits[0].predicted_labels == ["flysheet"]
+    assert misses == image_files[6:]
+
+
+def test_lookup_misses_changed_files_and_other_models(tmp_path, image_files):
+    with cache.PredictionCache("model@1", path=tmp_path / "cache.sqlite") as prediction_cache:
+        prediction_cache.lookup(image_files)
+        prediction_cache.add(make_batch(image_files))
+    changed = image_files[3]
+    stat = changed.stat()
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    with cache.PredictionCache("model@1", path=tmp_path / "cache.sqlite") as prediction_cache:
+        hits, misses = prediction_cache.lookup(image_files)
+    assert misses == [changed]
+    assert len(hits) == 9
+    with cache.PredictionCache("model@2", path=tmp_path / "cache.sqlite") as prediction_cache:
+        hits, misses = prediction_cache.lookup(image_files)
+    assert not hits
+
+
+def test_evict_removes_least_recently_used(tmp_path, image_files):
+    prediction_cache = cache.PredictionCache("model@1", path=tmp_path / "cache.sqlite")
+    prediction_cache.add(make_batch(image_files[:5]))
+    time.sleep(0.01)
+    prediction_cache.add(make_batch(image_files[5:]))
+    size = prediction_cache.size_bytes()
+    assert size > 0
+    prediction_cache.max_size_mb = (size / 2) / (1024 * 1024)
+    removed = prediction_cache.evict()
+    assert removed == 5
+    hits, _ = prediction_cache.lookup(image_files)
+    assert [hit.path for hit in hits] == image_files[5:]
+    prediction_cache.close()
+
+
+def test_tensor_cache_lookup_and_lru_eviction(tmp_path, image_files):
+    inputs = np.stack([np.full((3, 512, 512), i, dtype=np.uint8) for i in range(len(image_files))])
+    with cache.TensorCache("processor", tmp_path, max_size_mb=2) as tensor_cache:
+        tensor_cache.add(image_files[:2], inputs[:2])
+        time.sleep(0.01)
+        hits, cached, misses = tensor_cache.lookup(image_files[:1])
+        assert hits == image_files[:1]
+        np.testing.assert_array_equal(cached, inputs[:1])
+        tensor_cache.add(image_files[2:3], inputs[2:3])
+        hits, cached, misses = tensor_cache.lookup(image_files[:3])
+    assert hits == [image_files[0], image_files[2]]
+    np.testing.assert_array_equal(cached, inputs[[0, 2]])
+    assert misses == [image_files[1]]
+    assert os.path.getsize(tmp_path / "processor.bin") == 2 * inputs[0].nbytes
+    image_files[0].write_bytes(b"changed")
+    with cache.TensorCache("processor", tmp_path, max_size_mb=2) as tensor_cache:
+        assert tensor_cache.lookup(image_files[:1])[0] == []
+        tensor_cache.add(image_files[:1], inputs[5:6].astype(np.float16))
+        assert tensor_cache.lookup(image_files[:1])[0] == []
+    with cache.TensorCache("other", tmp_path, max_size_mb=2) as tensor_cache:
+        assert tensor_cache.lookup(image_files[2:3]) == ([], None, image_files[2:3])
+
+
+def test_tensor_cache_bounds_disk_use_across_configs(tmp_path, image_files):
+    inputs = np.stack([np.full((3, 512, 512), i, dtype=np.uint8) for i in range(len(image_files))])
+    max_bytes = 2 * 1024 * 1024
+    with cache.TensorCache("first", tmp_path, max_size_mb=2) as tensor_cache:
+        tensor_cache.add(image_files[:2], inputs[:2])
+    time.sleep(0.01)
+    with cache.TensorCache("second", tmp_path, max_size_mb=2) as tensor_cache:
+        tensor_cache.add(image_files[2:3], inputs[2:3])
+    assert os.path.getsize(tmp_path / "first.bin") == inputs[0].nbytes
+    with cache.TensorCache("first", tmp_path, max_size_mb=2) as tensor_cache:
+        hits, cached, _ = tensor_cache.lookup(image_files[:2])
+    assert hits == image_files[1:2]
+    np.testing.assert_array_equal(cached, inputs[1:2])
+    time.sleep(0.01)
+    with cache.TensorCache("second", tmp_path, max_size_mb=2) as tensor_cache:
+        for i in range(3, 5):
+            tensor_cache.add(image_files[i : i + 1], inputs[i : i + 1])
+            assert sum(os.path.getsize(file) for file in tmp_path.glob("*.bin")) <= max_bytes
+        hits, cached, _ = tensor_cache.lookup(image_files)
+    assert hits == image_files[3:5]
+    np.testing.assert_array_equal(cached, inputs[3:5])
+    assert not (tmp_path / "first.bin").exists()
+    with cache.TensorCache("first", tmp_path, max_size_mb=2) as tensor_cache:
+        assert tensor_cache.lookup(image_files[:2])[0] == []
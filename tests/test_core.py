@@ -263,3 +263,148 @@ def test_signal_last_truth(d):
             assert is_last_element == False
         if i == dict_len:
             assert is_last_element == True
+
+
+def test_yield_all_files_parallel(tmp_path):
+    """It finds the same files as walking serially"""
+    for i, j in itertools.product(range(3), range(4)):
+        sub_dir = tmp_path / f"{i}" / f"{j}"
+        sub_dir.mkdir(parents=True)
+        for k in range(3):
+            (sub_dir / f"file_{k}.tif").touch()
+    (tmp_path / "top.jpg").touch()
+    serial = {file for file in core.yield_all_files(tmp_path) if file.is_file()}
+    assert set(core.yield_all_files_parallel(tmp_path, workers=4)) == serial
+    assert len(serial) == 3 * 4 * 3 + 1
+
+
+@pytest.mark.parametrize("walk_workers", [1, 4])
+def test_get_image_files_from_pattern_walk_workers(walk_workers, tmp_path):
+    """It filters the same way whether directories are walked serially or concurrently"""
+    for i in range(5):
+        sub_dir = tmp_path / f"{i}_dir"
+        sub_dir.mkdir()
+        (sub_dir / f"file_fs_{i}.tif").touch()
+        (sub_dir / f"file_{i}.tif").touch()
+        (sub_dir / f"file_fs_{i}.jpg").touch()
+    matches = core.get_image_files_from_pattern(tmp_path, "fs", ".tif", check_opens=False, walk_workers=walk_workers)
+    assert sorted(matches) == sorted(tmp_path.rglob("file_fs_*.tif"))
+
+
+def test_compile_file_matcher():
+    """It matches any of the patterns and formats"""
+    matches = core.compile_file_matcher(["fse", "fbspi"], {".tif", ".jpg"})
+    assert matches(Path("a/file_fse_1.tif"))
+    assert matches(Path("a/file_fbspi_1.jpg"))
+    assert not matches(Path("a/file_fse_1.png"))
+    assert not matches(Path("a/file_1.tif"))
+    assert core.compile_file_matcher(None, ".tif")(Path("file_1.tif"))
+    assert core.compile_file_matcher("fse", None)(Path("file_fse_1.png"))
+
+
+def test_get_image_files_from_pattern_multiple_formats_and_patterns(tmp_path):
+    """It finds files for several formats and patterns in one walk"""
+    for pattern, ext in itertools.product(["fse", "fbspi", "other"], [".tif", ".jpg", ".png"]):
+        (tmp_path / f"file_{pattern}{ext}").touch()
+    matches = core.get_image_files_from_pattern(tmp_path, ["fse", "fbspi"], {".tif", ".jpg"}, check_opens=False)
+    assert sorted(file.name for file in matches) == [
+        "file_fbspi.jpg",
+        "file_fbspi.tif",
+        "file_fse.jpg",
+        "file_fse.tif",
+    ]
+
+
+@pytest.fixture()
+def archive_tree(tmp_path):
+    """Directory tree with derivative, hidden and deeply nested directories"""
+    for sub_dir in ["item", "item/.thumbnails", "item/_derivatives", "item/deep", "item/deep/deeper", "old_backup"]:
+        (tmp_path / sub_dir).mkdir(parents=True)
+        (tmp_path / sub_dir / "file_fs.tif").touch()
+    (tmp_path / "item" / ".hidden_fs.tif").touch()
+    return tmp_path
+
+
+@pytest.mark.parametrize("walk_workers", [1, 4])
+@pytest.mark.parametrize(
+    "directory_filter,expected",
+    [
+        (core.DirectoryFilter(), 7),
+        (core.DirectoryFilter(exclude=("_derivatives", "*backup*")), 5),
+        (core.DirectoryFilter(max_depth=1), 3),
+        (core.DirectoryFilter(skip_hidden=True), 5),
+        (core.DirectoryFilter(exclude=("deep",), max_depth=2, skip_hidden=True), 3),
+    ],
+)
+def test_directory_filter_prunes_walk(archive_tree, walk_workers, directory_filter, expected):
+    """It prunes directories during the walk"""
+    matches = list(
+        core.iter_image_files(
+            archive_tree, None, ".tif", check_opens=False, walk_workers=walk_workers, directory_filter=directory_filter
+        )
+    )
+    assert len(matches) == expected
+
+
+def test_directory_filter_prunes_index_scan(archive_tree, tmp_path):
+    """It prunes directories when scanning with an index"""
+    from flyswot.index import FileIndex
+
+    directory_filter = core.DirectoryFilter(exclude=("_derivatives",), skip_hidden=True)
+    with FileIndex(tmp_path / "index.sqlite") as index:
+        for _ in range(2):
+            matches = list(
+                core.iter_image_files(archive_tree, None, ".tif", index=index, directory_filter=directory_filter)
+            )
+            assert len(matches) == 4
+        unfiltered = list(core.iter_image_files(archive_tree, None, ".tif", index=index))
+    assert len(unfiltered) == 7
+
+
+def test_filter_to_preferred_ext_picks_most_preferred():
+    """It keeps the most preferred extension for each name without touching the file system"""
+    files = [
+        Path("masters/item_1.tif"),
+        Path("access/item_1.jpg"),
+        Path("item_2.tif"),
+        Path("item_2.jpg"),
+        Path("item_2.png"),
+        Path("item_3.tif"),
+        Path("item_4.png"),
+        Path(".item_5.jpg"),
+    ]
+    assert list(core.filter_to_preferred_ext(files, [".jpg", ".tif"])) == [
+        Path("access/item_1.jpg"),
+        Path("item_2.jpg"),
+        Path("item_3.tif"),
+        Path("item_4.png"),
+    ]
+    assert list(core.filter_to_preferred_ext(files, [".tif"]))[:2] == [Path("masters/item_1.tif"), Path("item_2.tif")]
+
+
+def test_filter_to_preferred_ext_by_same_directory():
+    """It only groups files in the same directory when keyed by directory and name"""
+    files = [Path("a/item_1.tif"), Path("a/item_1.jpg"), Path("b/item_1.tif"), Path("b/item_2.png")]
+    assert list(core.filter_to_preferred_ext_by(files, [".jpg", ".tif"], core.same_directory_stem)) == [
+        Path("a/item_1.jpg"),
+        Path("b/item_1.tif"),
+        Path("b/item_2.png"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "extensions,expected",
+    [(".jpg,.tif", [".jpg", ".tif"]), ("jpg, tif", [".jpg", ".tif"]), (".png,", [".png"])],
+)
+def test_parse_extensions(extensions, expected):
+    assert core.parse_extensions(extensions) == expected
+
+
+def test_read_manifest(tmp_path):
+    lines = ["# exported from the catalogue\n", "a.tif\n", "\n", "/archive/b.tif\n", "  c d.tif \n"]
+    assert list(core.read_manifest(lines)) == [Path("a.tif"), Path("/archive/b.tif"), Path("c d.tif")]
+    assert list(core.read_manifest(lines, base_dir=tmp_path))[:2] == [tmp_path / "a.tif", Path("/archive/b.tif")]
+    rows = ["id,path\n", "1,a.tif\n", "2,\n", "3,b.tif\n"]
+    assert list(core.read_manifest(rows, "path")) == [Path("a.tif"), Path("b.tif")]
+    with pytest.raises(ValueError):
+        core.read_manifest(rows, "filename")
@@ -0,0 +1,106 @@
+"""Tests for decode module."""
+
+import itertools
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from flyswot import decode
+
+# flake8: noqa
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    "test_files",
+)
+
+
+@pytest.fixture()
+def image_dir(tmp_path):
+    """Directory containing copies of a good and a corrupt image"""
+    for file, i in itertools.product(["fly_fse.jpg", "corrupt_image.jpg"], range(5)):
+        shutil.copyfile(os.path.join(FIXTURE_DIR, file), tmp_path / f"{i}_{file}")
+    return tmp_path
+
+
+def test_load_image():
+    image = decode.load_image(Path(FIXTURE_DIR) / "fly_fse.jpg")
+    assert isinstance(image, Image.Image)
+    assert image.mode == "RGB"
+
+
+def test_load_image_raises_for_corrupt_image():
+    with pytest.raises(Image.UnidentifiedImageError):
+        decode.load_image(Path(FIXTURE_DIR) / "corrupt_image.jpg")
+
+
+def test_decode_batch(image_dir):
+    files = sorted(image_dir.iterdir())
+    decoded = decode.decode_batch(files)
+    assert len(decoded.files) == len(decoded.images) == 5
+    assert len(decoded.failed) == 5
+    assert all(file.name.endswith("corrupt_image.jpg") for file in decoded.failed)
+
+
+@pytest.mark.parametrize("workers", [0, 1, 3])
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_prefetch_decoded_batches_keeps_order(image_dir, workers, prefetch):
+    files = sorted(image_dir.iterdir())
+    batches = list(decode.prefetch_decoded_batches(files, 3, workers=workers, prefetch=prefetch))
+    assert len(batches) == 4
+    seen = []
+    for batch in batches:
+        seen.extend(file for file in files if file in batch.files or file in batch.failed)
+        assert len(batch.files) == len(batch.images)
+    assert seen == files
+
+
+def test_prefetch_decoded_batches_with_processes(image_dir):
+    files = sorted(image_dir.iterdir())
+    batches = list(decode.prefetch_decoded_batches(files, 4, workers=2, use_processes=True))
+    assert sum(len(batch.files) for batch in batches) == 5
+    assert sum(len(batch.failed) for batch in batches) == 5
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "TIFF", "PNG"])
+def test_load_image_min_size(tmp_path, fmt):
+    path = tmp_path / f"large.{fmt.lower()}"
+    Image.new("RGB", (2400, 1800), color=(200, 100, 50)).save(path, format=fmt)
+    image = decode.load_image(path, min_size=256)
+    assert image.mode == "RGB"
+    assert 256 <= min(image.size) < 512
+    assert image.size[0] / image.size[1] == pytest.approx(4 / 3, rel=0.01)
+    assert decode.load_image(path).size == (2400, 1800)
+
+
+def test_load_image_min_size_doesnt_upscale(tmp_path):
+    path = tmp_path / "small.jpg"
+    Image.new("RGB", (300, 200)).save(path)
+    assert decode.load_image(path, min_size=256).size == (300, 200)
+
+
+def test_load_image_uses_reduced_resolution_subfile(tmp_path):
+    path = tmp_path / "pyramid.tif"
+    levels = [Image.new("RGB", (2000 // scale, 1600 // scale), color=(scale, 0, 0)) for scale in (1, 4, 8)]
+    levels[0].save(path, save_all=True, append_images=levels[1:], tiffinfo={254: decode.REDUCED_RESOLUTION_SUBFILE})
+    image = decode.load_image(path, min_size=256)
+    assert image.size == (500, 400)
+    assert image.getpixel((0, 0)) == (4, 0, 0)
+
+
+def test_memory_bounded_batches(tmp_path):
+    files = []
+    for i, size in enumerate([10, 10, 100, 10, 10, 10]):
+        file = tmp_path / f"{i}.png"
+        Image.new("RGB", (size, size)).save(file)
+        files.append(file)
+    files.append(tmp_path / "missing.png")
+    assert decode.estimated_decoded_size(files[2]) == 100 * 100 * 3
+    assert decode.estimated_decoded_size(files[2], min_size=50) == 50 * 50 * 3
+    batches = list(decode.memory_bounded_batches(files, 3, max_batch_bytes=1000))
+    assert batches == [files[:2], files[2:3], files[3:6], files[6:]]
+    decoded = list(decode.prefetch_decoded_batches(files, 3, workers=0, max_batch_bytes=1000))
+    assert [len(batch.files) for batch in decoded] == [2, 1, 3, 0]
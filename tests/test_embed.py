@@ -0,0 +1,93 @@
+"""Tests for embed module."""
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+from typer.testing import CliRunner
+
+from flyswot import cli, cli_inference, decode, embed
+
+# flake8: noqa
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    "test_files",
+)
+GOOD_IMAGE = Path(FIXTURE_DIR) / "fly_fse.jpg"
+
+runner = CliRunner()
+
+
+def test_embedding_store_roundtrip(tmp_path):
+    features = np.arange(12, dtype=np.float32).reshape(3, 4)
+    paths = [Path(f"{i}.jpg") for i in range(3)]
+    with embed.EmbeddingStore(tmp_path, "model", "abc") as store:
+        store.add(paths[:2], features[:2])
+        store.add(paths[2:], features[2:])
+        with pytest.raises(ValueError):
+            store.add(paths[:1], np.zeros((1, 5), dtype=np.float32))
+    with open(tmp_path / embed.FEATURES_FNAME, "ab") as f:
+        f.write(np.ones(4, dtype=np.float32).tobytes())
+    with open(tmp_path / embed.PATHS_FNAME, "a") as f:
+        f.write("partial")
+    with embed.EmbeddingStore(tmp_path) as store:
+        assert (store.model_id, store.revision, store.dim) == ("model", "abc", 4)
+        assert store.paths == ["0.jpg", "1.jpg", "2.jpg"]
+        assert isinstance(store.features(), np.memmap)
+        np.testing.assert_array_equal(store.features(), features)
+    with pytest.raises(FileNotFoundError):
+        embed.EmbeddingStore(tmp_path / "missing")
+
+
+def test_embedding_store_changed(tmp_path):
+    image = tmp_path / "a.jpg"
+    image.write_bytes(b"abc")
+    with embed.EmbeddingStore(tmp_path / "store", "model", "abc") as store:
+        assert store.changed([image]) == [image]
+        store.add([image], np.zeros((1, 4), dtype=np.float32))
+        assert store.changed([image]) == []
+    image.write_bytes(b"abcd")
+    with embed.EmbeddingStore(tmp_path / "store") as store:
+        assert store.changed([image]) == [image]
+        store.add([image], np.ones((1, 4), dtype=np.float32))
+    with embed.EmbeddingStore(tmp_path / "store") as store:
+        assert store.changed([image]) == []
+        assert len(store) == 1
+        assert store.current_rows() == [1]
+        np.testing.assert_array_equal(store.features()[store.current_rows()], np.ones((1, 4)))
+
+
+def test_embed_and_classify_embeddings(tiny_model, tmp_path):
+    images = tmp_path / "images"
+    images.mkdir()
+    for name in ["a.jpg", "b.jpg"]:
+        (images / name).write_bytes(GOOD_IMAGE.read_bytes())
+    (images / "corrupt.jpg").write_bytes(b"not an image")
+    store_dir = tmp_path / "store"
+    args = ["predict", "embed", str(images), str(store_dir), "--model-id", tiny_model, "--image-formats", ".jpg"]
+    result = runner.invoke(cli.app, args)
+    assert result.exit_code == 0
+    with embed.EmbeddingStore.for_model(store_dir, tiny_model) as store:
+        assert sorted(Path(path).name for path in store.paths) == ["a.jpg", "b.jpg"]
+        session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+        image = decode.load_image(GOOD_IMAGE, session.decode_size)
+        np.testing.assert_allclose(store.features()[0], session.predict_features([image], 1)[0], atol=1e-5)
+        np.testing.assert_allclose(
+            embed.classify_features(session, store.features()), session.predict_scores([image] * 2, 2), atol=1e-5
+        )
+    assert runner.invoke(cli.app, args).exit_code == 0
+    assert len(embed.EmbeddingStore.for_model(store_dir, tiny_model).paths) == 2
+    (images / "a.jpg").write_bytes(GOOD_IMAGE.read_bytes() + b"\0")
+    assert runner.invoke(cli.app, args).exit_code == 0
+    with embed.EmbeddingStore.for_model(store_dir, tiny_model) as store:
+        assert len(store) == 2
+        assert len(store.paths) == 3
+    reports = tmp_path / "reports"
+    result = runner.invoke(
+        cli.app, ["predict", "classify-embeddings", str(store_dir), str(reports), "--model-id", tiny_model]
+    )
+    assert result.exit_code == 0
+    report = next(reports.glob("*.csv"))
+    assert len(report.read_text().splitlines()) == 3
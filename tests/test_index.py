@@ -0,0 +1,97 @@
+"""Tests for index module."""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from flyswot import core
+from flyswot.index import FileIndex
+
+# flake8: noqa
+
+
+@pytest.fixture()
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    for sub_dir in ["a", "a/b", "c"]:
+        (root / sub_dir).mkdir(parents=True)
+        for i in range(3):
+            (root / sub_dir / f"file_{i}.tif").write_bytes(b"x")
+    return root
+
+
+def test_first_scan_finds_everything(tree, tmp_path):
+    with FileIndex(tmp_path / "index.sqlite") as index:
+        scan = index.scan(tree)
+    assert sorted(scan.files) == sorted(tree.rglob("*.tif"))
+    assert sorted(scan.new) == sorted(scan.files)
+    assert scan.changed == scan.deleted == []
+
+
+def test_rescan_reports_new_changed_and_deleted(tree, tmp_path):
+    with FileIndex(tmp_path / "index.sqlite") as index:
+        index.scan(tree)
+        (tree / "a" / "b" / "new.tif").write_bytes(b"new")
+        (tree / "c" / "file_0.tif").unlink()
+        for file in (tree / "a").glob("*.tif"):
+            file.unlink()
+        (tree / "a" / "file_1.tif").write_bytes(b"rewritten")
+        (tree / "a" / "file_2.tif").write_bytes(b"rewritten")
+        scan = index.scan(tree)
+    assert scan.new == [tree / "a" / "b" / "new.tif"]
+    assert sorted(scan.changed) == [tree / "a" / "file_1.tif", tree / "a" / "file_2.tif"]
+    assert tree / "a" / "file_0.tif" in scan.deleted
+    assert tree / "c" / "file_0.tif" in scan.deleted
+    assert sorted(scan.files) == sorted(tree.rglob("*.tif"))
+
+
+def test_rescan_reuses_unchanged_directories(tree, tmp_path):
+    with FileIndex(tmp_path / "index.sqlite") as index:
+        index.scan(tree)
+        (tree / "c" / "file_0.tif").write_bytes(b"modified in place")
+        scan = index.scan(tree)
+        assert scan.changed == []
+        assert sorted(scan.files) == sorted(tree.rglob("*.tif"))
+        assert index.scan(tree, full_rescan=True).changed == [tree / "c" / "file_0.tif"]
+
+
+def test_rescan_removes_deleted_subtrees(tree, tmp_path):
+    with FileIndex(tmp_path / "index.sqlite") as index:
+        index.scan(tree)
+        for file in (tree / "a" / "b").iterdir():
+            file.unlink()
+        (tree / "a" / "b").rmdir()
+        scan = index.scan(tree)
+        assert sorted(scan.deleted) == sorted(tree / "a" / "b" / f"file_{i}.tif" for i in range(3))
+        assert index.scan(tree).deleted == []
+
+
+def test_get_image_files_from_pattern_with_index(tree, tmp_path):
+    with FileIndex(tmp_path / "index.sqlite") as index:
+        first = sorted(core.get_image_files_from_pattern(tree, None, ".tif", check_opens=False, index=index))
+        assert first == sorted(tree.rglob("*.tif"))
+        (tree / "c" / "file_fs.tif").write_bytes(b"new")
+        changed = list(core.get_image_files_from_pattern(tree, None, ".tif", index=index, changed_only=True))
+    assert changed == [tree / "c" / "file_fs.tif"]
+
+
+def test_scan_is_only_saved_when_the_index_closes_cleanly(tree, tmp_path):
+    with pytest.raises(RuntimeError):
+        with FileIndex(tmp_path / "index.sqlite") as index:
+            index.scan(tree)
+            raise RuntimeError("run failed")
+    with FileIndex(tmp_path / "index.sqlite") as index:
+        assert sorted(index.scan(tree).new) == sorted(tree.rglob("*.tif"))
+    with FileIndex(tmp_path / "index.sqlite") as index:
+        assert index.scan(tree).new == []
+
+
+def test_get_image_files_from_pattern_full_rescan(tree, tmp_path):
+    with FileIndex(tmp_path / "index.sqlite") as index:
+        list(core.iter_image_files(tree, None, ".tif", check_opens=False, index=index))
+        (tree / "c" / "file_0.tif").write_bytes(b"modified in place")
+        options = dict(check_opens=False, index=index, changed_only=True)
+        assert list(core.iter_image_files(tree, None, ".tif", **options)) == []
+        changed = list(core.iter_image_files(tree, None, ".tif", full_rescan=True, **options))
+    assert changed == [tree / "c" / "file_0.tif"]
@@ -1,14 +1,17 @@
 import csv
 import inspect
 import itertools
+import math
 import os
 import pathlib
+import pickle
 import shutil
 import string
 from collections import defaultdict
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 import pytest
 import rich
 import typer
@@ -16,6 +19,7 @@ from hypothesis import given
 from hypothesis import strategies
 from hypothesis import strategies as st
 from hypothesis.core import given
+from typer.testing import CliRunner
 from rich.table import Column
 from toolz import itertoolz
 
@@ -96,6 +100,38 @@ def test_multi_prediction_batch(confidence: float, label: str, imfile: Any):
     assert hasattr(batch.batch_labels, "__next__")
 
 
+def test_array_prediction_batch():
+    scores = [[0.2, 0.7, 0.1], [0.45, 0.1, 0.45]]
+    batch = inference.ArrayPredictionBatch(["a.tif", "b.tif"], scores, ["flysheet", "cover", "other"], top_k=2)
+    assert batch.scores.shape == (2, 1, 3) and batch.scores.dtype == np.float32
+    assert batch.top_indices.tolist() == [[[1, 0]], [[0, 2]]]
+    assert batch.predicted_labels.tolist() == [["cover"], ["flysheet"]]
+    assert list(batch.batch_labels) == [["cover"], ["flysheet"]]
+    item = batch.batch[0]
+    assert item.path == Path("a.tif")
+    assert item.predicted_labels == ["cover"]
+    [pairs] = item.top_predictions
+    assert [label for _, label in pairs] == ["cover", "flysheet"]
+    assert [score for score, _ in pairs] == pytest.approx([0.7, 0.2])
+    [pairs] = batch.batch[1].top_predictions
+    assert [label for _, label in pairs] == ["flysheet", "other"]
+    assert np.shares_memory(item.scores, batch.scores)
+    assert batch.labels is inference.ArrayPredictionBatch(["c.tif"], [[1, 0, 0]], list(batch.labels)).labels
+    assert pickle.loads(pickle.dumps(batch)) == batch
+    with pytest.raises(ValueError):
+        inference.ArrayPredictionBatch(["a.tif"], scores, ["flysheet", "cover", "other"])
+
+
+def test_csv_report_writer_array_batch_keeps_tied_labels(tmp_path):
+    batch = inference.ArrayPredictionBatch([Path("/images/a.tif")], [[0.5, 0.5, 0.0]], ["flysheet", "cover", "other"])
+    csv_fname = tmp_path / "report.csv"
+    with cli_inference.CsvReportWriter(csv_fname) as report:
+        report.write(batch)
+    with open(csv_fname, newline="") as f:
+        [row] = list(csv.DictReader(f))
+    assert (row["prediction_label_a_0"], row["prediction_label_a_1"]) == ("flysheet", "cover")
+
+
 FIXTURE_DIR = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
     "test_files",
@@ -174,6 +210,32 @@ def test_predict_directory(datafiles, tmp_path) -> None:
         bs=1,
         image_formats=[".jpg"],
         model_id="flyswot/convnext-tiny-224_flyswot",
+        decode_workers=2,
+        prefetch=2,
+        decode_processes=False,
+        workers=1,
+        threads_per_worker=None,
+        backend=cli_inference.Backend.pytorch,
+        reduced_decode=True,
+        quantize=None,
+        use_cache=False,
+        cache_max_mb=1024,
+        cache_hash=False,
+        use_tensor_cache=False,
+        tensor_cache_max_mb=4096,
+        resume=None,
+        walk_workers=1,
+        use_index=False,
+        changed_only=False,
+        full_rescan=False,
+        stream=False,
+        exclude_dir=[],
+        max_depth=None,
+        skip_hidden=False,
+        prefer_ext=None,
+        report_format=cli_inference.ReportFormat.csv,
+        directory_summary=False,
+        max_memory_mb=None,
     )
     csv_file = list(tmp_path.rglob("*.csv"))
     assert csv_file
@@ -288,3 +350,440 @@ def test_file_summary_markdown():
     assert output
     assert isinstance(output, rich.panel.Panel)
     output = cli_inference.create_file_summary_markdown("fs", 3, Path("."), [".jpg", ".png"])
+
+
+class BadImageSession:
+    """Fake inference session which raises ValueError for batches containing a 'bad' image"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def predict_images(self, files, images, bs):
+        self.calls += 1
+        if any("bad" in file.name for file in files):
+            raise ValueError("bad image")
+        items = [inference.MultiLabelImagePredictionItem(file, [{0.9: "label", 0.1: "other"}]) for file in files]
+        return inference.MultiPredictionBatch(items)
+
+
+def test_predict_bisecting_isolates_bad_images():
+    files = [Path(f"good_{i}.jpg") for i in range(64)]
+    files[10] = Path("bad_10.jpg")
+    files[50] = Path("bad_50.jpg")
+    session = BadImageSession()
+    predictions, corrupt = cli_inference.predict_bisecting(files, [None] * len(files), session, 64)
+    assert set(corrupt) == {Path("bad_10.jpg"), Path("bad_50.jpg")}
+    predicted = [item.path for batch in predictions for item in batch.batch]
+    assert predicted == [file for file in files if "bad" not in file.name]
+    assert session.calls < 30
+
+
+def test_predict_bisecting_good_batch_single_call():
+    files = [Path(f"good_{i}.jpg") for i in range(16)]
+    session = BadImageSession()
+    predictions, corrupt = cli_inference.predict_bisecting(files, [None] * len(files), session, 16)
+    assert not corrupt
+    assert len(predictions) == 1
+    assert session.calls == 1
+
+
+def test_write_corrupt_images_csv(tmp_path):
+    csv_fname = tmp_path / "report.csv"
+    corrupt_images = {tmp_path / "b.jpg": "ValueError()", tmp_path / "a.jpg": "OSError()"}
+    corrupt_fname = cli_inference.write_corrupt_images_csv(corrupt_images, csv_fname)
+    assert corrupt_fname == tmp_path / "report_corrupt_images.csv"
+    with open(corrupt_fname, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["path"] for row in rows] == [str(tmp_path / "a.jpg"), str(tmp_path / "b.jpg")]
+    assert rows[0]["error"] == "OSError()"
+    assert rows[0]["directory"] == str(tmp_path)
+
+
+@pytest.fixture()
+def mixed_image_files(tmp_path):
+    """Good and corrupt image files"""
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    for file, i in itertools.product(["fly_fse.jpg", "corrupt_image.jpg"], range(5)):
+        shutil.copyfile(os.path.join(FIXTURE_DIR, file), image_dir / f"{i}_{file}")
+    return sorted(image_dir.iterdir())
+
+
+def test_predict_files_sharded_matches_single_process(tiny_model, mixed_image_files, tmp_path):
+    single_csv = tmp_path / "single.csv"
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    corrupt, checked = cli_inference.predict_files(mixed_image_files, session, 3, single_csv)
+    sharded_csv = tmp_path / "sharded.csv"
+    sharded_corrupt, sharded_checked = cli_inference.predict_files_sharded(
+        mixed_image_files, tiny_model, 3, sharded_csv, workers=2, threads_per_worker=1
+    )
+    assert checked == sharded_checked == 10
+    assert corrupt.keys() == sharded_corrupt.keys()
+    with open(single_csv, newline="") as f:
+        single_rows = list(csv.DictReader(f))
+    with open(sharded_csv, newline="") as f:
+        sharded_rows = list(csv.DictReader(f))
+    assert [row["path"] for row in single_rows] == [row["path"] for row in sharded_rows]
+    assert [row["path"] for row in sharded_rows] == [str(f) for f in mixed_image_files if "fly_fse" in f.name]
+
+
+@pytest.mark.parametrize("multi_label", [False, True])
+def test_onnx_inference_session_matches_pytorch(tiny_model, tmp_path, multi_label):
+    pytest.importorskip("onnxruntime")
+    from flyswot import models
+
+    export_dir = models.export_onnx(tiny_model, model_dir=tmp_path, force=False)
+    onnx_session = cli_inference.create_inference_session(str(export_dir), cli_inference.Backend.onnx)
+    assert isinstance(onnx_session, cli_inference.OnnxInferenceSession)
+    assert not onnx_session.multi_label
+    torch_session = cli_inference.create_inference_session(tiny_model)
+    assert isinstance(torch_session, cli_inference.HuggingFaceInferenceSession)
+    onnx_session.multi_label = torch_session.multi_label = multi_label
+    files = [Path(FIXTURE_DIR) / "fly_fse.jpg"] * 3
+    onnx_batch = onnx_session.predict_batch(files, 2)
+    torch_batch = torch_session.predict_batch(files, 2)
+    assert len(onnx_batch.batch) == 3
+    for onnx_item, torch_item in zip(onnx_batch.batch, torch_batch.batch):
+        assert onnx_item.predicted_labels == torch_item.predicted_labels
+        onnx_scores = [score for score, _ in onnx_item.top_predictions[0]]
+        torch_scores = [score for score, _ in torch_item.top_predictions[0]]
+        assert onnx_scores == pytest.approx(torch_scores, abs=1e-5)
+
+
+def test_pytorch_dynamic_quantization(tiny_model):
+    pytest.importorskip("torchao")
+    session = cli_inference.create_inference_session(tiny_model, quantization="dynamic")
+    batch = session.predict_batch([Path(FIXTURE_DIR) / "fly_fse.jpg"], 1)
+    assert batch.batch[0].predicted_labels[0] in {"flysheet", "cover", "other"}
+    with pytest.raises(ValueError):
+        cli_inference.create_inference_session(tiny_model, quantization="static")
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_predict_directory_local_model(tiny_model, mixed_image_files, tmp_path, stream):
+    report_dir = tmp_path / "reports"
+    report_dir.mkdir()
+    cli_inference.predict_directory(
+        mixed_image_files[0].parent,
+        report_dir,
+        pattern=None,
+        bs=3,
+        image_formats=[".jpg"],
+        model_id=tiny_model,
+        decode_workers=2,
+        prefetch=2,
+        decode_processes=False,
+        workers=1,
+        threads_per_worker=None,
+        backend=cli_inference.Backend.pytorch,
+        reduced_decode=True,
+        quantize=None,
+        use_cache=False,
+        cache_max_mb=1024,
+        cache_hash=False,
+        use_tensor_cache=False,
+        tensor_cache_max_mb=4096,
+        resume=None,
+        walk_workers=1,
+        use_index=False,
+        changed_only=False,
+        full_rescan=False,
+        stream=stream,
+        exclude_dir=[],
+        max_depth=None,
+        skip_hidden=False,
+        prefer_ext=None,
+        report_format=cli_inference.ReportFormat.csv,
+        directory_summary=False,
+        max_memory_mb=None,
+    )
+    reports = sorted(report_dir.glob("*.csv"))
+    assert [report.name.endswith("_corrupt_images.csv") for report in reports] == [False, True]
+    with open(reports[0], newline="") as f:
+        assert len(list(csv.DictReader(f))) == 5
+    with open(reports[1], newline="") as f:
+        assert len(list(csv.DictReader(f))) == 5
+
+
+def test_predict_files_with_cache(tiny_model, mixed_image_files, tmp_path):
+    from flyswot.cache import PredictionCache
+
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    reports = []
+    for run in range(2):
+        csv_fname = tmp_path / f"run_{run}.csv"
+        with PredictionCache("tiny", path=tmp_path / "cache.sqlite") as cache:
+            corrupt, checked = cli_inference.predict_files(mixed_image_files, session, 3, csv_fname, cache=cache)
+        assert checked == 10
+        assert len(corrupt) == 5
+        with open(csv_fname, newline="") as f:
+            reports.append(list(csv.DictReader(f)))
+    assert reports[0] == reports[1]
+    with PredictionCache("tiny", path=tmp_path / "cache.sqlite") as cache:
+        hits, misses = cache.lookup(mixed_image_files)
+    assert len(hits) == 5
+    assert all("corrupt" in file.name for file in misses)
+
+
+def test_truncate_partial_row(tmp_path):
+    report = tmp_path / "report.csv"
+    report.write_text("path,directory\n/a.tif,/\n/b.t")
+    cli_inference.truncate_partial_row(report, chunk_size=4)
+    assert report.read_text() == "path,directory\n/a.tif,/\n"
+    cli_inference.truncate_partial_row(report)
+    assert report.read_text() == "path,directory\n/a.tif,/\n"
+
+
+def test_predict_directory_resume(tiny_model, mixed_image_files, tmp_path):
+    report_dir = tmp_path / "reports"
+    report_dir.mkdir()
+    options = dict(
+        pattern=None,
+        bs=2,
+        image_formats=[".jpg"],
+        model_id=tiny_model,
+        decode_workers=0,
+        prefetch=0,
+        decode_processes=False,
+        workers=1,
+        threads_per_worker=None,
+        backend=cli_inference.Backend.pytorch,
+        reduced_decode=True,
+        quantize=None,
+        use_cache=False,
+        cache_max_mb=1024,
+        cache_hash=False,
+        use_tensor_cache=False,
+        tensor_cache_max_mb=4096,
+        walk_workers=2,
+        use_index=False,
+        changed_only=False,
+        full_rescan=False,
+        stream=False,
+        exclude_dir=[],
+        max_depth=None,
+        skip_hidden=False,
+        prefer_ext=None,
+        report_format=cli_inference.ReportFormat.csv,
+        directory_summary=True,
+        max_memory_mb=None,
+    )
+    cli_inference.predict_directory(mixed_image_files[0].parent, report_dir, resume=None, **options)
+    report = next(report for report in report_dir.glob("*.csv") if "corrupt" not in report.name)
+    complete = report.read_text()
+    lines = complete.splitlines(keepends=True)
+    report.write_text("".join(lines[:3]) + lines[3][:10])
+    cli_inference.create_corrupt_images_fname(report).unlink()
+    cli_inference.predict_directory(mixed_image_files[0].parent, report_dir, resume=report, **options)
+    with open(report, newline="") as f:
+        paths = [row["path"] for row in csv.DictReader(f)]
+    assert sorted(paths) == sorted(str(f) for f in mixed_image_files if "fly_fse" in f.name)
+    assert len(cli_inference.read_corrupt_images_csv(report)) == 5
+    report.write_text("")
+    cli_inference.create_corrupt_images_fname(report).unlink()
+    cli_inference.predict_directory(mixed_image_files[0].parent, report_dir, resume=report, **options)
+    assert report.read_text() == complete
+
+
+@pytest.mark.parametrize("report_name,report_format", [("report.parquet", "parquet"), ("report.parquet", "csv")])
+def test_predict_directory_resume_needs_csv_report(tmp_path, report_name, report_format):
+    report = tmp_path / report_name
+    report.write_bytes(b"PAR1 not a csv report")
+    result = CliRunner().invoke(
+        cli_inference.app,
+        ["directory", str(tmp_path), str(tmp_path), "--resume", str(report), "--format", report_format],
+    )
+    assert result.exit_code == 2
+    assert report.read_bytes() == b"PAR1 not a csv report"
+
+
+def test_predict_files_streamed(tiny_model, mixed_image_files, tmp_path):
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    listed_csv = tmp_path / "listed.csv"
+    cli_inference.predict_files(mixed_image_files, session, 3, listed_csv)
+    streamed_csv = tmp_path / "streamed.csv"
+    corrupt, checked = cli_inference.predict_files(iter(mixed_image_files), session, 3, streamed_csv)
+    assert checked == 10
+    assert len(corrupt) == 5
+    assert streamed_csv.read_text() == listed_csv.read_text()
+
+
+def test_predict_files_sharded_streamed(tiny_model, mixed_image_files, tmp_path):
+    csv_fname = tmp_path / "streamed.csv"
+    corrupt, checked = cli_inference.predict_files_sharded(
+        iter(mixed_image_files), tiny_model, 2, csv_fname, workers=2, threads_per_worker=1
+    )
+    assert checked == 10
+    assert len(corrupt) == 5
+    with open(csv_fname, newline="") as f:
+        assert [row["path"] for row in csv.DictReader(f)] == [str(f) for f in mixed_image_files if "fly_fse" in f.name]
+
+
+def test_predict_manifest_from_stdin(tiny_model, mixed_image_files, tmp_path):
+    from typer.testing import CliRunner
+
+    manifest = "path\n" + "".join(f"{file}\n" for file in mixed_image_files) + f"{tmp_path / 'missing.jpg'}\n"
+    result = CliRunner().invoke(
+        cli_inference.app,
+        ["manifest", "-", str(tmp_path / "reports"), "--column", "path", "--model-id", tiny_model, "--bs", "3"],
+        input=manifest,
+    )
+    assert result.exit_code == 0, result.output
+    [report] = (tmp_path / "reports").glob("*[0-9].csv")
+    with open(report, newline="") as f:
+        assert [row["path"] for row in csv.DictReader(f)] == [str(f) for f in mixed_image_files if "fly_fse" in f.name]
+    assert len(cli_inference.read_corrupt_images_csv(report)) == 6
+
+
+def test_csv_report_writer(tmp_path):
+    csv_fname = tmp_path / "report.csv"
+    items = [
+        inference.MultiLabelImagePredictionItem(
+            Path(f"/images/{i}.tif"), [{0.2: "cover", 0.7: "flysheet", 0.1: "other"}]
+        )
+        for i in range(3)
+    ]
+    with cli_inference.CsvReportWriter(csv_fname) as report:
+        report.write(inference.MultiPredictionBatch(items[:2]))
+        report.flush()
+        report.write(
+            inference.MultiPredictionBatch([inference.MultiLabelImagePredictionItem(Path("/x.tif"), [{1.0: "a"}])])
+        )
+    with cli_inference.CsvReportWriter(csv_fname, append=True) as report:
+        report.write(inference.MultiPredictionBatch(items[2:]))
+    with open(csv_fname, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["path"] for row in rows] == ["/images/0.tif", "/images/1.tif", "/x.tif", "/images/2.tif"]
+    assert rows[0]["prediction_label_a_0"] == "flysheet"
+    assert rows[0]["confidence_label_a_1"] == "0.2"
+    assert rows[2]["prediction_label_a_1"] == ""
+    assert cli_inference.labels_from_csv(csv_fname) == [["flysheet", "flysheet", "a", "flysheet"]]
+
+
+@pytest.mark.parametrize("report_format", [cli_inference.ReportFormat.parquet, cli_inference.ReportFormat.arrow])
+def test_arrow_report_writer(tmp_path, report_format):
+    pa = pytest.importorskip("pyarrow")
+    fname = tmp_path / f"report{report_format.suffix}"
+    labels = ["flysheet", "cover", "other"]
+    with cli_inference.ArrowReportWriter(fname, labels, report_format, row_group_size=2) as report:
+        for i in range(5):
+            item = inference.MultiLabelImagePredictionItem(
+                Path(f"/images/{i}.tif"), [{0.75: "cover", 0.25: "flysheet"}]
+            )
+            report.write(inference.MultiPredictionBatch([item]))
+            report.flush()
+    if report_format == cli_inference.ReportFormat.parquet:
+        import pyarrow.parquet as pq
+
+        assert pq.ParquetFile(fname).metadata.num_row_groups == 3
+        table = pq.read_table(fname, columns=["path", "scores_a"])
+    else:
+        table = pa.ipc.open_file(fname).read_all()
+    assert table.schema.metadata[b"flyswot.labels"] == b'["flysheet", "cover", "other"]'
+    assert table.column("path").to_pylist() == [f"/images/{i}.tif" for i in range(5)]
+    scores = table.column("scores_a").to_pylist()[0]
+    assert scores[:2] == [0.25, 0.75] and math.isnan(scores[2])
+    assert cli_inference.labels_from_arrow(fname) == [["cover"] * 5]
+
+
+def test_predict_files_parquet_report(tiny_model, mixed_image_files, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    report = tmp_path / "report.parquet"
+    corrupt, checked = cli_inference.predict_files(
+        mixed_image_files, session, 3, report, report_format=cli_inference.ReportFormat.parquet
+    )
+    assert checked == 10 and len(corrupt) == 5
+    table = pq.read_table(report)
+    assert table.column("path").to_pylist() == [str(f) for f in mixed_image_files if "fly_fse" in f.name]
+    for scores in table.column("scores_a").to_pylist():
+        assert sum(scores) == pytest.approx(1.0, abs=1e-4)
+    with pytest.raises(ValueError):
+        cli_inference.create_report_writer(report, cli_inference.ReportFormat.parquet, append=True)
+
+
+def test_label_counts_match_report(tiny_model, mixed_image_files, tmp_path):
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    csv_fname = tmp_path / "report.csv"
+    label_counts = cli_inference.LabelCounts(per_directory=True)
+    cli_inference.predict_files(mixed_image_files, session, 3, csv_fname, label_counts=label_counts)
+    expected = [itertoolz.frequencies(labels) for labels in cli_inference.labels_from_csv(csv_fname)]
+    assert label_counts.heads == expected
+    assert label_counts.directories == {str(mixed_image_files[0].parent): expected}
+    from_report = cli_inference.LabelCounts(per_directory=True)
+    from_report.add_csv_report(csv_fname)
+    assert from_report.heads == expected and from_report.directories == label_counts.directories
+    [table] = label_counts.tables()
+    assert table.row_count == len(expected[0]) + 1
+    [directory_table] = label_counts.directory_tables()
+    assert directory_table.row_count == 1
+
+
+def test_huggingface_session_matches_pipeline(tiny_model, mixed_image_files):
+    from transformers import pipeline
+
+    from flyswot import decode
+
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    files = [file for file in mixed_image_files if "fly_fse" in file.name]
+    images = [decode.load_image(file, session.decode_size) for file in files]
+    classifier = pipeline("image-classification", model=session.model, image_processor=session.image_processor)
+    expected = [{result["label"]: result["score"] for result in results} for results in classifier(images, top_k=3)]
+    logits = session.predict_logits(images, 2)
+    assert logits.shape == (len(files), 3)
+    batch = session.predict_images(files, images, 2)
+    for scores, labels in zip(batch.scores[:, 0], expected):
+        assert scores.tolist() == pytest.approx([labels[label] for label in session.labels], abs=1e-6)
+    assert session.predict_image(files[0])[0]["label"] == batch.predicted_labels[0, 0]
+
+
+def test_huggingface_session_tensor_cache(tiny_model, mixed_image_files, tmp_path):
+    from flyswot import decode
+
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    files = [file for file in mixed_image_files if "fly_fse" in file.name]
+    corrupt = [file for file in mixed_image_files if "corrupt" in file.name][0]
+    images = [decode.load_image(file, session.decode_size) for file in files]
+    expected = session.predict_images(files, images, 2)
+    inputs = session.preprocess(images)
+    assert inputs.dtype == np.uint8
+    np.testing.assert_allclose(session.predict_preprocessed(files, inputs, 2).scores, expected.scores, atol=1e-5)
+    with cli_inference.TensorCache("tiny", tmp_path) as tensor_cache:
+        session.tensor_cache = tensor_cache
+        session.predict_images(files, images, 2)
+        written = []
+        misses = list(
+            cli_inference.skip_preprocessed_files(
+                [*files, corrupt], session, 2, lambda batch, checked: written.extend(batch)
+            )
+        )
+    assert misses == [corrupt]
+    assert [path for batch in written for path in batch.paths] == files
+    np.testing.assert_allclose(np.concatenate([batch.scores for batch in written]), expected.scores, atol=1e-5)
+
+
+def test_huggingface_session_preprocess_float16(tiny_model):
+    from flyswot import decode
+
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    calls = []
+
+    class ShiftedProcessor(type(session.image_processor)):
+        def __call__(self, images, **kwargs):
+            calls.append(kwargs)
+            outputs = super().__call__(images, **kwargs)
+            outputs["pixel_values"] = outputs["pixel_values"] + 0.5
+            return outputs
+
+    image = decode.load_image(Path(FIXTURE_DIR) / "fly_fse.jpg", session.decode_size)
+    raw = session.image_processor([image], do_rescale=False, do_normalize=False, return_tensors="np")
+    config = session.image_processor.to_dict()
+    mean = np.array(config["image_mean"]).reshape(-1, 1, 1)
+    std = np.array(config["image_std"]).reshape(-1, 1, 1)
+    expected = ((raw["pixel_values"] + 0.5) * config["rescale_factor"] - mean) / std
+    session.image_processor = ShiftedProcessor(**config)
+    inputs = session.preprocess([image])
+    assert len(calls) == 1
+    assert inputs.dtype == np.float16
+    np.testing.assert_allclose(inputs, expected, atol=1e-2)
+    np.testing.assert_array_equal(session.pixel_values(inputs).numpy(), inputs.astype(np.float32))
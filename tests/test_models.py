@@ -1,6 +1,8 @@
 """Tests model module."""
 
 import datetime
+import json
+import shutil
 import time
 from pathlib import Path
 from typing import Any
@@ -121,3 +123,116 @@ def test_model_card_link():
     link = models.hub_model_link("flyswot/convnext-tiny-224_flyswot")
     assert link
     assert isinstance(link, str)
+
+
+def test_image_input_size():
+    from transformers import ConvNextImageProcessor, DeiTImageProcessor, ViTImageProcessor
+
+    assert models.image_input_size(ConvNextImageProcessor(size={"shortest_edge": 224})) == (224, 224)
+    assert models.image_input_size(ViTImageProcessor(size={"height": 384, "width": 256})) == (384, 256)
+    processor = DeiTImageProcessor(size={"height": 256, "width": 256}, crop_size={"height": 224, "width": 224})
+    assert models.image_input_size(processor) == (224, 224)
+
+
+def test_export_onnx(tiny_model, tmp_path):
+    pytest.importorskip("onnxruntime")
+    export_dir = models.export_onnx(tiny_model, model_dir=tmp_path, force=False)
+    assert (export_dir / models.ONNX_MODEL_NAME).is_file()
+    assert (export_dir / "config.json").is_file()
+    assert (export_dir / "preprocessor_config.json").is_file()
+    modified = (export_dir / models.ONNX_MODEL_NAME).stat().st_mtime
+    assert models.export_onnx(tiny_model, model_dir=tmp_path, force=False) == export_dir
+    assert (export_dir / models.ONNX_MODEL_NAME).stat().st_mtime == modified
+
+
+def test_export_onnx_is_redone_for_new_revision(tiny_model, tmp_path):
+    pytest.importorskip("onnxruntime")
+    model = tmp_path / "model"
+    shutil.copytree(tiny_model, model)
+    export_dir = models.export_onnx(str(model), model_dir=tmp_path, force=False)
+    (model / "config.json").write_text((model / "config.json").read_text() + "\n")
+    updated_dir = models.export_onnx(str(model), model_dir=tmp_path, force=False)
+    assert updated_dir != export_dir
+    assert (updated_dir / models.ONNX_MODEL_NAME).is_file()
+    assert models.quantized_onnx_path(updated_dir, models.Quantization.dynamic).parent == updated_dir
+
+
+def test_sample_files():
+    files = [Path(f"{i}.tif") for i in range(100)]
+    sample = models.sample_files(files, 10)
+    assert len(sample) == 10
+    assert sample[0] == Path("0.tif")
+    assert len(set(sample)) == 10
+    assert models.sample_files(files[:5], 10) == sorted(files[:5])
+
+
+@pytest.mark.parametrize("mode", list(models.Quantization))
+def test_quantize(tiny_model, tmp_path, mode):
+    pytest.importorskip("onnxruntime")
+    sample_dir = tmp_path / "images"
+    sample_dir.mkdir()
+    for i in range(4):
+        (sample_dir / f"{i}.jpg").write_bytes(Path("tests/test_files/fly_fse.jpg").read_bytes())
+    quantized_path = models.quantize(
+        tiny_model,
+        mode=mode,
+        sample_dir=sample_dir,
+        sample_size=3,
+        image_formats=[".jpg"],
+        model_dir=tmp_path,
+        force=False,
+        backend=models.Backend.onnx,
+    )
+    assert quantized_path.is_file()
+    assert quantized_path.name == f"model.{mode.value}-int8.onnx"
+    report = json.loads(quantized_path.with_suffix(".agreement.json").read_text())
+    assert report["images"] == 3
+    assert 0.0 <= report["top_1_agreement"] <= 1.0
+
+
+def test_quantize_pytorch_agreement_report(tiny_model, tmp_path):
+    pytest.importorskip("torchao")
+    sample_dir = tmp_path / "images"
+    sample_dir.mkdir()
+    for i in range(4):
+        (sample_dir / f"{i}.jpg").write_bytes(Path("tests/test_files/fly_fse.jpg").read_bytes())
+    options = dict(sample_size=3, image_formats=[".jpg"], model_dir=tmp_path, force=False)
+    report_path = models.quantize(
+        tiny_model, mode=models.Quantization.dynamic, sample_dir=sample_dir, backend=models.Backend.pytorch, **options
+    )
+    report = json.loads(report_path.read_text())
+    assert report["images"] == 3
+    assert report["max_confidence_difference"] < 0.05
+    with pytest.raises(typer.BadParameter):
+        models.quantize(
+            tiny_model,
+            mode=models.Quantization.static,
+            sample_dir=sample_dir,
+            backend=models.Backend.pytorch,
+            **options,
+        )
+
+
+def test_quantize_static_needs_sample(tiny_model, tmp_path):
+    with pytest.raises(typer.BadParameter):
+        models.quantize(
+            tiny_model,
+            mode=models.Quantization.static,
+            sample_dir=None,
+            sample_size=3,
+            image_formats=[".jpg"],
+            model_dir=tmp_path,
+            force=False,
+            backend=models.Backend.onnx,
+        )
+
+
+def test_decode_size():
+    from transformers import ConvNextImageProcessor, DeiTImageProcessor, ViTImageProcessor
+
+    assert models.decode_size(ConvNextImageProcessor(size={"shortest_edge": 224}, crop_pct=0.875)) == 256
+    assert models.decode_size(ConvNextImageProcessor(size={"shortest_edge": 224}, crop_pct=None)) == 224
+    assert models.decode_size(ViTImageProcessor(size={"height": 384, "width": 256})) == 384
+    # Resized to 256 before the 224 crop
+    processor = DeiTImageProcessor(size={"height": 256, "width": 256}, crop_size={"height": 224, "width": 224})
+    assert models.decode_size(processor) == 256
@@ -0,0 +1,108 @@
+"""Tests for serve module."""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from flyswot import cli_inference, inference, serve
+
+# flake8: noqa
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    "test_files",
+)
+GOOD_IMAGE = Path(FIXTURE_DIR) / "fly_fse.jpg"
+CORRUPT_IMAGE = Path(FIXTURE_DIR) / "corrupt_image.jpg"
+
+
+@pytest.fixture(scope="module")
+def batcher(tiny_model):
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    batcher = serve.MicroBatcher(session, max_batch_size=4, max_wait=0.2)
+    yield batcher
+    batcher.close()
+
+
+def test_micro_batcher_merges_concurrent_requests(batcher):
+    batches_before = batcher.metrics.batches
+    with ThreadPoolExecutor(8) as executor:
+        predictions = list(executor.map(batcher.predict, [GOOD_IMAGE] * 8))
+    assert all(prediction.path == GOOD_IMAGE for prediction in predictions)
+    assert 2 <= batcher.metrics.batches - batches_before < 8
+    expected = batcher.session.predict_batch([GOOD_IMAGE], 1).batch[0]
+    assert predictions[0].predicted_labels == expected.predicted_labels
+
+
+def test_micro_batcher_corrupt_image(batcher):
+    futures = [batcher.submit(CORRUPT_IMAGE), batcher.submit(GOOD_IMAGE)]
+    with pytest.raises(serve.CorruptImageError):
+        futures[0].result()
+    assert futures[1].result().path == GOOD_IMAGE
+
+
+def test_server_metrics_snapshot():
+    metrics = serve.ServerMetrics()
+    assert metrics.snapshot(0)["mean_batch_size"] == 0.0
+    metrics.record_batch(3)
+    for latency in [0.01, 0.02, 0.03]:
+        metrics.record_request(latency)
+    metrics.record_request(0.5, failed=True)
+    snapshot = metrics.snapshot(2)
+    assert snapshot["queue_depth"] == 2
+    assert snapshot["requests"] == 4
+    assert snapshot["errors"] == 1
+    assert snapshot["mean_batch_size"] == 3
+    assert snapshot["latency_ms"]["p50"] == pytest.approx(30)
+    assert snapshot["latency_ms"]["max"] == pytest.approx(500)
+
+
+@pytest.mark.parametrize("use_socket", [False, True])
+def test_server(batcher, tmp_path, use_socket):
+    socket_path = tmp_path / "flyswot.sock" if use_socket else None
+    server = serve.create_server(batcher, "tiny", port=0, socket_path=socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    if use_socket:
+        connection = dict(socket_path=socket_path)
+    else:
+        connection = dict(url=f"http://127.0.0.1:{server.server_address[1]}")
+    try:
+        prediction = serve.request_prediction(GOOD_IMAGE, **connection)
+        assert prediction["path"] == str(GOOD_IMAGE)
+        assert prediction["predicted_labels"][0] in {"flysheet", "cover", "other"}
+        with pytest.raises(ValueError):
+            serve.request_prediction(CORRUPT_IMAGE, **connection)
+        status, health = serve.request("GET", "/health", **connection)
+        assert status == 200 and health["model"] == "tiny"
+        status, metrics = serve.request("GET", "/metrics", **connection)
+        assert status == 200 and metrics["requests"] >= 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_request_prediction_without_server(tmp_path):
+    with pytest.raises(ConnectionError):
+        serve.request_prediction(GOOD_IMAGE, socket_path=tmp_path / "missing.sock")
+
+
+def test_prediction_to_json_keeps_tied_labels():
+    scores = np.array([[0.4, 0.4, 0.2]], dtype=np.float32)
+    (prediction,) = inference.ArrayPredictionBatch([GOOD_IMAGE], scores, ["a", "b", "c"]).batch
+    (predictions,) = serve.prediction_to_json(prediction)["predictions"]
+    assert [p["label"] for p in predictions] == ["a", "b", "c"]
+
+
+def test_serve_rejects_static_quantization():
+    from typer.testing import CliRunner
+
+    from flyswot.cli import app
+
+    for backend in ("pytorch", "onnx"):
+        result = CliRunner().invoke(app, ["serve", "--quantize", "static", "--backend", backend])
+        assert result.exit_code == 2
@@ -0,0 +1,97 @@
+"""Tests for watch module."""
+
+import csv
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from flyswot import cli_inference, watch
+
+# flake8: noqa
+
+FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    "test_files",
+)
+
+
+def test_polling_watcher(tmp_path):
+    (tmp_path / "existing.jpg").write_bytes(b"old")
+    watcher = watch.PollingWatcher(tmp_path)
+    assert watcher.changes() == set()
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "new.jpg").write_bytes(b"new")
+    assert watcher.changes() == {tmp_path / "sub" / "new.jpg"}
+    assert watcher.changes() == set()
+    (tmp_path / "existing.jpg").write_bytes(b"modified")
+    assert watcher.changes() == {tmp_path / "existing.jpg"}
+
+
+def test_event_watcher(tmp_path):
+    pytest.importorskip("watchdog")
+    watcher = watch.EventWatcher(tmp_path)
+    try:
+        (tmp_path / "new.jpg").write_bytes(b"new")
+        changed = set()
+        for _ in range(50):
+            changed |= watcher.changes()
+            if changed:
+                break
+            time.sleep(0.1)
+        assert changed == {tmp_path / "new.jpg"}
+    finally:
+        watcher.close()
+
+
+def test_settling_files(tmp_path):
+    image = tmp_path / "image.jpg"
+    image.write_bytes(b"partial")
+    settling = watch.SettlingFiles(settle=0.2)
+    settling.add({image, tmp_path / "deleted.jpg"})
+    assert len(settling) == 1
+    assert settling.ready() == []
+    image.write_bytes(b"partial and the rest")
+    time.sleep(0.25)
+    assert settling.ready() == []
+    time.sleep(0.25)
+    assert settling.ready() == [image]
+    assert len(settling) == 0
+
+
+def test_watch_files(tiny_model, tmp_path):
+    watched = tmp_path / "watched"
+    watched.mkdir()
+    report = watch.RollingReport(tmp_path / "reports")
+    report.csv_directory.mkdir()
+    session = cli_inference.HuggingFaceInferenceSession(tiny_model)
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=watch.watch_files,
+        args=(watch.PollingWatcher(watched), session, report),
+        kwargs=dict(image_formats={".jpg"}, bs=2, max_wait=0.2, settle=0.1, interval=0.05, stop=stop),
+    )
+    thread.start()
+    try:
+        for i in range(3):
+            shutil.copyfile(os.path.join(FIXTURE_DIR, "fly_fse.jpg"), watched / f"{i}.jpg")
+        shutil.copyfile(os.path.join(FIXTURE_DIR, "corrupt_image.jpg"), watched / "corrupt.jpg")
+        (watched / "notes.txt").write_text("ignored")
+        for _ in range(100):
+            if report.csv_fname and len(report.corrupt_images) == 1 and report.csv_fname.exists():
+                with open(report.csv_fname, newline="") as f:
+                    if len(list(csv.DictReader(f))) == 3:
+                        break
+            time.sleep(0.1)
+    finally:
+        stop.set()
+        thread.join()
+    assert report.csv_fname == watch.rolling_report_fname(tmp_path / "reports")
+    with open(report.csv_fname, newline="") as f:
+        paths = sorted(row["path"] for row in csv.DictReader(f))
+    assert paths == [str(watched / f"{i}.jpg") for i in range(3)]
+    assert list(report.corrupt_images) == [watched / "corrupt.jpg"]
+    assert cli_inference.create_corrupt_images_fname(report.csv_fname).exists()